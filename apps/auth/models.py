@@ -12,13 +12,13 @@ from django.contrib.auth.models import UserManager as ParentUserManager
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.postgres.fields import CIEmailField
 from django.db import models
-from django.template.loader import render_to_string
 from django.utils import timezone
 
 from rest_framework.generics import get_object_or_404
 from rest_framework.authtoken.models import Token
 
 from apps.common import constant as common_constant
+from apps.common.mail import build_message, send_messages
 
 logger = logging.getLogger(__name__)
 
@@ -156,14 +156,7 @@ class User(AbstractUser):
         '''
         email user.
         '''
-        html_message = render_to_string(html_template, context=context)
-        text_message = render_to_string(text_template, context=context)
-
-        super(User, self).email_user(
-            message=text_message,
-            html_message=html_message,
-            subject=subject
-        )
+        send_messages([build_message(self, text_template, html_template, subject, context)])
 
     def reset_password(self):
         '''
@@ -40,3 +40,32 @@ WORKFLOW_START_UPDATE_THRESHOLD_HOURS = 2
 TASK_START_UPDATE_THRESHOLD_HOURS = 2
 WORKFLOW_PERIODIC_TASK_SCHEDULE_SECONDS = 3600.0
 TASK_PERIODIC_TASK_SCHEDULE_SECONDS = 3600.0
+TIMER_KIND = namedtuple(
+    'TIMER_KIND',
+    'START_WORKFLOW START_TASK'
+)._make([1, 2])
+TIMER_BATCH_SIZE = 100
+TIMER_POLL_SECONDS = 2.0
+TIMER_RETRY_SECONDS = 60
+TIMER_MAX_ATTEMPTS = 10
+MAIL_FRAGMENT_CACHE_SIZE = 10000
+OUTBOX_KIND = namedtuple(
+    'OUTBOX_KIND',
+    'WORKFLOW_MAIL TASK_MAIL'
+)._make([1, 2])
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_RETRY_SECONDS = 60
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RELAY_SCHEDULE_SECONDS = 60.0
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+HISTORY_PARTITION_SCHEDULE_SECONDS = 24 * 60 * 60.0
+HISTORY_SNAPSHOT_INTERVAL = 200
+WORKFLOW_BATCH_REPORT_SIZE = 100
+IJL_REPORT_MONTHS = 12
+IJL_REPORT_MAX_MONTHS = 120
+REPORT_EXPORT_CHUNK_SIZE = 500
+REPORT_JOB_STATUS = namedtuple(
+    'REPORT_JOB_STATUS',
+    'PENDING RUNNING COMPLETE FAILED'
+)._make([1, 2, 3, 4])
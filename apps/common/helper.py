@@ -2,6 +2,7 @@ import csv
 from datetime import date
 
 from django.conf import settings
+from django.db import connection
 from django.utils import six
 from django.utils.crypto import constant_time_compare, salted_hmac
 from django.utils.http import base36_to_int, int_to_base36
@@ -145,3 +146,35 @@ def parse_invite_csv(file):
 
 def generate_error(error_msg):
     return {'detail': error_msg}
+
+
+def allocate_ids(model, count):
+    '''
+    Reserves primary keys from the id sequence of the model, so that related rows can be wired before a bulk insert.
+
+    Arguments:
+        model {Model} -- model class with an auto id field
+        count {int} -- number of ids to reserve
+
+    Returns:
+        list -- reserved ids, in increasing order
+    '''
+
+    if not count:
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+            [model._meta.db_table, model._meta.pk.column, count]
+        )
+        return sorted(row[0] for row in cursor.fetchall())
+
+
+def add_months(month, count):
+    '''
+    Returns the first day of the month count months after the month of the given date.
+    '''
+
+    month_index = month.year * 12 + month.month - 1 + count
+    return date(month_index // 12, month_index % 12 + 1, 1)
@@ -0,0 +1,187 @@
+import logging
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
+from django.utils.encoding import force_text
+from django.utils.html import conditional_escape
+
+from apps.common import constant as common_constant
+
+logger = logging.getLogger(__name__)
+
+MAIL_TEMPLATES = (
+    'company-create.txt', 'company-create.html',
+    'invite-user.txt', 'invite-user.html',
+    'reset-password.txt', 'reset-password.html',
+    'task.txt', 'task.html',
+    'verify-user.txt', 'verify-user.html',
+    'workflow.txt', 'workflow.html',
+)
+
+# Variables differing for every recipient. They must only be printed in the templates ({{ name }}), never used in
+# tags or filters, as the rest of the message is rendered once and shared between recipients.
+RECIPIENT_VARIABLES = ('name', 'token')
+RECIPIENT_VARIABLE_MARKER = '[[mail-recipient:{variable}]]'
+
+_compiled_templates = {}
+_rendered_fragments = {}
+
+
+def get_mail_template(template_name):
+    '''
+    Returns the compiled template, loading and compiling it only once per process.
+    '''
+
+    template = _compiled_templates.get(template_name)
+    if template is None:
+        template = _compiled_templates[template_name] = get_template(template_name)
+    return template
+
+
+def preload_mail_templates():
+    '''
+    Loads and compiles all mail templates, to be called at worker start.
+    '''
+
+    for template_name in MAIL_TEMPLATES:
+        get_mail_template(template_name)
+    logger.info('{count} mail templates compiled'.format(count=len(MAIL_TEMPLATES)))
+
+
+def _freeze(value):
+    '''
+    Hashable representation of a context value, keeping the type so that e.g. None and 'None' stay distinct.
+    '''
+
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.iteritems()))
+    return (type(value).__name__, force_text(value))
+
+
+def render_mail(template_name, context):
+    '''
+    Renders a mail template. The part of the message shared between recipients is rendered once per distinct context
+    and cached, only the recipient variables are filled in for every message.
+
+    Arguments:
+        template_name {str} -- name of the template
+        context {dict} -- template context
+
+    Returns:
+        str -- rendered message
+    '''
+
+    recipient_variables = [variable for variable in RECIPIENT_VARIABLES if variable in context]
+    shared_context = dict(context)
+    for variable in recipient_variables:
+        shared_context[variable] = RECIPIENT_VARIABLE_MARKER.format(variable=variable)
+
+    key = (template_name, _freeze(shared_context))
+    fragment = _rendered_fragments.get(key)
+    if fragment is None:
+        if len(_rendered_fragments) >= common_constant.MAIL_FRAGMENT_CACHE_SIZE:
+            _rendered_fragments.clear()
+        fragment = _rendered_fragments[key] = get_mail_template(template_name).render(shared_context)
+
+    for variable in recipient_variables:
+        # values are escaped the same way the template engine would have done
+        fragment = fragment.replace(
+            RECIPIENT_VARIABLE_MARKER.format(variable=variable),
+            conditional_escape(force_text(context[variable]))
+        )
+    return fragment
+
+
+def build_message(user, text_template, html_template, subject, context):
+    '''
+    Renders the text and html templates of a mail to the user.
+
+    Arguments:
+        user {User} -- recipient of the mail
+        text_template {str} -- name of the plain text template
+        html_template {str} -- name of the html template
+        subject {str} -- subject of the mail
+        context {dict} -- template context
+
+    Returns:
+        EmailMultiAlternatives -- message ready to be sent
+    '''
+
+    message = EmailMultiAlternatives(
+        subject=subject,
+        body=render_mail(text_template, context),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[user.email]
+    )
+    message.attach_alternative(render_mail(html_template, context), 'text/html')
+    return message
+
+
+def send_messages(messages):
+    '''
+    Delivers the messages over one connection. A failing message does not stop the others, the connection is
+    reopened after a failure.
+
+    Arguments:
+        messages {list} -- EmailMessage instances
+
+    Returns:
+        list -- recipients of the messages which could not be delivered
+    '''
+
+    if not messages:
+        return []
+
+    failed_recipients = []
+    connection = get_connection()
+    connection.open()
+    try:
+        for message in messages:
+            try:
+                connection.send_messages([message])
+            except Exception:
+                logger.exception('Mail delivery to {recipients} failed'.format(recipients=', '.join(message.to)))
+                failed_recipients.extend(message.to)
+                # the connection may be left in a broken state
+                connection.close()
+                connection.open()
+    finally:
+        connection.close()
+
+    logger.info('{sent} of {total} mails delivered'.format(
+        sent=len(messages) - len(failed_recipients),
+        total=len(messages)
+    ))
+    return failed_recipients
+
+
+class MailBatch(object):
+    '''
+    Collects the mails of one send operation to deliver them together over a single connection.
+    '''
+
+    def __init__(self):
+        self.messages = []
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, user, text_template, html_template, subject, context):
+        '''
+        Renders a mail to the user and queues it.
+        '''
+
+        self.messages.append(build_message(user, text_template, html_template, subject, context))
+
+    def send(self):
+        '''
+        Delivers the queued mails.
+
+        Returns:
+            list -- recipients of the mails which could not be delivered
+        '''
+
+        return send_messages(self.messages)
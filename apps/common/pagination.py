@@ -0,0 +1,64 @@
+from rest_framework import pagination
+from rest_framework.response import Response
+
+from apps.common import constant as common_constant
+
+
+class KeysetPagination(pagination.CursorPagination):
+    '''
+    Cursor pagination on a stable ordering, every page is fetched with a range scan from the position in the cursor.
+
+    Besides the next and previous links, the response carries a resume link pointing after the last item of the page,
+    also on the last page, so that a sync client can store it and later fetch only the items added since.
+    '''
+
+    ordering = 'id'
+    page_size = common_constant.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = common_constant.MAX_PAGE_SIZE
+
+    def get_resume_link(self):
+        '''
+        Link to the items following the last one of the page. The cursor is built the way get_next_link builds it, the
+        position being the last one of the page which differs from the position of the last item, and the offset
+        skipping the items from there, so that items added later with the same position are not skipped.
+        '''
+        if not self.page:
+            # nothing after the requested position yet, the client resumes from the same cursor
+            return self.encode_cursor(self.cursor) if self.cursor else None
+
+        compare = self._get_position_from_instance(self.page[-1], self.ordering)
+        offset = 0
+        for item in reversed(self.page):
+            position = self._get_position_from_instance(item, self.ordering)
+            if position != compare:
+                break
+            offset += 1
+        else:
+            # every item of the page shares the last position
+            if self.cursor is None:
+                position = None
+            elif self.cursor.reverse:
+                offset = 0
+                position = self.previous_position
+            else:
+                offset = self.cursor.offset + len(self.page)
+                position = self.cursor.position
+
+        return self.encode_cursor(pagination.Cursor(offset=offset, reverse=False, position=position))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'resume': self.get_resume_link(),
+            'results': data,
+        })
+
+
+class CreatedKeysetPagination(KeysetPagination):
+    '''
+    Keyset pagination in creation order, ties on the creation time are told apart by id.
+    '''
+
+    ordering = ('created', 'id')
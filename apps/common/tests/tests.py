@@ -1,7 +1,28 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from rest_framework.test import APITestCase
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.template.loader import get_template
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.six.moves.urllib.parse import parse_qs, urlparse
+
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from apps.common import constant as common_constant
+from apps.common import mail as common_mail
+from apps.common.mail import MailBatch, render_mail
+from apps.common.pagination import CreatedKeysetPagination
+from apps.company.models import Company, UserCompany
+from apps.workflow.models import Timer, Workflow, Task
+from apps.workflow_template.models import WorkflowTemplate
+
+User = get_user_model()
 
 
 class BaseTest(APITestCase):
@@ -9,3 +30,173 @@ class BaseTest(APITestCase):
         'apps/common/fixtures/workflow_auth.json',
         'apps/common/fixtures/company.json'
         ]
+
+
+def create_company(name='company'):
+    return Company.objects.create(name=name, address='address', status=common_constant.COMPANY_STATUS.ACTIVE)
+
+
+def create_employee(company, email, is_admin=False, **kwargs):
+    '''
+    Creates an active employee of the company, along with its user.
+    '''
+    user = User.objects.create_user(email=email, password='testpass', first_name=email.split('@')[0])
+    kwargs.setdefault('join_at', timezone.now())
+    return UserCompany.objects.create(
+        user=user,
+        company=company,
+        designation='SDE',
+        status=common_constant.USER_STATUS.ACTIVE,
+        is_admin=is_admin,
+        **kwargs
+    )
+
+
+def create_workflow(creator, start_at=None, **kwargs):
+    template, _ = WorkflowTemplate.objects.get_or_create(name='template', defaults={'structure': {}})
+    return Workflow.objects.create(
+        template=template,
+        name=kwargs.pop('name', 'workflow'),
+        creator=creator,
+        start_at=start_at or timezone.now(),
+        **kwargs
+    )
+
+
+def create_task(workflow, assignee, parent_task=None, **kwargs):
+    kwargs.setdefault('start_delta', timedelta(0))
+    kwargs.setdefault('duration', timedelta(hours=1))
+    return Task.objects.create(
+        workflow=workflow,
+        assignee=assignee,
+        parent_task=parent_task,
+        title=kwargs.pop('title', 'task'),
+        **kwargs
+    )
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        self.created = timezone.now()
+        self.timers = [self.create_timer(self.created)]
+        self.timers.extend(self.create_timer(self.created + timedelta(seconds=1)) for _ in range(3))
+
+    def create_timer(self, created):
+        timer = Timer.objects.create(
+            kind=common_constant.TIMER_KIND.START_TASK,
+            object_id=Timer.objects.count() + 1,
+            fire_at=created
+        )
+        Timer.objects.filter(id=timer.id).update(created=created)
+        return timer
+
+    def paginate(self, cursor=None, page_size=2):
+        params = {'page_size': page_size}
+        if cursor:
+            params['cursor'] = cursor
+        paginator = CreatedKeysetPagination()
+        page = paginator.paginate_queryset(Timer.objects.all(), Request(APIRequestFactory().get('/', params)))
+        resume = paginator.get_resume_link()
+        return [timer.id for timer in page], parse_qs(urlparse(resume).query)['cursor'][0] if resume else None
+
+    def test_resume_inside_tied_created(self):
+        ids, resume = self.paginate(page_size=3)
+        self.assertEqual(ids, [timer.id for timer in self.timers[:3]])
+
+        later = self.create_timer(self.created + timedelta(seconds=1))
+        ids, resume = self.paginate(resume, page_size=3)
+        self.assertEqual(ids, [self.timers[3].id, later.id])
+
+        ids, _ = self.paginate(resume)
+        self.assertEqual(ids, [])
+
+    def test_resume_on_page_of_tied_created(self):
+        _, resume = self.paginate()
+        ids, resume = self.paginate(resume)
+        self.assertEqual(ids, [timer.id for timer in self.timers[2:4]])
+
+        later = self.create_timer(self.created + timedelta(seconds=1))
+        ids, resume = self.paginate(resume)
+        self.assertEqual(ids, [later.id])
+
+    def test_resume_empty_page(self):
+        _, resume = self.paginate(page_size=10)
+        ids, same = self.paginate(resume)
+        self.assertEqual((ids, same), ([], resume))
+
+
+class FailingEmailBackend(EmailBackend):
+    '''
+    Locmem backend refusing the mails to fail@t.com, and counting the connections opened.
+    '''
+    opened = 0
+
+    def open(self):
+        FailingEmailBackend.opened += 1
+        return True
+
+    def send_messages(self, messages):
+        if any('fail@t.com' in message.to for message in messages):
+            raise IOError('recipient refused')
+        return super(FailingEmailBackend, self).send_messages(messages)
+
+
+@override_settings(EMAIL_BACKEND='apps.common.tests.tests.FailingEmailBackend')
+class MailBatchTest(TestCase):
+
+    def setUp(self):
+        FailingEmailBackend.opened = 0
+
+    def add_mail(self, batch, email):
+        user = User(email=email, first_name=email.split('@')[0])
+        batch.add(user, 'verify-user.txt', 'verify-user.html', 'Verify', {'name': user.first_name, 'token': 'token'})
+
+    def test_mails_are_sent_over_one_connection(self):
+        batch = MailBatch()
+        for email in ('first@t.com', 'second@t.com', 'third@t.com'):
+            self.add_mail(batch, email)
+
+        self.assertEqual(batch.send(), [])
+
+        self.assertEqual([message.to for message in mail.outbox], [['first@t.com'], ['second@t.com'], ['third@t.com']])
+        self.assertEqual(FailingEmailBackend.opened, 1)
+
+    def test_failed_mail_does_not_stop_the_others(self):
+        batch = MailBatch()
+        for email in ('first@t.com', 'fail@t.com', 'third@t.com'):
+            self.add_mail(batch, email)
+
+        self.assertEqual(batch.send(), ['fail@t.com'])
+
+        self.assertEqual([message.to for message in mail.outbox], [['first@t.com'], ['third@t.com']])
+
+    def test_empty_batch_opens_no_connection(self):
+        self.assertEqual(MailBatch().send(), [])
+        self.assertEqual(FailingEmailBackend.opened, 0)
+
+
+class RenderMailTest(TestCase):
+
+    def setUp(self):
+        common_mail._rendered_fragments.clear()
+        self.context = {'task_new': True, 'task_title': 'review', 'workflow_name': 'release'}
+
+    def test_rendered_as_the_template(self):
+        for name in ('first', '<b>second</b>'):
+            context = dict(self.context, name=name)
+            self.assertEqual(render_mail('task.html', context), get_template('task.html').render(context))
+
+    def test_shared_part_is_rendered_once_for_all_recipients(self):
+        messages = [render_mail('task.txt', dict(self.context, name=name)) for name in ('first', 'second')]
+
+        self.assertEqual(len(common_mail._rendered_fragments), 1)
+        self.assertIn('Hi first', messages[0])
+        self.assertIn('Hi second', messages[1])
+
+    def test_different_contexts_are_rendered_apart(self):
+        render_mail('task.txt', dict(self.context, name='first'))
+        updated = render_mail('task.txt', dict(self.context, name='first', task_new=False))
+
+        self.assertEqual(len(common_mail._rendered_fragments), 2)
+        self.assertIn('task of the release workflow has been updated', updated)
@@ -13,6 +13,7 @@ from partial_index import PartialIndex, PQ
 from apps.common.models import BaseModel
 from apps.common import constant as common_constant
 from apps.common.helper import invite_token_generator
+from apps.common.mail import MailBatch
 
 User = get_user_model()
 
@@ -78,17 +79,20 @@ class Company(BaseModel):
                         common_constant.USER_STATUS.INVITED]
         )
 
-        for admin in admins:
+        mail_batch = MailBatch()
+        for admin in admins.select_related('user'):
             context = {
                 'name': admin.user.name,
                 'company': self.name
             }
-            admin.user.email_user(
+            mail_batch.add(
+                admin.user,
                 'company-create.txt',
                 'company-create.html',
                 'Company Registration', context
             )
-            logger.info('creation mail send to %s ' % (admin.user.email))
+        failed_recipients = mail_batch.send()
+        logger.info('creation mail send to %s admins, failed for %s' % (len(mail_batch), failed_recipients))
 
 
 class Link(BaseModel):
@@ -152,6 +156,9 @@ class UserCompany(BaseModel):
     )
     is_admin = models.BooleanField(default=False)
 
+    # relations followed by _history_representation, loaded along when resolving history values
+    history_select_related = ('user', 'company')
+
     class Meta:
         indexes = [
             PartialIndex(
@@ -182,21 +189,30 @@ class UserCompany(BaseModel):
         token = invite_token_generator.make_token(self.user, self)
         return '%s--%s--%s' % (token, self.user.id, self.id)
 
-    def send_invite(self):
+    def add_invite_mail(self, mail_batch):
         '''
-        send invitation mail.
+        queue invitation mail into the mail batch.
         '''
         context = {
             'name': self.user.name,
             'token': self.get_invite_token(),
             'company': self.company
         }
-        self.user.email_user(
+        mail_batch.add(
+            self.user,
             'invite-user.txt',
             'invite-user.html',
             'Invitation to join',
             context
         )
+
+    def send_invite(self):
+        '''
+        send invitation mail.
+        '''
+        mail_batch = MailBatch()
+        self.add_invite_mail(mail_batch)
+        mail_batch.send()
         logger.info('Invite mail send to {email}'.format(
             email=self.user.email))
 
@@ -298,7 +298,12 @@ class InviteEmployeeSerializer(UserCompanySerializer):
             defaults=validated_data
         )
 
-        instance.send_invite()
+        # invites of a bulk operation are delivered together by the caller
+        mail_batch = self.context.get('mail_batch')
+        if mail_batch is None:
+            instance.send_invite()
+        else:
+            instance.add_invite_mail(mail_batch)
         return instance
 
 
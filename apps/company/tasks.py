@@ -4,6 +4,7 @@ import logging
 from apps.common import constant as common_constant
 from apps.company.serializers import InviteEmployeeCsvSerializer
 from apps.common.helper import parse_invite_csv
+from apps.common.mail import MailBatch
 from apps.company.models import UserCompany, UserCompanyCsv
 
 logger = logging.getLogger(__name__)
@@ -29,10 +30,12 @@ def invite_via_csv(csv_object_id):
             file_name=csv_instance.csv_file.name))
         return
 
+    mail_batch = MailBatch()
     serializer = InviteEmployeeCsvSerializer(
         data=data,
         context={
-            'user': csv_instance.user_company.user
+            'user': csv_instance.user_company.user,
+            'mail_batch': mail_batch
         },
         many=True)
     is_valid = serializer.is_valid(raise_exception=False)
@@ -46,6 +49,9 @@ def invite_via_csv(csv_object_id):
         return
 
     serializer.save()
+    failed_recipients = mail_batch.send()
+    logger.info('Invite mail send to {count} people, failed for {failed}'.format(
+        count=len(mail_batch), failed=failed_recipients))
 
     # update the status of the csv file to processed
     csv_instance.status = common_constant.CSV_STATUS.PROCESSED
@@ -24,6 +24,7 @@ from apps.company.permissions import (
 )
 
 from apps.common.helper import filter_invite_token
+from apps.common.pagination import KeysetPagination
 from apps.company.tasks import invite_via_csv
 
 
@@ -136,6 +137,7 @@ class EmployeesView(ListModelMixin, GenericViewSet):
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('status', 'is_admin')
     queryset = UserCompany.objects.all()
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         employee = self.request.user.active_employee
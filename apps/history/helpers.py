@@ -1,6 +1,14 @@
+from contextlib import contextmanager
+import functools
 import logging
 
+from django.db import connection
+from django.db.transaction import atomic, on_commit
+
 from apps.history.models import History
+from apps.history.snapshots import count_changes
+from apps.history.tasks import take_history_snapshot
+from apps.workflow.models import Workflow
 from apps.common import constant as common_constants
 
 # This should be fired before saving data into the modal.
@@ -8,109 +16,257 @@ from apps.common import constant as common_constants
 logger = logging.getLogger(__name__)
 
 
-def get_value(instance, field):
-    if instance._meta.get_field(field).get_internal_type() == 'ForeignKey':
-        next_value = str(
-            getattr(
-                instance,
-                '{field_name}_id'.format(field_name=field)
-            )
-        )
+class HistoryBuffer(object):
+    '''
+    Collects the histories saved in a history_buffer block, to write them with a single INSERT at its end.
+    '''
+
+    def __init__(self):
+        self.histories = []
+
+    def add(self, histories):
+        self.histories.extend(histories)
+
+    def coalesce(self):
+        '''
+        Merges the histories of rows saved several times in the block, keeping the first previous value and the last
+        next value of every field, and drops changes which leave a field unchanged.
+        '''
+
+        histories = []
+        latest = {}
+        for history in self.histories:
+            key = (history.content_type_id, history.object_id)
+            previous = latest.get(key)
+            if (
+                previous is not None and
+                history.action == common_constants.HISTORY_ACTION.UPDATE and
+                previous.action != common_constants.HISTORY_ACTION.DELETE
+            ):
+                for field_name, (prev_value, next_value) in history.changes.iteritems():
+                    previous.changes.setdefault(field_name, [prev_value, next_value])[1] = next_value
+                continue
+            latest[key] = history
+            histories.append(history)
+
+        for history in histories:
+            if history.action == common_constants.HISTORY_ACTION.UPDATE:
+                history.changes = {
+                    field_name: values for field_name, values in history.changes.iteritems() if values[0] != values[1]
+                }
+        return [
+            history for history in histories
+            if history.action != common_constants.HISTORY_ACTION.UPDATE or history.changes
+        ]
+
+    def flush(self):
+        histories = self.coalesce()
+        self.histories = []
+        if histories:
+            logger.debug('Flushing %d history entries' % len(histories))
+            write_histories(histories)
+
+
+@contextmanager
+def history_buffer():
+    '''
+    Runs the block in a transaction, collecting the histories saved in it and writing them with a single INSERT at the
+    end of the block, before the transaction commits, so that they are committed or rolled back along with the
+    changes they record. Nested blocks run in a savepoint and collect their histories apart, handing them to the
+    enclosing block when they succeed and dropping them when they roll back.
+    '''
+
+    parent_buffer = getattr(connection, 'history_buffer', None)
+    with atomic():
+        buffer = connection.history_buffer = HistoryBuffer()
+        try:
+            yield
+        finally:
+            connection.history_buffer = parent_buffer
+        if parent_buffer is None:
+            buffer.flush()
+        else:
+            parent_buffer.add(buffer.histories)
+
+
+def buffer_histories(func):
+    '''
+    Decorator running the function in a history_buffer block, in place of atomic.
+    '''
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with history_buffer():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def request_snapshot(workflow_id):
+    try:
+        take_history_snapshot.delay(workflow_id)
+    except Exception:
+        # the counter asks again once the next interval of changes is crossed
+        logger.exception('Snapshot of workflow %s could not be requested' % workflow_id)
+
+
+def write_histories(histories):
+    '''
+    Inserts the histories and requests a snapshot of the workflows which changed enough since their last one, once
+    the transaction commits. The change counters of the workflows are updated first, their row locks queuing the
+    writers of a workflow until commit, so that its histories are committed in id order, which snapshots rely on.
+    '''
+
+    with atomic():
+        snapshot_workflow_ids = count_changes(histories)
+        History.objects.bulk_create(histories)
+    for workflow_id in snapshot_workflow_ids:
+        on_commit(functools.partial(request_snapshot, workflow_id))
+
+
+def save_histories(histories):
+    '''
+    Writes the histories at the end of the ongoing history_buffer block, or at once in the ongoing transaction.
+    '''
+
+    if not histories:
+        return
+    buffer = getattr(connection, 'history_buffer', None)
+    if buffer is None:
+        write_histories(histories)
     else:
-        next_value = str(getattr(instance, field))
-    return next_value
+        buffer.add(histories)
+
+
+def get_value(instance, field):
+    '''
+    Returns the value of the field in its native type, the id for a foreign key.
+    '''
+    return instance._meta.get_field(field).value_from_object(instance)
 
 
-def get_history(content_object, field_name, prev_value, next_value, action):
+def get_history_scopes(instances):
+    '''
+    Returns the (workflow id, company id) the histories of every instance belong to, Nones for models without scope.
+    The companies are read with one query for all the instances.
+    '''
+
+    workflows_ids = [
+        instance._history_workflow_id() if hasattr(instance, '_history_workflow_id') else None
+        for instance in instances
+    ]
+    scoped_workflows_ids = set(workflow_id for workflow_id in workflows_ids if workflow_id is not None)
+    companies_ids = dict(
+        Workflow.objects.filter(id__in=scoped_workflows_ids).values_list('id', 'creator__company_id')
+    ) if scoped_workflows_ids else {}
+    return [(workflow_id, companies_ids.get(workflow_id)) for workflow_id in workflows_ids]
+
+
+def get_history_scope(instance):
+    '''
+    Returns the (workflow id, company id) the histories of the instance belong to, Nones if the model has no scope.
+    '''
+
+    return get_history_scopes([instance])[0]
+
+
+def get_history(content_object, changes, action, scope):
+    '''
+    Returns the history of one save of the object.
+
+    Arguments:
+        content_object {Model} -- saved object
+        changes {dict} -- [previous value, next value] of every changed field, by field name
+        action {int} -- one of common_constants.HISTORY_ACTION
+        scope {tuple} -- (workflow id, company id) the history belongs to
+    '''
+    workflow_id, company_id = scope
     return History(
         content_object=content_object,
-        field_name=field_name,
-        prev_value=prev_value,
-        next_value=next_value,
-        action=action
+        changes=changes,
+        action=action,
+        workflow_id=workflow_id,
+        company_id=company_id
+    )
+
+
+def get_history_fields(instance):
+    '''
+    Returns the fields recorded in the create and delete histories of the instance, all but its
+    history_excluded_fields.
+    '''
+    excluded_fields = getattr(instance, 'history_excluded_fields', ())
+    return [field for field in instance._meta.fields if field.name not in excluded_fields]
+
+
+def get_create_history(instance, scope):
+    return get_history(
+        instance,
+        {field.name: [None, get_value(instance, field.name)] for field in get_history_fields(instance)},
+        common_constants.HISTORY_ACTION.CREATE,
+        scope
+    )
+
+
+def get_update_changes(instance):
+    return {key: [value, get_value(instance, key)] for key, value in instance.tracker.changed().iteritems()}
+
+
+def get_delete_history(instance, scope):
+    return get_history(
+        instance,
+        {field.name: [get_value(instance, field.name), None] for field in get_history_fields(instance)},
+        common_constants.HISTORY_ACTION.DELETE,
+        scope
     )
 
 
 def create_history(instance):
-    histories = [
-        get_history(
-            instance,
-            field.name,
-            str(None),
-            get_value(instance, field.name),
-            common_constants.HISTORY_ACTION.CREATE
-        ) for field in instance._meta.fields
-    ]
     logger.debug('Create History entry of %s ' % instance)
-    History.objects.bulk_create(histories)
+    save_histories([get_create_history(instance, get_history_scope(instance))])
 
 
 def update_history(instance):
-    changes = instance.tracker.changed()
-    histories = [
-        get_history(
-            instance,
-            key,
-            str(value),
-            get_value(instance, key),
-            common_constants.HISTORY_ACTION.UPDATE
-        ) for key, value in changes.iteritems()
-    ]
+    changes = get_update_changes(instance)
     logger.debug('Update History entry of %s' % (instance))
-    History.objects.bulk_create(histories)
+    if changes:
+        save_histories([
+            get_history(instance, changes, common_constants.HISTORY_ACTION.UPDATE, get_history_scope(instance))
+        ])
 
 
 def delete_history(instance):
-    histories = [
-        get_history(
-            instance,
-            field.name,
-            get_value(instance, field.name),
-            str(None),
-            common_constants.HISTORY_ACTION.DELETE
-        ) for field in instance._meta.fields
-    ]
-    logger.debug('Delete History entry of %s' % (instance, field.name))
+    save_histories([get_delete_history(instance, get_history_scope(instance))])
+    logger.debug('Delete History entry of %s' % instance)
 
 
 def create_bulk_history(instances):
     histories = [
-        get_history(
-            instance,
-            field.name,
-            str(None),
-            get_value(instance, field.name),
-            common_constants.HISTORY_ACTION.CREATE
-        )
-        for instance in instances for field in instance._meta.fields
+        get_create_history(instance, scope) for instance, scope in zip(instances, get_history_scopes(instances))
     ]
     logger.debug('Create Bulk History entry')
-    History.objects.bulk_create(histories)
+    save_histories(histories)
 
 
 def update_bulk_history(instances):
+    changed_instances = []
+    for instance in instances:
+        changes = get_update_changes(instance)
+        if changes:
+            changed_instances.append((instance, changes))
     histories = [
-        get_history(
-            instance,
-            key,
-            str(value),
-            get_value(instance, key),
-            common_constants.HISTORY_ACTION.UPDATE
-        ) for instance in instances for key, value in instance.tracker.changed().iteritems()
+        get_history(changed_instance, instance_changes, common_constants.HISTORY_ACTION.UPDATE, scope)
+        for (changed_instance, instance_changes), scope in zip(
+            changed_instances,
+            get_history_scopes([changed_instance for changed_instance, _ in changed_instances])
+        )
     ]
     logger.debug('Update Bulk History entry')
-    History.objects.bulk_create(histories)
+    save_histories(histories)
 
 
 def delete_bulk_history(instances):
     histories = [
-        get_history(
-            instance,
-            field.name,
-            get_value(instance, field.name),
-            str(None),
-            common_constants.HISTORY_ACTION.DELETE
-        ) for instance in instances for field in instance._meta.fields
+        get_delete_history(instance, scope) for instance, scope in zip(instances, get_history_scopes(instances))
     ]
     logger.debug('Delete Bulk History entry')
-    History.objects.bulk_create(histories)
+    save_histories(histories)
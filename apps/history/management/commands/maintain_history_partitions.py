@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.history.partitions import maintain_partitions
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    '''
+    Create upcoming history partitions and archive the expired ones.
+    '''
+    help = 'Creates the monthly history partitions ahead of time and archives partitions older than the retention.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months-ahead',
+            type=int,
+            default=settings.HISTORY_PARTITION_MONTHS_AHEAD,
+            help='number of future months to create partitions for'
+        )
+        parser.add_argument(
+            '--retention-months',
+            type=int,
+            default=settings.HISTORY_RETENTION_MONTHS,
+            help='number of past months kept in the database'
+        )
+        parser.add_argument(
+            '--archive-dir',
+            default=settings.HISTORY_ARCHIVE_DIR,
+            help='directory of the archive storage receiving the archived partitions'
+        )
+
+    def handle(self, *args, **options):
+        created_months, archived_files = maintain_partitions(
+            months_ahead=options['months_ahead'],
+            retention_months=options['retention_months'],
+            archive_dir=options['archive_dir']
+        )
+        for month in created_months:
+            self.stdout.write('Partition of %s created' % month.strftime('%Y-%m'))
+        for path in archived_files:
+            self.stdout.write('Partition archived to %s' % path)
+        logger.info('%d history partitions created, %d archived' % (len(created_months), len(archived_files)))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# histories of workflows, tasks and workflow accesses, tagged with the workflow and the company of its creator
+BACKFILL_SQL = '''
+UPDATE history_history AS history
+SET workflow_id = workflow.id, company_id = creator.company_id
+FROM django_content_type AS content_type, {table} AS object
+    INNER JOIN workflow_workflow AS workflow ON workflow.id = object.{workflow_column}
+    INNER JOIN company_usercompany AS creator ON creator.id = workflow.creator_id
+WHERE history.content_type_id = content_type.id
+    AND content_type.app_label = 'workflow'
+    AND content_type.model = %s
+    AND history.object_id = object.id
+'''
+
+SCOPED_MODELS = (
+    ('workflow', 'workflow_workflow', 'id'),
+    ('task', 'workflow_task', 'workflow_id'),
+    ('workflowaccess', 'workflow_workflowaccess', 'workflow_id'),
+)
+
+
+def backfill_history_scope(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for model_name, table, workflow_column in SCOPED_MODELS:
+            cursor.execute(BACKFILL_SQL.format(table=table, workflow_column=workflow_column), [model_name])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('history', '0003_remove_history_modified'),
+        ('workflow', '0016_outboxevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='history',
+            name='company_id',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='history',
+            name='workflow_id',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['workflow_id', 'created'], name='history_his_workflo_3ed9f3_idx'),
+        ),
+        migrations.RunPython(backfill_history_scope, migrations.RunPython.noop),
+    ]
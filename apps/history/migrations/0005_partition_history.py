@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.db import migrations
+from django.utils import timezone
+
+# history_history is recreated as a table range partitioned on created, its rows are copied over into monthly
+# partitions. Rows falling outside of the created partitions land in the default partition.
+RENAME_SQL = '''
+ALTER TABLE history_history RENAME TO history_history_unpartitioned;
+ALTER INDEX history_his_workflo_3ed9f3_idx RENAME TO history_history_unpartitioned_workflow_created_idx;
+CREATE TABLE history_history (LIKE history_history_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (created);
+CREATE TABLE history_history_default PARTITION OF history_history DEFAULT;
+ALTER SEQUENCE history_history_id_seq OWNED BY history_history.id;
+'''
+
+CREATE_PARTITION_SQL = '''
+CREATE TABLE history_history_y{year:04d}m{month:02d} PARTITION OF history_history FOR VALUES FROM (%s) TO (%s)
+'''
+
+OLDEST_MONTH_SQL = '''
+SELECT MIN(created) FROM history_history_unpartitioned
+'''
+
+COPY_SQL = '''
+INSERT INTO history_history SELECT * FROM history_history_unpartitioned;
+DROP TABLE history_history_unpartitioned;
+ALTER TABLE history_history ADD PRIMARY KEY (id, created);
+ALTER TABLE history_history ADD CONSTRAINT history_history_content_type_id_fk_django_content_type_id
+    FOREIGN KEY (content_type_id) REFERENCES django_content_type (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX history_history_content_type_id_idx ON history_history (content_type_id, object_id);
+CREATE INDEX history_his_workflo_3ed9f3_idx ON history_history (workflow_id, created);
+'''
+
+
+# back to a plain table holding the rows of all the partitions, the histories archived meanwhile are not restored
+UNPARTITION_SQL = '''
+ALTER TABLE history_history RENAME TO history_history_partitioned;
+CREATE TABLE history_history (LIKE history_history_partitioned INCLUDING DEFAULTS);
+ALTER SEQUENCE history_history_id_seq OWNED BY history_history.id;
+INSERT INTO history_history SELECT * FROM history_history_partitioned;
+DROP TABLE history_history_partitioned;
+ALTER TABLE history_history ADD PRIMARY KEY (id);
+ALTER TABLE history_history ADD CONSTRAINT history_history_content_type_id_fk_django_content_type_id
+    FOREIGN KEY (content_type_id) REFERENCES django_content_type (id) DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX history_history_content_type_id_idx ON history_history (content_type_id, object_id);
+CREATE INDEX history_his_workflo_3ed9f3_idx ON history_history (workflow_id, created);
+'''
+
+
+def add_months(month, count):
+    month_index = month.year * 12 + month.month - 1 + count
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_history(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(RENAME_SQL)
+
+        cursor.execute(OLDEST_MONTH_SQL)
+        oldest_created, = cursor.fetchone()
+        current_month = add_months(timezone.now().date(), 0)
+        month = add_months(oldest_created.date(), 0) if oldest_created else current_month
+        while month <= add_months(current_month, 1):
+            cursor.execute(
+                CREATE_PARTITION_SQL.format(year=month.year, month=month.month),
+                [month, add_months(month, 1)]
+            )
+            month = add_months(month, 1)
+
+        cursor.execute(COPY_SQL)
+
+
+def unpartition_history(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(UNPARTITION_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0004_history_scope'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_history, unpartition_history),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import apps.history.models
+import django.contrib.postgres.fields.citext
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0005_partition_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='history',
+            name='changes',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict, encoder=apps.history.models.HistoryJSONEncoder, help_text='[previous value, next value] of the changed fields, by field name'),
+        ),
+        migrations.AlterField(
+            model_name='history',
+            name='field_name',
+            field=django.contrib.postgres.fields.citext.CICharField(blank=True, default='', max_length=254),
+        ),
+        migrations.AlterField(
+            model_name='history',
+            name='next_value',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AlterField(
+            model_name='history',
+            name='prev_value',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
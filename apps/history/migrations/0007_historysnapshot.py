@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('history', '0006_history_changes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistorySnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('workflow_id', models.PositiveIntegerField()),
+                ('taken_at', models.DateTimeField(help_text='creation time of the last history applied')),
+                ('last_history_id', models.PositiveIntegerField(help_text='last history applied')),
+                ('state', django.contrib.postgres.fields.jsonb.JSONField(help_text='field values of the objects by model name and object id')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HistorySnapshotCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('workflow_id', models.PositiveIntegerField(unique=True)),
+                ('changes', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='historysnapshot',
+            index=models.Index(fields=['workflow_id', 'taken_at'], name='history_his_workflo_a652f5_idx'),
+        ),
+    ]
@@ -1,22 +1,51 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from collections import defaultdict
+import datetime
+
 from django.db import models
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.postgres.fields import CICharField
+from django.contrib.postgres.fields import CICharField, JSONField
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import force_text
 
 from apps.common.models import BaseModel
 from apps.common import constant as common_constant
 
 
+class HistoryJSONEncoder(DjangoJSONEncoder):
+    '''
+    Encodes datetimes and times with their full isoformat, DjangoJSONEncoder cutting them to milliseconds.
+    '''
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(HistoryJSONEncoder, self).default(o)
+
+
 class History(models.Model):
+    '''
+    History of one save of an object, holding the [previous value, next value] of every changed field in changes.
+
+    Histories written before change sets hold a single field in field_name, prev_value and next_value, and an empty
+    changes. expand_changes turns both into one history per field, holding str() of the values as those rows do.
+    '''
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey()
-    field_name = CICharField(max_length=254)
-    prev_value = models.TextField()
-    next_value = models.TextField()
+    field_name = CICharField(max_length=254, blank=True, default='')
+    prev_value = models.TextField(blank=True, default='')
+    next_value = models.TextField(blank=True, default='')
+    changes = JSONField(
+        default=dict,
+        blank=True,
+        encoder=HistoryJSONEncoder,
+        help_text='[previous value, next value] of the changed fields, by field name'
+    )
     action = models.PositiveIntegerField(
         choices=(choice for choice in zip(
             common_constant.HISTORY_ACTION,
@@ -25,23 +54,120 @@ class History(models.Model):
         help_text='history action'
     )
     created = models.DateTimeField(auto_now_add=True)
+    # owners of the content object, denormalized so that their histories are read without joining the objects
+    workflow_id = models.PositiveIntegerField(null=True, blank=True)
+    company_id = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['workflow_id', 'created']),
+        ]
 
     def __unicode__(self):
         return '{content_type}-#-{field_name}'.format(content_type=self.content_type, field_name=self.field_name)
 
+    @classmethod
+    def expand_changes(cls, histories):
+        '''
+        Expands change sets into one unsaved history per changed field, in the order of the model fields, the shape
+        histories are listed with. The values are turned into the text histories holding a single field store, and
+        those histories are kept as they are.
+
+        Arguments:
+            histories {list} -- History instances
+
+        Returns:
+            list -- History instances with one field each
+        '''
+
+        expanded = []
+        for history in histories:
+            if not history.changes:
+                expanded.append(history)
+                continue
+
+            model_class = history._get_model_class()
+            field_order = {field.name: index for index, field in enumerate(model_class._meta.fields)}
+            for field_name in sorted(history.changes, key=lambda name: (field_order.get(name, len(field_order)), name)):
+                field = model_class._meta.get_field(field_name)
+                prev_value, next_value = history.changes[field_name]
+                expanded.append(cls(
+                    id=history.id,
+                    content_type_id=history.content_type_id,
+                    object_id=history.object_id,
+                    field_name=field_name,
+                    prev_value=cls._get_text_value(field, prev_value),
+                    next_value=cls._get_text_value(field, next_value),
+                    action=history.action,
+                    created=history.created,
+                    workflow_id=history.workflow_id,
+                    company_id=history.company_id
+                ))
+        return expanded
+
+    @classmethod
+    def prefetch_display_values(cls, histories):
+        '''
+        Loads the objects referenced by the histories, their content objects and related field values, with one query
+        per model. The display methods of the histories then resolve their values from these objects.
+
+        Arguments:
+            histories {list} -- History instances
+        '''
+
+        requested_pks = defaultdict(set)
+        for history in histories:
+            requested_pks[history._get_model_class()].add(history.object_id)
+            field = history._get_field()
+            if field.get_internal_type() != 'ForeignKey':
+                continue
+            for value in (history.prev_value, history.next_value):
+                if value != 'None' and value is not None:
+                    requested_pks[cls._get_related_model_class(field)].add(field.target_field.to_python(value))
+
+        related_instances = {
+            model_class: model_class._base_manager.select_related(
+                *getattr(model_class, 'history_select_related', ())
+            ).in_bulk(list(pks))
+            for model_class, pks in requested_pks.iteritems()
+        }
+        for history in histories:
+            history._related_instances = related_instances
+
+    @staticmethod
+    def _get_text_value(field, value):
+        '''
+        Returns str() of a change set value. Change sets hold the values as encoded by HistoryJSONEncoder, durations
+        and datetimes as ISO 8601 strings, so they are decoded with their field first.
+        '''
+        try:
+            value = field.to_python(value)
+        except ValidationError:
+            pass
+        return force_text(value)
+
+    def _get_model_class(self):
+        # content types are cached by the manager, unlike the content_type relation
+        return ContentType.objects.get_for_id(self.content_type_id).model_class()
+
     def _get_field(self):
-        return self.content_type.model_class()._meta.get_field(self.field_name)
+        return self._get_model_class()._meta.get_field(self.field_name)
 
-    def _get_related_model_class(self, field):
+    @staticmethod
+    def _get_related_model_class(field):
         return field.rel.to
 
     def _related_field_representation(self, field, value):
         model_class = self._get_related_model_class(field)
-        # try:
-        related_instance = model_class.objects.get(pk=value)
+        related_instances = getattr(self, '_related_instances', None)
+        if related_instances is None:
+            related_instance = model_class.objects.get(pk=value)
+            return related_instance._history_representation()
+
+        related_instance = related_instances[model_class].get(field.target_field.to_python(value))
+        if related_instance is None:
+            return value
         return related_instance._history_representation()
-        # except model_class.DoesNotExist:
-        #     return value
 
     def _choice_field_representation(self, field, value):
         value = int(value)
@@ -51,16 +177,13 @@ class History(models.Model):
 
     def _get_display_value(self, value):
         if value == 'None' or value is None:
-            return value
+            return 'None'
         field = self._get_field()
         if field.get_internal_type() == 'ForeignKey':
             return self._related_field_representation(field, value)
         elif len(field.choices) > 0:
             return self._choice_field_representation(field, value)
-        else:
-            print 'unknown type'
-            print field.get_internal_type()
-            return value
+        return value
 
     def get_prev_value_display(self):
         return self._get_display_value(self.prev_value)
@@ -69,6 +192,41 @@ class History(models.Model):
         return self._get_display_value(self.next_value)
 
     def get_content_object_display(self):
-        if self.content_object is not None:
-            return self.content_object._history_representation()
+        related_instances = getattr(self, '_related_instances', None)
+        if related_instances is None:
+            content_object = self.content_object
+        else:
+            content_object = related_instances[self._get_model_class()].get(self.object_id)
+        if content_object is not None:
+            return content_object._history_representation()
         return 'None'
+
+
+class HistorySnapshot(BaseModel):
+    '''
+    State of a workflow, its tasks and accessors, rebuilt from its histories up to the last_history_id history.
+    Past states are rebuilt from the nearest snapshot instead of the first history of the workflow.
+    '''
+    workflow_id = models.PositiveIntegerField()
+    taken_at = models.DateTimeField(help_text='creation time of the last history applied')
+    last_history_id = models.PositiveIntegerField(help_text='last history applied')
+    state = JSONField(help_text='field values of the objects by model name and object id')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['workflow_id', 'taken_at']),
+        ]
+
+    def __unicode__(self):
+        return '{workflow_id}-#-{taken_at}'.format(workflow_id=self.workflow_id, taken_at=self.taken_at)
+
+
+class HistorySnapshotCounter(models.Model):
+    '''
+    Number of histories written for a workflow since its last snapshot.
+    '''
+    workflow_id = models.PositiveIntegerField(unique=True)
+    changes = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return '{workflow_id}-#-{changes}'.format(workflow_id=self.workflow_id, changes=self.changes)
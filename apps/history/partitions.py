@@ -0,0 +1,256 @@
+import csv
+import gzip
+import json
+import logging
+import os
+import re
+import tempfile
+from datetime import date
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import get_storage_class
+from django.db import connection, transaction
+from django.utils import timezone
+
+from apps.common.helper import add_months
+from apps.history.models import History
+
+logger = logging.getLogger(__name__)
+
+# history_history is range partitioned on created, one partition per month
+PARTITION_NAME = '{table}_y{year:04d}m{month:02d}'
+PARTITION_NAME_RE = re.compile(r'^{table}_y(?P<year>\d{{4}})m(?P<month>\d{{2}})$'.format(table=History._meta.db_table))
+ARCHIVE_SUFFIX = '.csv.gz'
+
+DEFAULT_PARTITION_NAME = '{table}_default'
+
+CREATE_PARTITION_SQL = '''
+CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table}
+FOR VALUES FROM (%s) TO (%s)
+'''
+
+DEFAULT_PARTITION_HAS_ROWS_SQL = '''
+SELECT EXISTS (SELECT 1 FROM {default} WHERE created >= %s AND created < %s)
+'''
+
+# postgres refuses to create a partition while the default partition holds rows of its range, so the default
+# partition is detached while they are moved over to the new partition
+MOVE_DEFAULT_ROWS_SQL = '''
+ALTER TABLE {table} DETACH PARTITION {default};
+CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} FOR VALUES FROM (%(start)s) TO (%(end)s);
+INSERT INTO {partition} SELECT * FROM {default} WHERE created >= %(start)s AND created < %(end)s;
+DELETE FROM {default} WHERE created >= %(start)s AND created < %(end)s;
+ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT;
+'''
+
+LIST_PARTITIONS_SQL = '''
+SELECT child.relname
+FROM pg_inherits
+    INNER JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+    INNER JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+WHERE parent.relname = %s
+'''
+
+# partitions left detached by an interrupted archival
+LIST_DETACHED_PARTITIONS_SQL = '''
+SELECT relname FROM pg_class WHERE relname LIKE %s AND relkind = 'r' AND NOT relispartition
+'''
+
+
+def get_partition_name(month):
+    return PARTITION_NAME.format(table=History._meta.db_table, year=month.year, month=month.month)
+
+
+def create_partition(cursor, month):
+    '''
+    Creates the partition holding the histories of the month, if it does not exist yet. Histories of the month which
+    landed in the default partition are moved to it.
+    '''
+
+    month = add_months(month, 0)
+    table = History._meta.db_table
+    names = {
+        'partition': get_partition_name(month),
+        'table': table,
+        'default': DEFAULT_PARTITION_NAME.format(table=table),
+    }
+    with transaction.atomic():
+        cursor.execute(DEFAULT_PARTITION_HAS_ROWS_SQL.format(**names), [month, add_months(month, 1)])
+        has_default_rows, = cursor.fetchone()
+        if has_default_rows:
+            cursor.execute(MOVE_DEFAULT_ROWS_SQL.format(**names), {'start': month, 'end': add_months(month, 1)})
+            logger.info('History rows of %s moved from the default partition' % names['partition'])
+        else:
+            cursor.execute(CREATE_PARTITION_SQL.format(**names), [month, add_months(month, 1)])
+
+
+def _get_months(partitions):
+    months = []
+    for partition in partitions:
+        match = PARTITION_NAME_RE.match(partition)
+        if match:
+            months.append(date(int(match.group('year')), int(match.group('month')), 1))
+    return sorted(months)
+
+
+def get_partition_months(cursor):
+    '''
+    Returns the months of the attached partitions, oldest first. The default partition is left out.
+    '''
+
+    cursor.execute(LIST_PARTITIONS_SQL, [History._meta.db_table])
+    return _get_months(partition for partition, in cursor.fetchall())
+
+
+def get_detached_partition_months(cursor):
+    '''
+    Returns the months of the partitions which were detached but not archived yet, oldest first.
+    '''
+
+    cursor.execute(LIST_DETACHED_PARTITIONS_SQL, [History._meta.db_table + '\\_y%'])
+    return _get_months(partition for partition, in cursor.fetchall())
+
+
+def get_archive_storage(archive_dir=None):
+    '''
+    Returns the storage of the archived partitions, HISTORY_ARCHIVE_STORAGE rooted at the archive directory. The
+    partitions are archived by a worker and read back by the web nodes, so deployments running them on several hosts
+    use a shared storage.
+    '''
+
+    return get_storage_class(settings.HISTORY_ARCHIVE_STORAGE)(location=archive_dir or settings.HISTORY_ARCHIVE_DIR)
+
+
+def archive_partition(cursor, month, archive_dir, detach=True):
+    '''
+    Detaches the partition of the month, dumps it to a compressed CSV file in the archive storage and drops it. The
+    partition is detached first so that writes to the history table are not blocked while it is dumped, and it is
+    only dropped once its file is completely stored.
+
+    Returns:
+        str -- path of the archive file in the archive directory
+    '''
+
+    partition = get_partition_name(month)
+    name = partition + ARCHIVE_SUFFIX
+    if detach:
+        cursor.execute('ALTER TABLE {table} DETACH PARTITION {partition}'.format(
+            table=History._meta.db_table,
+            partition=partition
+        ))
+
+    storage = get_archive_storage(archive_dir)
+    with tempfile.TemporaryFile() as temp_file:
+        with gzip.GzipFile(fileobj=temp_file, mode='wb') as archive_file:
+            cursor.copy_expert('COPY {partition} TO STDOUT WITH CSV HEADER'.format(partition=partition), archive_file)
+        temp_file.seek(0)
+        # left by an archival interrupted before the drop
+        if storage.exists(name):
+            storage.delete(name)
+        storage.save(name, File(temp_file))
+    cursor.execute('DROP TABLE {partition}'.format(partition=partition))
+
+    path = os.path.join(archive_dir, name)
+    logger.info('History partition %s archived to %s' % (partition, path))
+    return path
+
+
+def maintain_partitions(months_ahead=None, retention_months=None, archive_dir=None):
+    '''
+    Creates the partitions of the coming months and archives the partitions older than the retention.
+
+    Keyword Arguments:
+        months_ahead {int} -- number of future months to create partitions for (default: {None})
+        retention_months {int} -- number of past months kept in the database (default: {None})
+        archive_dir {str} -- directory of the archive storage receiving the archived partitions (default: {None})
+
+    Returns:
+        tuple -- (created months, archived files)
+    '''
+
+    months_ahead = settings.HISTORY_PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    retention_months = settings.HISTORY_RETENTION_MONTHS if retention_months is None else retention_months
+    archive_dir = archive_dir or settings.HISTORY_ARCHIVE_DIR
+
+    current_month = add_months(timezone.now().date(), 0)
+    oldest_kept_month = add_months(current_month, -retention_months)
+
+    with connection.cursor() as cursor:
+        existing_months = set(get_partition_months(cursor))
+        created_months = []
+        for count in range(months_ahead + 1):
+            month = add_months(current_month, count)
+            if month not in existing_months:
+                create_partition(cursor, month)
+                created_months.append(month)
+
+        detached_months = get_detached_partition_months(cursor)
+        expired_months = [
+            existing_month for existing_month in sorted(existing_months) if existing_month < oldest_kept_month
+        ]
+        archived_files = [
+            archive_partition(cursor, detached_month, archive_dir, detach=False) for detached_month in detached_months
+        ]
+        for month in expired_months:
+            archived_files.append(archive_partition(cursor, month, archive_dir))
+
+    return created_months, archived_files
+
+
+def _parse_archived_row(row, fields):
+    values = {}
+    for column, value in row.iteritems():
+        field = fields.get(column)
+        if field is None:
+            continue
+        value = value.decode('utf-8')
+        # COPY writes NULL as an empty unquoted value, which csv reads as an empty string
+        if value == '' and field.null:
+            values[field.attname] = None
+        elif field.get_internal_type() == 'JSONField':
+            values[field.attname] = json.loads(value)
+        else:
+            values[field.attname] = field.to_python(value)
+    return History(**values)
+
+
+def read_archived_histories(predicate, archive_dir=None, limit=None):
+    '''
+    Reads the archived histories, oldest partition first, keeping those the predicate accepts. Every archive file read
+    is decompressed and scanned, so this is much slower than reading the table.
+
+    Arguments:
+        predicate {function} -- called with each History, returns whether to keep it
+
+    Keyword Arguments:
+        archive_dir {str} -- directory of the archive storage holding the archived partitions (default: {None})
+        limit {int} -- files are no longer read once this many histories are kept, every history of the last file
+            read being returned (default: {None})
+
+    Returns:
+        list -- unsaved History instances
+    '''
+
+    storage = get_archive_storage(archive_dir)
+    try:
+        _, file_names = storage.listdir('')
+    except OSError:
+        # nothing archived yet
+        return []
+
+    fields = {field.attname: field for field in History._meta.concrete_fields}
+    histories = []
+    for file_name in sorted(file_names):
+        if limit is not None and len(histories) >= limit:
+            break
+        if not file_name.endswith(ARCHIVE_SUFFIX) or not PARTITION_NAME_RE.match(file_name[:-len(ARCHIVE_SUFFIX)]):
+            continue
+        with storage.open(file_name, 'rb') as stored_file:
+            with gzip.GzipFile(fileobj=stored_file, mode='rb') as archive_file:
+                for row in csv.DictReader(archive_file):
+                    history = _parse_archived_row(row, fields)
+                    if predicate(history):
+                        histories.append(history)
+    # partitions hold consecutive months, so sorting the histories of the files read keeps them in table order
+    return sorted(histories, key=lambda history: (history.created, history.id))
@@ -1,11 +1,24 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.db import models
 from rest_framework import serializers
 
 from apps.history.models import History
 
 
+class HistoryListSerializer(serializers.ListSerializer):
+    '''
+    Lists change sets as one entry per field, and resolves the display values of the whole list at once instead of
+    querying the related objects of every entry.
+    '''
+
+    def to_representation(self, data):
+        histories = History.expand_changes(data.all() if isinstance(data, models.Manager) else data)
+        History.prefetch_display_values(histories)
+        return super(HistoryListSerializer, self).to_representation(histories)
+
+
 class HistorySerializer(serializers.ModelSerializer):
     action = serializers.CharField(
         read_only=True,
@@ -26,8 +39,16 @@ class HistorySerializer(serializers.ModelSerializer):
 
     class Meta:
         model = History
+        list_serializer_class = HistoryListSerializer
         fields = (
             'id', 'field_name', 'prev_value',
             'next_value', 'content_object', 'action', 'created',
             'content_type'
         )
+
+
+class HistoryAsOfSerializer(serializers.Serializer):
+    '''
+    Time at which the state of an object is requested.
+    '''
+    ts = serializers.DateTimeField()
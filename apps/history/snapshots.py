@@ -0,0 +1,152 @@
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+
+from apps.common import constant as common_constant
+from apps.history.models import History, HistorySnapshot
+
+logger = logging.getLogger(__name__)
+
+COUNT_CHANGES_SQL = '''
+INSERT INTO history_historysnapshotcounter AS counter (workflow_id, changes)
+VALUES {values}
+ON CONFLICT (workflow_id) DO UPDATE SET changes = counter.changes + EXCLUDED.changes
+RETURNING workflow_id, changes
+'''
+
+
+def count_changes(histories):
+    '''
+    Adds the histories to the change counters of their workflows.
+
+    Arguments:
+        histories {list} -- History instances being written
+
+    Returns:
+        list -- ids of the workflows whose counter just reached a multiple of the snapshot interval
+    '''
+
+    added_changes = {}
+    for history in histories:
+        if history.workflow_id is not None:
+            added_changes[history.workflow_id] = added_changes.get(history.workflow_id, 0) + 1
+    if not added_changes:
+        return []
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            COUNT_CHANGES_SQL.format(values=', '.join(['(%s, %s)'] * len(added_changes))),
+            [value for item in sorted(added_changes.iteritems()) for value in item]
+        )
+        counters = cursor.fetchall()
+
+    interval = common_constant.HISTORY_SNAPSHOT_INTERVAL
+    # only the write crossing a multiple of the interval requests a snapshot, so a failed snapshot is requested again
+    return [
+        workflow_id for workflow_id, changes in counters
+        if changes // interval > (changes - added_changes[workflow_id]) // interval
+    ]
+
+
+def apply_history(state, history):
+    '''
+    Applies the changes of the history to the state, in place.
+    '''
+
+    objects = state.setdefault(ContentType.objects.get_for_id(history.content_type_id).model, {})
+    object_id = str(history.object_id)
+    if history.action == common_constant.HISTORY_ACTION.DELETE:
+        objects.pop(object_id, None)
+        return
+
+    values = objects.setdefault(object_id, {})
+    if history.changes:
+        for field_name, (prev_value, next_value) in history.changes.iteritems():
+            values[field_name] = next_value
+    else:
+        # histories written before change sets hold str() of a single value
+        values[history.field_name] = None if history.next_value == 'None' else history.next_value
+
+
+def replay(workflow_id, until=None):
+    '''
+    Rebuilds the state of the workflow from its nearest snapshot and the histories written after it. Snapshots are
+    anchored on the id of their last history rather than its creation time, as the histories of a workflow are
+    committed in id order but not in creation time order.
+
+    Arguments:
+        workflow_id {int} -- id of the workflow
+
+    Keyword Arguments:
+        until {datetime} -- time of the state, the latest state when None (default: {None})
+
+    Returns:
+        tuple -- (state, last History applied or None)
+    '''
+
+    snapshots = HistorySnapshot.objects.filter(workflow_id=workflow_id)
+    histories = History.objects.filter(workflow_id=workflow_id)
+    if until is not None:
+        snapshots = snapshots.filter(taken_at__lte=until)
+        histories = histories.filter(created__lte=until)
+
+    snapshot = snapshots.order_by('-last_history_id').first()
+    state = {}
+    if snapshot is not None:
+        state = snapshot.state
+        histories = histories.filter(id__gt=snapshot.last_history_id)
+
+    last_history = None
+    for history in histories.order_by('id').iterator():
+        apply_history(state, history)
+        last_history = history
+    return state, last_history
+
+
+def take_snapshot(workflow_id):
+    '''
+    Stores the latest state of the workflow, if histories were written since its last snapshot.
+
+    Returns:
+        HistorySnapshot -- the new snapshot, None if the workflow did not change
+    '''
+
+    state, last_history = replay(workflow_id)
+    if last_history is None:
+        return None
+
+    snapshot = HistorySnapshot.objects.create(
+        workflow_id=workflow_id,
+        taken_at=last_history.created,
+        last_history_id=last_history.id,
+        state=state
+    )
+    logger.info('History snapshot %s taken' % snapshot)
+    return snapshot
+
+
+def get_workflow_state(workflow_id, as_of):
+    '''
+    Returns the workflow, its tasks and accessors as they were at the given time.
+
+    Arguments:
+        workflow_id {int} -- id of the workflow
+        as_of {datetime} -- time of the state
+
+    Returns:
+        dict -- field values of the workflow, tasks and accessors, tasks and accessors ordered by id
+    '''
+
+    state, _ = replay(workflow_id, as_of)
+
+    def _objects(model_name):
+        objects = state.get(model_name, {})
+        return [objects[object_id] for object_id in sorted(objects, key=int)]
+
+    return {
+        'as_of': as_of,
+        'workflow': state.get('workflow', {}).get(str(workflow_id)),
+        'tasks': _objects('task'),
+        'accessors': _objects('workflowaccess'),
+    }
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from celery import shared_task
+import logging
+
+from apps.history.models import HistorySnapshotCounter
+from apps.history.partitions import maintain_partitions
+from apps.history.snapshots import take_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def maintain_history_partitions():
+    '''
+    Creates the history partitions of the coming months and archives the expired ones.
+    '''
+
+    created_months, archived_files = maintain_partitions()
+    logger.info('%d history partitions created, %d archived' % (len(created_months), len(archived_files)))
+
+
+@shared_task
+def take_history_snapshot(workflow_id):
+    '''
+    Stores a snapshot of the workflow state, resetting its change counter.
+    '''
+
+    HistorySnapshotCounter.objects.filter(workflow_id=workflow_id).update(changes=0)
+    take_snapshot(workflow_id)
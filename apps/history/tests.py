@@ -1,6 +1,361 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+from importlib import import_module
 
-# Create your tests here.
+from django.apps import apps
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from apps.common import constant as common_constant
+from apps.common.tests.tests import create_company, create_employee, create_workflow, create_task
+from apps.history import helpers as history_helpers
+from apps.history.helpers import get_history_scopes, history_buffer
+from apps.history.models import History, HistorySnapshot
+from apps.history.serializers import HistorySerializer
+from apps.history.partitions import archive_partition, create_partition, get_partition_months, get_partition_name
+from apps.history.snapshots import replay, take_snapshot
+from apps.workflow.models import Task, Workflow, WorkflowAccess
+
+
+class HistoryBufferTest(TestCase):
+
+    def setUp(self):
+        self.employee = create_employee(create_company(), 'employee@t.com')
+
+    def test_histories_are_written_at_the_end_of_the_block(self):
+        workflow = create_workflow(self.employee, name='first')
+        with history_buffer():
+            workflow.name = 'second'
+            workflow.save()
+            workflow.name = 'third'
+            workflow.save()
+            self.assertEqual(History.objects.count(), 1)
+
+        history = History.objects.filter(workflow_id=workflow.id).latest('id')
+        self.assertEqual(history.action, common_constant.HISTORY_ACTION.UPDATE)
+        self.assertEqual(history.changes, {'name': ['first', 'third']})
+
+    def test_create_and_update_in_a_block_are_coalesced(self):
+        with history_buffer():
+            workflow = create_workflow(self.employee, name='first')
+            workflow.name = 'second'
+            workflow.save()
+
+        history = History.objects.get(workflow_id=workflow.id)
+        self.assertEqual(history.action, common_constant.HISTORY_ACTION.CREATE)
+        self.assertEqual(history.changes['name'], [None, 'second'])
+
+    def test_saves_outside_of_a_block_are_written_at_once(self):
+        workflow = create_workflow(self.employee)
+
+        self.assertEqual(History.objects.filter(workflow_id=workflow.id).count(), 1)
+
+    def test_error_in_the_block_discards_changes_and_histories(self):
+        with self.assertRaises(ValueError):
+            with history_buffer():
+                create_workflow(self.employee)
+                raise ValueError
+
+        self.assertFalse(Workflow.objects.exists())
+        self.assertFalse(History.objects.exists())
+
+    def test_failed_flush_rolls_back_the_changes(self):
+        def write_histories(histories):
+            raise ValueError
+
+        original_write_histories = history_helpers.write_histories
+        history_helpers.write_histories = write_histories
+        try:
+            with self.assertRaises(ValueError):
+                with history_buffer():
+                    create_workflow(self.employee)
+        finally:
+            history_helpers.write_histories = original_write_histories
+
+        self.assertFalse(Workflow.objects.exists())
+
+    def test_nested_blocks_flush_once(self):
+        workflow = create_workflow(self.employee, name='first')
+        with history_buffer():
+            with history_buffer():
+                workflow.name = 'second'
+                workflow.save()
+            self.assertEqual(History.objects.count(), 1)
+
+        self.assertEqual(History.objects.filter(workflow_id=workflow.id).count(), 2)
+
+    def test_histories_of_a_rolled_back_nested_block_are_dropped(self):
+        workflow = create_workflow(self.employee, name='first')
+        with history_buffer():
+            workflow.name = 'second'
+            workflow.save()
+            with self.assertRaises(ValueError):
+                with history_buffer():
+                    create_workflow(self.employee, name='rolled back')
+                    workflow.name = 'third'
+                    workflow.save()
+                    raise ValueError
+
+        self.assertEqual(list(Workflow.objects.values_list('name', flat=True)), ['second'])
+        self.assertEqual(History.objects.count(), 2)
+        history = History.objects.latest('id')
+        self.assertEqual(history.changes, {'name': ['first', 'second']})
+
+
+class HistoryScopeTest(TestCase):
+
+    def setUp(self):
+        self.company = create_company()
+        employee = create_employee(self.company, 'employee@t.com')
+        self.workflows = [create_workflow(employee), create_workflow(employee)]
+        self.tasks = [create_task(workflow, employee) for workflow in self.workflows for _ in range(2)]
+
+    def test_scopes_are_read_with_one_query(self):
+        tasks = list(Task.objects.order_by('id'))
+
+        with self.assertNumQueries(1):
+            scopes = get_history_scopes(tasks + [self.company])
+
+        self.assertEqual(
+            scopes,
+            [(task.workflow_id, self.company.id) for task in tasks] + [(None, None)]
+        )
+
+    def test_histories_are_scoped(self):
+        for task in self.tasks:
+            history = History.objects.get(tasks=task)
+            self.assertEqual((history.workflow_id, history.company_id), (task.workflow_id, self.company.id))
+
+
+class ExpandChangesTest(TestCase):
+
+    def setUp(self):
+        self.employee = create_employee(create_company(), 'employee@t.com')
+        self.workflow = create_workflow(self.employee, start_at=timezone.now().replace(microsecond=0))
+
+    def get_values(self, instance):
+        history = instance.histories.get()
+        return {expanded.field_name: expanded.next_value for expanded in History.expand_changes([history])}
+
+    def test_values_are_stringified_as_single_field_histories(self):
+        task = create_task(self.workflow, self.employee, duration=timedelta(hours=1))
+        access = WorkflowAccess.objects.create(employee=self.employee, workflow=self.workflow)
+
+        task_values = self.get_values(task)
+        self.assertEqual(task_values['duration'], '1:00:00')
+        self.assertEqual(task_values['start_delta'], '0:00:00')
+        self.assertEqual(task_values['parent_task'], 'None')
+        self.assertEqual(self.get_values(self.workflow)['start_at'], str(self.workflow.start_at))
+        self.assertEqual(self.get_values(access)['is_active'], 'True')
+
+    def test_datetimes_keep_their_microseconds(self):
+        start_at = timezone.now().replace(microsecond=853746)
+        self.workflow.start_at = start_at
+        self.workflow.save()
+
+        history = self.workflow.histories.get(action=common_constant.HISTORY_ACTION.UPDATE)
+        self.assertEqual(history.changes['start_at'][1], start_at.isoformat())
+        expanded, = History.expand_changes([history])
+        self.assertEqual(expanded.next_value, str(start_at))
+        state, _ = replay(self.workflow.id)
+        self.assertEqual(state['workflow'][str(self.workflow.id)]['start_at'], start_at.isoformat())
+
+    def test_values_are_displayed(self):
+        task = create_task(self.workflow, self.employee)
+        expanded = {history.field_name: history for history in History.expand_changes([task.histories.get()])}
+
+        self.assertEqual(expanded['duration'].get_next_value_display(), '1:00:00')
+        self.assertEqual(expanded['workflow'].get_next_value_display(), self.workflow._history_representation())
+
+    def test_single_field_histories_are_kept_as_stored(self):
+        history = History.objects.create(
+            content_object=create_task(self.workflow, self.employee),
+            field_name='duration',
+            prev_value='None',
+            next_value='1:00:00',
+            action=common_constant.HISTORY_ACTION.CREATE
+        )
+
+        expanded, = History.expand_changes([history])
+        self.assertIs(expanded, history)
+        self.assertEqual((expanded.get_prev_value_display(), expanded.get_next_value_display()), ('None', '1:00:00'))
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        self.employee = create_employee(create_company(), 'employee@t.com')
+        self.workflow = create_workflow(self.employee, name='first')
+
+    def test_histories_committed_after_the_snapshot_are_replayed(self):
+        snapshot = take_snapshot(self.workflow.id)
+        self.workflow.name = 'second'
+        self.workflow.save()
+        # written by a transaction which started before the snapshot was taken and committed after it
+        History.objects.filter(workflow_id=self.workflow.id, id__gt=snapshot.last_history_id).update(
+            created=snapshot.taken_at - timedelta(seconds=1)
+        )
+
+        state, last_history = replay(self.workflow.id)
+
+        self.assertEqual(state['workflow'][str(self.workflow.id)]['name'], 'second')
+        self.assertGreater(last_history.id, snapshot.last_history_id)
+
+    def test_snapshot_state_is_replayed(self):
+        self.workflow.name = 'second'
+        self.workflow.save()
+        snapshot = take_snapshot(self.workflow.id)
+
+        with self.assertNumQueries(2):
+            state, last_history = replay(self.workflow.id)
+
+        self.assertEqual(state, snapshot.state)
+        self.assertIsNone(last_history)
+
+
+class AsOfTest(APITestCase):
+
+    def setUp(self):
+        self.employee = create_employee(create_company(), 'admin@t.com', is_admin=True)
+        self.workflow = create_workflow(self.employee, name='first')
+        self.created = timezone.now() - timedelta(days=1)
+        self.set_last_created(self.created)
+        for hours, name in enumerate(['second', 'third', 'fourth'], 1):
+            self.workflow.name = name
+            self.workflow.save()
+            self.set_last_created(self.created + timedelta(hours=hours))
+            if name != 'fourth':
+                take_snapshot(self.workflow.id)
+        self.client.force_authenticate(self.employee.user)
+
+    def set_last_created(self, created):
+        histories = History.objects.filter(workflow_id=self.workflow.id)
+        histories.filter(id=histories.order_by('-id').values('id')[:1]).update(created=created)
+
+    def get_name(self, ts):
+        response = self.client.get(reverse('workflow:workflow-as-of', args=[self.workflow.id]), {'ts': ts})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['workflow'] and response.data['workflow']['name']
+
+    def test_state_between_snapshots(self):
+        self.assertEqual(HistorySnapshot.objects.filter(workflow_id=self.workflow.id).count(), 2)
+        # snapshots were taken at the second and third names
+        self.assertEqual(self.get_name(self.created + timedelta(hours=1, minutes=30)), 'second')
+        self.assertEqual(self.get_name(self.created + timedelta(hours=2, minutes=30)), 'third')
+
+    def test_state_before_first_snapshot_and_after_last_one(self):
+        self.assertIsNone(self.get_name(self.created - timedelta(minutes=1)))
+        self.assertEqual(self.get_name(self.created + timedelta(minutes=30)), 'first')
+        self.assertEqual(self.get_name(timezone.now()), 'fourth')
+
+
+class HistorySerializerTest(TestCase):
+
+    def setUp(self):
+        company = create_company()
+        self.employees = [create_employee(company, '{index}@t.com'.format(index=index)) for index in range(4)]
+        self.workflow = create_workflow(self.employees[0])
+
+    def serialize(self):
+        histories = list(History.objects.filter(workflow_id=self.workflow.id).order_by('id'))
+        with CaptureQueriesContext(connection) as queries:
+            data = HistorySerializer(histories, many=True).data
+        return data, len(queries)
+
+    def test_display_values_are_resolved_in_bulk(self):
+        create_task(self.workflow, self.employees[0])
+        _, few_queries = self.serialize()
+        for employee in self.employees[1:]:
+            create_task(self.workflow, employee)
+
+        data, queries = self.serialize()
+
+        self.assertEqual(queries, few_queries)
+        expected = [
+            (history.field_name, history.get_prev_value_display(), history.get_next_value_display())
+            for history in History.expand_changes(History.objects.filter(workflow_id=self.workflow.id).order_by('id'))
+        ]
+        self.assertEqual([(entry['field_name'], entry['prev_value'], entry['next_value']) for entry in data], expected)
+
+
+class PartitionTest(APITestCase):
+
+    def setUp(self):
+        self.employee = create_employee(create_company(), 'admin@t.com', is_admin=True)
+        self.workflow = create_workflow(self.employee, name='first')
+        for name in ('second', 'third'):
+            self.workflow.name = name
+            self.workflow.save()
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+
+    def move_histories(self, month):
+        History.objects.all().update(created=timezone.make_aware(datetime(month.year, month.month, 15)))
+
+    def count_rows(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM {table}'.format(table=table))
+            return cursor.fetchone()[0]
+
+    def test_partition_takes_rows_of_the_default_partition(self):
+        month = date(2099, 3, 1)
+        self.move_histories(month)
+        self.assertEqual(self.count_rows('history_history_default'), 3)
+
+        with connection.cursor() as cursor:
+            create_partition(cursor, month)
+
+        self.assertEqual(self.count_rows(get_partition_name(month)), 3)
+        self.assertEqual(self.count_rows('history_history_default'), 0)
+        self.assertEqual(History.objects.count(), 3)
+
+    def test_partitioning_migration_is_reversible(self):
+        migration = import_module('apps.history.migrations.0005_partition_history')
+        histories = list(History.objects.order_by('id').values_list('id', 'changes'))
+        with connection.cursor() as cursor:
+            # the test transaction holds the deferred foreign key checks of the histories
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+        migration.unpartition_history(apps, connection.schema_editor())
+        self.assertEqual(get_partition_months(connection.cursor()), [])
+        self.assertEqual(list(History.objects.order_by('id').values_list('id', 'changes')), histories)
+
+        migration.partition_history(apps, connection.schema_editor())
+        self.assertIn(timezone.now().date().replace(day=1), get_partition_months(connection.cursor()))
+        self.assertEqual(list(History.objects.order_by('id').values_list('id', 'changes')), histories)
+
+    def test_archived_histories_are_paged(self):
+        month = date(2001, 1, 1)
+        self.move_histories(month)
+        with connection.cursor() as cursor:
+            create_partition(cursor, month)
+            # the test transaction holds the deferred foreign key checks of the moved rows
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            archive_partition(cursor, month, self.archive_dir)
+        self.workflow.name = 'fourth'
+        self.workflow.save()
+
+        self.client.force_authenticate(self.employee.user)
+        url = reverse('workflow:workflow-history', args=[self.workflow.id])
+        names = []
+        with override_settings(HISTORY_ARCHIVE_DIR=self.archive_dir):
+            response = self.client.get(url, {'include_archived': 1, 'page_size': 1})
+            pages = 1
+            while response.data['next']:
+                names.extend(entry['next_value'] for entry in response.data['results'] if entry['field_name'] == 'name')
+                response = self.client.get(response.data['next'])
+                pages += 1
+            names.extend(entry['next_value'] for entry in response.data['results'] if entry['field_name'] == 'name')
+
+        self.assertEqual(names, ['first', 'second', 'third', 'fourth'])
+        self.assertEqual(pages, 4)
@@ -6,3 +6,6 @@ from django.apps import AppConfig
 
 class ReportConfig(AppConfig):
     name = 'apps.report'
+
+    def ready(self):
+        import apps.report.signals
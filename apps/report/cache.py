@@ -0,0 +1,206 @@
+import functools
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.transaction import on_commit
+
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+
+from apps.common import constant as common_constant
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'report-version:{company_id}'
+REPORT_KEY = 'report:{company_id}:{version}:{report}:{params}'
+JOB_KEY = 'report-job:{job_id}'
+HITS_KEY = 'report-cache:hits'
+MISSES_KEY = 'report-cache:misses'
+# query param asking for the report to be computed by a worker, left out of the cache key
+ASYNC_PARAM = 'async'
+
+
+def get_report_cache():
+    return caches[settings.REPORT_CACHE_ALIAS]
+
+
+def _incr(cache, key, initial=0):
+    # add is a no-op when the key exists, incr then works on every backend
+    cache.add(key, initial, None)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # evicted between add and incr
+        cache.set(key, initial + 1, None)
+        return initial + 1
+
+
+def _initial_version():
+    # versions start from the current time, so that a version evicted from the cache is never reused
+    return int(time.time() * 1000)
+
+
+def get_company_version(company_id):
+    '''
+    Returns the version of the company data, cached reports of older versions are never read again.
+    '''
+
+    cache = get_report_cache()
+    key = VERSION_KEY.format(company_id=company_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_company_version(company_id):
+    '''
+    Invalidates all cached reports of the company.
+    '''
+
+    version = _incr(get_report_cache(), VERSION_KEY.format(company_id=company_id), _initial_version())
+    logger.debug('Report data version of company %s bumped to %s' % (company_id, version))
+
+
+def bump_after_commit(company_id):
+    '''
+    Invalidates all cached reports of the company once the ongoing transaction commits, so that no report of the old
+    data is cached under the new version.
+    '''
+
+    on_commit(lambda: bump_company_version(company_id))
+
+
+def get_report_key(company_id, report, params):
+    '''
+    Returns the cache key of the report of the company for the given params, at the current company data version.
+    '''
+
+    params = hashlib.md5(repr(sorted(params.iteritems())).encode('utf-8')).hexdigest()
+    return REPORT_KEY.format(
+        company_id=company_id,
+        version=get_company_version(company_id),
+        report=report,
+        params=params
+    )
+
+
+def get_report_job(job_id):
+    return get_report_cache().get(JOB_KEY.format(job_id=job_id))
+
+
+def set_report_job(job_id, job):
+    get_report_cache().set(JOB_KEY.format(job_id=job_id), job, settings.REPORT_JOB_TIMEOUT)
+
+
+def get_report_job_data(request, job_id, job):
+    data = {
+        'job_id': job_id,
+        'status': job['status'],
+        'url': reverse('report:report-job', kwargs={'job_id': job_id}, request=request),
+    }
+    if job['status'] in (common_constant.REPORT_JOB_STATUS.COMPLETE, common_constant.REPORT_JOB_STATUS.FAILED):
+        data['status_code'] = job['status_code']
+        data['result'] = job['result']
+    return data
+
+
+def queue_report_job(view, request, key, kwargs):
+    '''
+    Queues the computation of the report by a worker, unless the same report is already queued, running or computed,
+    in which case its job is shared. Jobs are named after the cache key of the report, which includes the company data
+    version, so identical requests get the same job until the company data changes.
+
+    Arguments:
+        view {APIView} -- report view
+        request {Request} -- report request
+        key {str} -- cache key of the report
+        kwargs {dict} -- url kwargs of the view
+
+    Returns:
+        Response -- job status, with 202 status
+    '''
+    from apps.report.tasks import generate_report
+
+    cache = get_report_cache()
+    job_id = hashlib.md5(key.encode('utf-8')).hexdigest()
+    job_key = JOB_KEY.format(job_id=job_id)
+    job = {'status': common_constant.REPORT_JOB_STATUS.PENDING, 'company_id': request.user.company.id}
+
+    existing_job = cache.get(job_key)
+    if existing_job is not None and existing_job['status'] == common_constant.REPORT_JOB_STATUS.FAILED:
+        # failed jobs are retried by the next request
+        cache.delete(job_key)
+    # add is atomic, only one of concurrent identical requests queues the job
+    if cache.add(job_key, job, settings.REPORT_JOB_TIMEOUT):
+        query_params = request.query_params.copy()
+        query_params.pop(ASYNC_PARAM, None)
+        generate_report.delay(
+            job_id,
+            '{module}.{name}'.format(module=type(view).__module__, name=type(view).__name__),
+            request.user.id,
+            query_params.urlencode(),
+            kwargs
+        )
+        logger.info('Report job %s queued' % job_id)
+    else:
+        job = cache.get(job_key) or job
+
+    return Response(get_report_job_data(request, job_id, job), status=status.HTTP_202_ACCEPTED)
+
+
+def cached_report(report):
+    '''
+    Decorator for the get/retrieve method of report views, serving the response data from the report cache until the
+    company data changes or the cache timeout expires. With the async query param, a report missing from the cache is
+    computed by a worker and the response only describes the job.
+
+    Arguments:
+        report {str} -- name of the report, part of the cache key
+    '''
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            cache = get_report_cache()
+            params = dict(kwargs)
+            params.update(
+                (key, tuple(values)) for key, values in request.query_params.lists() if key != ASYNC_PARAM
+            )
+            key = get_report_key(request.user.company.id, report, params)
+
+            data = cache.get(key)
+            if data is not None:
+                _incr(cache, HITS_KEY)
+                return Response(data, status=status.HTTP_200_OK)
+
+            if request.query_params.get(ASYNC_PARAM) in ('1', 'true'):
+                return queue_report_job(view, request, key, kwargs)
+
+            _incr(cache, MISSES_KEY)
+            response = method(view, request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, settings.REPORT_CACHE_TIMEOUT)
+            return response
+        return wrapper
+    return decorator
+
+
+def get_cache_stats():
+    '''
+    Returns the hit and miss counts of the report cache.
+    '''
+
+    cache = get_report_cache()
+    counts = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = counts.get(HITS_KEY, 0), counts.get(MISSES_KEY, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': float(hits) / (hits + misses) if hits + misses else None,
+    }
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import collections
+import csv
+from itertools import islice
+import json
+
+from django.utils.encoding import force_text
+
+from rest_framework import serializers
+from rest_framework.utils.encoders import JSONEncoder
+
+OUTPUT_CSV = 'csv'
+OUTPUT_NDJSON = 'ndjson'
+CONTENT_TYPES = {
+    OUTPUT_CSV: 'text/csv; charset=utf-8',
+    OUTPUT_NDJSON: 'application/x-ndjson; charset=utf-8',
+}
+
+
+class Echo(object):
+    '''
+    File like object handing back what is written to it, so that csv writes a row at a time to the response.
+    '''
+
+    def write(self, value):
+        return value
+
+
+def iterate_chunks(queryset, chunk_size):
+    '''
+    Iterates over the queryset in lists of chunk_size instances, the ids being read with a server side cursor and every
+    chunk loaded with a query of its own.
+    '''
+    ids = queryset.order_by('id').values_list('id', flat=True).iterator()
+    while True:
+        chunk_ids = list(islice(ids, chunk_size))
+        if not chunk_ids:
+            return
+        yield list(queryset.filter(id__in=chunk_ids).order_by('id'))
+
+
+def get_csv_columns(serializer, prefix=''):
+    '''
+    Returns the columns of the serializer, nested serializers being flattened into dotted columns. Lists stay in one
+    column, holding their json.
+    '''
+    columns = []
+    for name, field in serializer.fields.items():
+        if isinstance(field, serializers.Serializer):
+            columns.extend(get_csv_columns(field, prefix + name + '.'))
+        else:
+            columns.append(prefix + name)
+    return columns
+
+
+def get_csv_value(data, column):
+    for name in column.split('.'):
+        if data is None:
+            return ''
+        data = data[name]
+    if data is None:
+        return ''
+    if isinstance(data, (list, dict)):
+        data = json.dumps(data, cls=JSONEncoder)
+    return force_text(data).encode('utf-8')
+
+
+def stream_csv(rows, serializer):
+    '''
+    Yields the rows as csv lines, after a header line.
+
+    Arguments:
+        rows {iterable} -- serialized rows
+        serializer {Serializer} -- serializer of the rows, giving the columns
+    '''
+    columns = ['id'] + get_csv_columns(serializer)
+    writer = csv.writer(Echo())
+    yield writer.writerow([column.encode('utf-8') for column in columns])
+    for row in rows:
+        yield writer.writerow([get_csv_value(row, column) for column in columns])
+
+
+def stream_ndjson(rows):
+    '''
+    Yields the rows as json lines.
+    '''
+    for row in rows:
+        yield json.dumps(row, cls=JSONEncoder) + '\n'
+
+
+def serialize_rows(chunks, build_reports, serializer_class):
+    '''
+    Yields the serialized reports of the instances, chunk after chunk, with the id of their instance first.
+
+    Arguments:
+        chunks {iterable} -- lists of instances
+        build_reports {function} -- returns the report data of a list of instances
+        serializer_class {class} -- serializer of the report data
+    '''
+    for instances in chunks:
+        for instance, data in zip(instances, build_reports(instances)):
+            row = collections.OrderedDict([('id', instance.id)])
+            row.update(serializer_class(data).data)
+            yield row
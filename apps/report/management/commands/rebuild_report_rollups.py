@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from apps.report.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    '''
+    Recompute the report rollups from completed tasks.
+    '''
+    help = 'Rebuilds the employee task rollups read by the reports, e.g. to backfill them.'
+
+    def handle(self, *args, **options):
+        rollups = rebuild_rollups()
+        self.stdout.write('%d employee rollups rebuilt' % rollups)
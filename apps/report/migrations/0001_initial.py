@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# rollups of the tasks completed before the deploy, later completions are added as they happen. A rollup by workflow
+# was part of this migration at first and dropped, the workflow reports read their tasks directly.
+BACKFILL_ROLLUPS_SQL = '''
+INSERT INTO report_employeetaskrollup
+    (company_id, employee_id, day, completed_tasks, time_spent_sum, time_spent_min, time_spent_max)
+SELECT company_id, employee_id, day, COUNT(*), SUM(time_spent), MIN(time_spent), MAX(time_spent)
+FROM (
+    SELECT
+        task.assignee_id AS employee_id,
+        employee.company_id,
+        workflow.start_at::date AS day,
+        task.completed_at - COALESCE(parent_task.completed_at, workflow.start_at) - task.start_delta AS time_spent
+    FROM workflow_task AS task
+        INNER JOIN workflow_workflow AS workflow ON workflow.id = task.workflow_id
+        INNER JOIN company_usercompany AS employee ON employee.id = task.assignee_id
+        LEFT OUTER JOIN workflow_task AS parent_task ON parent_task.id = task.parent_task_id
+    WHERE task.status = %s
+) AS completed_task
+GROUP BY company_id, employee_id, day
+'''
+
+# TASK_STATUS.COMPLETE
+TASK_STATUS_COMPLETE = 4
+
+
+def backfill_rollups(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(BACKFILL_ROLLUPS_SQL, [TASK_STATUS_COMPLETE])
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('company', '0012_usercompanycsv'),
+        ('workflow', '0016_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmployeeTaskRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(help_text='start day of the workflows of the tasks')),
+                ('completed_tasks', models.PositiveIntegerField(default=0)),
+                ('time_spent_sum', models.DurationField()),
+                ('time_spent_min', models.DurationField()),
+                ('time_spent_max', models.DurationField()),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='task_rollups', to='company.Company')),
+                ('employee', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='task_rollups', to='company.UserCompany')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='employeetaskrollup',
+            unique_together=set([('employee', 'day')]),
+        ),
+        migrations.AddIndex(
+            model_name='employeetaskrollup',
+            index=models.Index(fields=['company', 'day'], name='report_empl_company_de3054_idx'),
+        ),
+        # the table is dropped when unapplied
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
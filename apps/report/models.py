@@ -3,4 +3,27 @@ from __future__ import unicode_literals
 
 from django.db import models
 
-# Create your models here.
+from apps.company.models import Company, UserCompany
+
+
+class EmployeeTaskRollup(models.Model):
+    '''
+    Completed tasks of an employee, by start day of their workflows, maintained as tasks get completed.
+    '''
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='task_rollups')
+    employee = models.ForeignKey(UserCompany, on_delete=models.CASCADE, related_name='task_rollups')
+    day = models.DateField(help_text='start day of the workflows of the tasks')
+    completed_tasks = models.PositiveIntegerField(default=0)
+    time_spent_sum = models.DurationField()
+    time_spent_min = models.DurationField()
+    time_spent_max = models.DurationField()
+
+    class Meta:
+        unique_together = ('employee', 'day')
+        indexes = [
+            models.Index(fields=['company', 'day']),
+        ]
+
+    def __unicode__(self):
+        return '{employee}-#-{day}'.format(employee=self.employee_id, day=self.day)
+
@@ -0,0 +1,98 @@
+import logging
+
+from django.db import connection
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from apps.common import constant as common_constant
+from apps.company.models import Company, UserCompany
+from apps.report.cache import bump_after_commit
+from apps.report.models import EmployeeTaskRollup
+from apps.workflow.models import Task, Workflow
+
+logger = logging.getLogger(__name__)
+
+RECORD_EMPLOYEE_TASK_SQL = '''
+INSERT INTO {rollup_table} AS rollup
+    (company_id, employee_id, day, completed_tasks, time_spent_sum, time_spent_min, time_spent_max)
+VALUES (%(company_id)s, %(employee_id)s, %(day)s, 1, %(time_spent)s, %(time_spent)s, %(time_spent)s)
+ON CONFLICT (employee_id, day) DO UPDATE SET
+    completed_tasks = rollup.completed_tasks + 1,
+    time_spent_sum = rollup.time_spent_sum + EXCLUDED.time_spent_sum,
+    time_spent_min = LEAST(rollup.time_spent_min, EXCLUDED.time_spent_min),
+    time_spent_max = GREATEST(rollup.time_spent_max, EXCLUDED.time_spent_max)
+'''.format(rollup_table=EmployeeTaskRollup._meta.db_table)
+
+# concurrent completions wait for the rebuild, and are added on top of it once it commits
+REBUILD_ROLLUPS_SQL = '''
+LOCK TABLE {rollup_table} IN EXCLUSIVE MODE;
+DELETE FROM {rollup_table};
+
+INSERT INTO {rollup_table}
+    (company_id, employee_id, day, completed_tasks, time_spent_sum, time_spent_min, time_spent_max)
+SELECT company_id, employee_id, day, COUNT(*), SUM(time_spent), MIN(time_spent), MAX(time_spent)
+FROM (
+    SELECT
+        task.assignee_id AS employee_id,
+        employee.company_id,
+        workflow.start_at::date AS day,
+        task.completed_at - COALESCE(parent_task.completed_at, workflow.start_at) - task.start_delta AS time_spent
+    FROM {task_table} AS task
+        INNER JOIN {workflow_table} AS workflow ON workflow.id = task.workflow_id
+        INNER JOIN {employee_table} AS employee ON employee.id = task.assignee_id
+        LEFT OUTER JOIN {task_table} AS parent_task ON parent_task.id = task.parent_task_id
+    WHERE task.status = %(complete)s
+) AS completed_task
+GROUP BY company_id, employee_id, day;
+'''.format(
+    rollup_table=EmployeeTaskRollup._meta.db_table,
+    task_table=Task._meta.db_table,
+    workflow_table=Workflow._meta.db_table,
+    employee_table=UserCompany._meta.db_table
+)
+
+
+def get_time_spent(task):
+    '''
+    Time spent on the completed task, from the completion of its parent (or the start of its workflow) and its start
+    delta.
+    '''
+
+    started_after = task.parent_task.completed_at if task.parent_task_id else task.workflow.start_at
+    return task.completed_at - started_after - task.start_delta
+
+
+def record_task_completion(task):
+    '''
+    Adds the completed task to the rollup of its assignee, in the ongoing transaction.
+    '''
+
+    params = {
+        'company_id': task.assignee.company_id,
+        'employee_id': task.assignee_id,
+        # rollup days are UTC days, as the database session works in UTC
+        'day': timezone.localtime(task.workflow.start_at, timezone.utc).date(),
+        'time_spent': get_time_spent(task),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(RECORD_EMPLOYEE_TASK_SQL, params)
+
+
+@atomic
+def rebuild_rollups():
+    '''
+    Recomputes the rollups from all completed tasks, and invalidates the cached reports of every company once the
+    rebuild commits.
+
+    Returns:
+        int -- number of rollups
+    '''
+
+    with connection.cursor() as cursor:
+        cursor.execute(REBUILD_ROLLUPS_SQL, {'complete': common_constant.TASK_STATUS.COMPLETE})
+    rollups = EmployeeTaskRollup.objects.count()
+    for company_id in Company.objects.values_list('id', flat=True):
+        bump_after_commit(company_id)
+
+    logger.info('%d employee rollups rebuilt' % rollups)
+    return rollups
@@ -5,7 +5,9 @@ from django.contrib.auth import get_user_model
 
 from rest_framework import serializers
 
+from apps.common import constant as common_constant
 from apps.company.models import UserCompany
+from apps.report import export
 from apps.workflow.models import Task, Workflow
 
 User = get_user_model()
@@ -46,6 +48,58 @@ class IJLEmployeeCountSerializer(serializers.Serializer):
     month = serializers.DateTimeField()
 
 
+class IJLEmployeeCountRangeSerializer(serializers.Serializer):
+    '''
+    Number of months counted by the employee count report, the current month included.
+    '''
+    months = serializers.IntegerField(
+        min_value=1,
+        max_value=common_constant.IJL_REPORT_MAX_MONTHS,
+        default=common_constant.IJL_REPORT_MONTHS
+    )
+
+
+class ReportRangeSerializer(serializers.Serializer):
+    '''
+    Time range of a report, open ended when start or end is missing.
+    '''
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+    def validate(self, data):
+        if data.get('start') and data.get('end') and data['start'] >= data['end']:
+            raise serializers.ValidationError('start must be before end')
+        return data
+
+
+class WorkflowBatchReportSerializer(serializers.Serializer):
+    '''
+    Comma separated ids of the workflows to report on.
+    '''
+    ids = serializers.CharField()
+
+    def validate_ids(self, value):
+        try:
+            ids = sorted(set(int(workflow_id) for workflow_id in value.split(',') if workflow_id.strip()))
+        except ValueError:
+            raise serializers.ValidationError('ids must be comma separated integers')
+        if not ids:
+            raise serializers.ValidationError('at least one id is required')
+        batch_size = common_constant.WORKFLOW_BATCH_REPORT_SIZE
+        if len(ids) > batch_size:
+            raise serializers.ValidationError(
+                'at most {count} workflows can be reported at once'.format(count=batch_size)
+            )
+        return ids
+
+
+class ReportExportSerializer(serializers.Serializer):
+    '''
+    Output of a report export, named output as format is taken by rest framework.
+    '''
+    output = serializers.ChoiceField(choices=(export.OUTPUT_CSV, export.OUTPUT_NDJSON), default=export.OUTPUT_CSV)
+
+
 class TopEmployeeSerializer(serializers.Serializer):
     employee = EmployeeBasicSerializer()
     avg_task_time = serializers.DurationField()
@@ -0,0 +1,33 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from apps.company.models import UserCompany
+from apps.history.helpers import get_history_scope
+from apps.report.cache import bump_after_commit
+from apps.workflow.models import Workflow, Task
+
+
+@receiver(post_save, sender=Workflow)
+@receiver(post_delete, sender=Workflow)
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+def invalidate_reports_on_workflow_change(sender, instance, **kwargs):
+    '''
+    invalidates the cached reports of the company of the workflow.
+    '''
+    if isinstance(instance, Workflow):
+        company_id = instance.creator.company_id
+    else:
+        workflow_id, company_id = get_history_scope(instance)
+    # None for tasks deleted along with their workflow, whose own deletion invalidates the reports
+    if company_id is not None:
+        bump_after_commit(company_id)
+
+
+@receiver(post_save, sender=UserCompany)
+@receiver(post_delete, sender=UserCompany)
+def invalidate_reports_on_employee_change(sender, instance, **kwargs):
+    '''
+    invalidates the cached reports of the company of the employee.
+    '''
+    bump_after_commit(instance.company_id)
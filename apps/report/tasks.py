@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from celery import shared_task
+import logging
+
+from django.contrib.auth import get_user_model
+from django.http import HttpRequest, QueryDict
+from django.utils.module_loading import import_string
+
+from rest_framework import status
+
+from apps.common import constant as common_constant
+from apps.report.cache import get_report_job, set_report_job
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def generate_report(job_id, view_path, user_id, query_string, kwargs):
+    '''
+    Computes a report queued with the async query param, going through the report view as a GET request of the user
+    so that permissions, validation and caching apply as for a synchronous request. The serialized result is stored in
+    the job until it expires.
+
+    Arguments:
+        job_id {str} -- id of the report job
+        view_path {str} -- dotted path of the report view class
+        user_id {int} -- id of the user who asked for the report
+        query_string {str} -- query params of the report
+        kwargs {dict} -- url kwargs of the view
+    '''
+
+    job = get_report_job(job_id)
+    if job is None:
+        logger.warning('Report job %s expired before it started' % job_id)
+        return
+    job['status'] = common_constant.REPORT_JOB_STATUS.RUNNING
+    set_report_job(job_id, job)
+
+    request = HttpRequest()
+    request.method = 'GET'
+    request.GET = QueryDict(query_string)
+    # picked up by rest framework in place of the authentication classes
+    request._force_auth_user = User.objects.get(id=user_id)
+
+    try:
+        response = import_string(view_path).as_view()(request, **kwargs)
+    except Exception:
+        logger.exception('Report job %s failed' % job_id)
+        job.update(status=common_constant.REPORT_JOB_STATUS.FAILED, status_code=500, result=None)
+    else:
+        job.update(
+            status=(
+                common_constant.REPORT_JOB_STATUS.COMPLETE if response.status_code == status.HTTP_200_OK
+                else common_constant.REPORT_JOB_STATUS.FAILED
+            ),
+            status_code=response.status_code,
+            result=response.data
+        )
+    set_report_job(job_id, job)
+    logger.info('Report job %s finished with status %s' % (job_id, job['status_code']))
@@ -1,6 +1,486 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from datetime import datetime, timedelta
+from importlib import import_module
+import json
+
+from django.apps import apps
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Avg, Max, Min, Sum
 from django.test import TestCase
+from django.utils import timezone
+from django.utils.dateparse import parse_duration
+
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from apps.common import constant as common_constant
+from apps.common.helper import add_months
+from apps.common.tests.tests import create_company, create_employee, create_task, create_workflow
+from apps.company.models import UserCompany
+from apps.report import rollups as report_rollups
+from apps.report.cache import get_cache_stats
+from apps.report.models import EmployeeTaskRollup
+from apps.report.rollups import get_time_spent, rebuild_rollups, record_task_completion
+from apps.report.tasks import generate_report
+from apps.report.views import build_employee_reports, build_workflow_reports, calculate_completed_tasks_time_spent
+from apps.workflow import tasks as workflow_tasks
+from apps.workflow.models import Task, Workflow
+
+
+class TopEmployeesReportTest(APITestCase):
+
+    def setUp(self):
+        company = create_company()
+        self.admin = create_employee(company, 'admin@t.com', is_admin=True)
+        self.employee = create_employee(company, 'employee@t.com')
+
+    def test_non_admin_is_forbidden(self):
+        self.client.force_authenticate(self.employee.user)
+
+        response = self.client.get(reverse('report:favourite-employees', args=['01']))
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_admin_is_allowed(self):
+        self.client.force_authenticate(self.admin.user)
+
+        response = self.client.get(reverse('report:favourite-employees', args=['01']))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_ranking_is_limited_to_the_fastest_employees(self):
+        now = timezone.now()
+        employees = [self.employee] + [
+            create_employee(self.admin.company, '{index}@t.com'.format(index=index)) for index in range(11)
+        ]
+        for index, employee in enumerate(reversed(employees)):
+            # workflows of the rollups and of the partial current day
+            start_at = now - timedelta(days=5 if index % 2 else 0, hours=1)
+            task = create_task(create_workflow(self.admin, start_at=start_at), employee)
+            task.completed_at = start_at + timedelta(minutes=index + 1)
+            task.status = common_constant.TASK_STATUS.COMPLETE
+            task.save()
+            record_task_completion(Task.objects.get(id=task.id))
+        self.client.force_authenticate(self.admin.user)
+
+        response = self.client.get(reverse('report:favourite-employees', args=['01']))
+
+        self.assertEqual([row['employee']['id'] for row in response.data], [
+            employee.id for employee in reversed(employees)
+        ][:10])
+        self.assertEqual(
+            [parse_duration(row['avg_task_time']) for row in response.data],
+            [timedelta(minutes=index + 1) for index in range(10)]
+        )
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class RollupReportTest(APITestCase):
+    '''
+    Reports read from the rollups give the figures aggregated from the tasks.
+    '''
+
+    start = utc(2026, 1, 10, 12)
+    end = utc(2026, 1, 20, 12)
+
+    def setUp(self):
+        company = create_company()
+        self.admin = create_employee(company, 'admin@t.com', is_admin=True)
+        self.employees = [create_employee(company, 'first@t.com'), create_employee(company, 'second@t.com')]
+        # workflows around the UTC day boundaries and the bounds of the range
+        starts = [
+            utc(2026, 1, 9, 23, 30), utc(2026, 1, 10, 6), utc(2026, 1, 10, 18), utc(2026, 1, 15),
+            utc(2026, 1, 20, 6), utc(2026, 1, 20, 18), utc(2026, 1, 21, 0, 30),
+        ]
+        for index, start_at in enumerate(starts):
+            workflow = create_workflow(self.admin, start_at=start_at)
+            for rank, employee in enumerate(self.employees):
+                parent_task = self.complete(create_task(
+                    workflow, employee, completed_at=start_at + timedelta(minutes=10 * (index + rank + 1))
+                ))
+                self.complete(create_task(
+                    workflow, employee, parent_task=parent_task,
+                    completed_at=parent_task.completed_at + timedelta(minutes=7 * (len(starts) - index) + rank)
+                ))
+        self.client.force_authenticate(self.admin.user)
+
+    def complete(self, task):
+        task.status = common_constant.TASK_STATUS.COMPLETE
+        task.save()
+        record_task_completion(Task.objects.get(id=task.id))
+        return task
+
+    def get_expected_top_employees(self):
+        averages = []
+        for employee in self.employees:
+            tasks = employee.tasks.filter(workflow__start_at__gt=self.start, workflow__start_at__lt=self.end)
+            averages.append((
+                calculate_completed_tasks_time_spent(tasks).aggregate(avg_time=Avg('time_spent'))['avg_time'],
+                employee.id
+            ))
+        return sorted(averages)
+
+    def get_top_employees(self):
+        response = self.client.get(reverse('report:favourite-employees-range'), {
+            'start': self.start.isoformat(),
+            'end': self.end.isoformat(),
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(parse_duration(row['avg_task_time']), row['employee']['id']) for row in response.data]
+
+    def test_top_employees_match_the_tasks_across_day_boundaries(self):
+        self.assertEqual(self.get_top_employees(), self.get_expected_top_employees())
+
+    def test_top_employees_match_the_tasks_after_a_rebuild(self):
+        rebuild_rollups()
+
+        self.assertEqual(self.get_top_employees(), self.get_expected_top_employees())
+
+    def get_rollups(self):
+        return sorted(EmployeeTaskRollup.objects.values_list(
+            'company_id', 'employee_id', 'day', 'completed_tasks', 'time_spent_sum', 'time_spent_min', 'time_spent_max'
+        ))
+
+    def test_migration_backfills_the_rollups(self):
+        rollups = self.get_rollups()
+        EmployeeTaskRollup.objects.all().delete()
+
+        import_module('apps.report.migrations.0001_initial').backfill_rollups(apps, connection.schema_editor())
+
+        self.assertEqual(self.get_rollups(), rollups)
+
+    def test_rebuild_invalidates_the_cached_reports(self):
+        # on_commit callbacks do not run in test transactions, the bumps are recorded instead
+        bumped_company_ids = []
+        original_bump_after_commit = report_rollups.bump_after_commit
+        report_rollups.bump_after_commit = bumped_company_ids.append
+        self.addCleanup(setattr, report_rollups, 'bump_after_commit', original_bump_after_commit)
+
+        rebuild_rollups()
+
+        self.assertEqual(bumped_company_ids, [self.admin.company_id])
+
+    def test_employee_report_matches_the_tasks(self):
+        for employee in self.employees:
+            expected = calculate_completed_tasks_time_spent(employee.tasks.all()).aggregate(
+                total=Sum('time_spent'), avg=Avg('time_spent'), min=Min('time_spent'), max=Max('time_spent')
+            )
+
+            response = self.client.get(reverse('report:employee-report', args=[employee.id]))
+
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual({
+                'total': parse_duration(response.data['total_time_spent_on_tasks']),
+                'avg': parse_duration(response.data['avg_time_spent_on_tasks']),
+                'min': parse_duration(response.data['min_time_spent_on_tasks']),
+                'max': parse_duration(response.data['max_time_spent_on_tasks']),
+            }, expected)
+
+
+class IJLEmployeeCountTest(APITestCase):
+
+    def setUp(self):
+        company = create_company()
+        current_month = add_months(timezone.localtime(timezone.now()).date(), 0)
+
+        def month(count):
+            month = add_months(current_month, count)
+            return timezone.make_aware(datetime(month.year, month.month, 1, 12))
+
+        self.admin = create_employee(company, 'admin@t.com', is_admin=True)
+        employees = [
+            (create_employee(company, 'first@t.com'), month(-1), month(-1), None),
+            (create_employee(company, 'second@t.com'), month(-2), month(0), month(0)),
+            (create_employee(company, 'old@t.com'), month(-5), month(-5), None),
+            (create_employee(create_company('other'), 'other@t.com'), month(0), month(0), None),
+        ]
+        for employee, created, join_at, left_at in employees:
+            UserCompany.objects.filter(id=employee.id).update(created=created, join_at=join_at, left_at=left_at)
+        self.client.force_authenticate(self.admin.user)
+
+    def test_monthly_counts(self):
+        response = self.client.get(reverse('report:ijl-employees'), {'months': 3})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        counts = {key: [row['count'] for row in rows] for key, rows in response.data.items()}
+        self.assertEqual(counts, {
+            'invited_users': [1, 1, 1],
+            'joined_users': [0, 1, 2],
+            'left_users': [0, 0, 1],
+        })
+
+    def test_months_are_limited(self):
+        response = self.client.get(reverse('report:ijl-employees'), {'months': 1000})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TimeSpentTest(TestCase):
+
+    def test_time_spent_expression_matches_the_task_chain(self):
+        employee = create_employee(create_company(), 'employee@t.com')
+        start_at = timezone.now().replace(microsecond=0)
+        workflow = create_workflow(employee, start_at)
+        first_task = create_task(
+            workflow, employee, start_delta=timedelta(minutes=10),
+            status=common_constant.TASK_STATUS.COMPLETE, completed_at=start_at + timedelta(hours=1)
+        )
+        second_task = create_task(
+            workflow, employee, first_task, start_delta=timedelta(minutes=20),
+            status=common_constant.TASK_STATUS.COMPLETE, completed_at=start_at + timedelta(hours=3)
+        )
+        create_task(workflow, employee, second_task)
+
+        times_spent = dict(calculate_completed_tasks_time_spent(Task.objects.all()).values_list('id', 'time_spent'))
+
+        self.assertEqual(times_spent, {
+            first_task.id: timedelta(minutes=50),
+            second_task.id: timedelta(hours=1, minutes=40),
+        })
+        for task in Task.objects.filter(id__in=times_spent):
+            self.assertEqual(get_time_spent(task), times_spent[task.id])
+
+
+class EmployeeReportTest(TestCase):
+
+    def setUp(self):
+        company = create_company()
+        self.admin = create_employee(company, 'admin@t.com', is_admin=True)
+        self.employees = [create_employee(company, 'first@t.com'), create_employee(company, 'second@t.com')]
+        self.start_at = timezone.now().replace(microsecond=0) - timedelta(days=2)
+        self.workflows = [create_workflow(self.admin, self.start_at, name=name) for name in ('first', 'second')]
+        Workflow.objects.filter(id=self.workflows[0].id).update(
+            status=common_constant.WORKFLOW_STATUS.COMPLETE, completed_at=self.start_at + timedelta(hours=5)
+        )
+        self.tasks = [
+            self.complete(create_task(self.workflows[0], self.employees[0]), timedelta(hours=2)),
+            create_task(self.workflows[0], self.employees[1]),
+            self.complete(create_task(self.workflows[1], self.employees[0]), timedelta(hours=3)),
+            create_task(self.workflows[1], self.employees[0]),
+        ]
+
+    def complete(self, task, time_spent):
+        task.status = common_constant.TASK_STATUS.COMPLETE
+        task.completed_at = self.start_at + time_spent
+        task.save()
+        record_task_completion(Task.objects.get(id=task.id))
+        return task
+
+    def test_reports_are_built_in_three_queries(self):
+        employees = list(self.employees)
+
+        with self.assertNumQueries(3):
+            first_report, second_report = build_employee_reports(employees)
+
+        self.assertEqual(first_report['number_of_workflows_assigned'], 2)
+        self.assertEqual(first_report['number_of_tasks'], 3)
+        self.assertEqual(
+            [(row['workflow'].id, row['total_time_spent']) for row in first_report['time_spent_on_workflows']],
+            [(self.workflows[0].id, timedelta(hours=2)), (self.workflows[1].id, timedelta(hours=3))]
+        )
+        self.assertEqual(first_report['total_time_spent_on_tasks'], timedelta(hours=5))
+        self.assertEqual(first_report['last_task_completed'].id, self.tasks[2].id)
+        self.assertEqual(first_report['last_workflow_completed'].id, self.workflows[0].id)
+
+        self.assertEqual(second_report['number_of_tasks'], 1)
+        self.assertEqual(second_report['time_spent_on_workflows'], [])
+        self.assertEqual(second_report['total_time_spent_on_tasks'], timedelta(0))
+        self.assertIsNone(second_report['last_task_completed'])
+
+
+class WorkflowReportTest(APITestCase):
+
+    def setUp(self):
+        company = create_company()
+        self.admin = create_employee(company, 'admin@t.com', is_admin=True)
+        self.employees = [create_employee(company, '{index}@t.com'.format(index=index)) for index in range(3)]
+        self.start_at = timezone.now().replace(microsecond=0) - timedelta(days=1)
+        self.workflow = create_workflow(self.admin, self.start_at, status=common_constant.WORKFLOW_STATUS.INPROGRESS)
+        completed_at = self.start_at
+        parent_task = None
+        for employee, hours in zip(self.employees, (2, 1, 3)):
+            completed_at += timedelta(hours=hours)
+            parent_task = create_task(
+                self.workflow, employee, parent_task,
+                status=common_constant.TASK_STATUS.COMPLETE, completed_at=completed_at
+            )
+        create_task(self.workflow, self.employees[0], parent_task)
+        self.empty_workflow = create_workflow(self.admin, name='empty')
+
+    def test_min_and_max_assignees(self):
+        report, empty_report = build_workflow_reports([self.workflow, self.empty_workflow])
+
+        self.assertEqual(report['number_of_tasks'], 4)
+        self.assertEqual(report['number_of_assignees'], 3)
+        self.assertEqual(report['average_task_complete_time'], timedelta(hours=2))
+        self.assertEqual(report['assingee_with_min_time']['assignee'].id, self.employees[1].id)
+        self.assertEqual(report['assingee_with_min_time']['time'], timedelta(hours=1))
+        self.assertEqual(report['assingee_with_max_time']['assignee'].id, self.employees[2].id)
+        self.assertEqual(report['assingee_with_max_time']['time'], timedelta(hours=3))
+        self.assertEqual(empty_report['number_of_tasks'], 0)
+        self.assertIsNone(empty_report['assingee_with_min_time'])
+
+    def test_batch_report_matches_single_reports(self):
+        self.client.force_authenticate(self.admin.user)
+        single_reports = [
+            self.client.get(reverse('report:workflow-report', args=[workflow.id])).data
+            for workflow in (self.workflow, self.empty_workflow)
+        ]
+
+        response = self.client.get(reverse('report:workflow-batch-report'), {
+            'ids': '{},{}'.format(self.empty_workflow.id, self.workflow.id)
+        })
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # total_time_spend of workflows in progress runs until now
+        for report in single_reports + response.data:
+            report.pop('total_time_spend')
+        self.assertEqual(response.data, single_reports)
+
+
+class ReportCacheInvalidationTest(TestCase):
+    '''
+    Bulk status updates, which send no post_save, invalidate the cached reports of their companies.
+    '''
+
+    def setUp(self):
+        self.company = create_company()
+        self.employee = create_employee(self.company, 'admin@t.com', is_admin=True)
+        # on_commit callbacks do not run in test transactions, the bumps are recorded instead
+        self.bumped_company_ids = []
+        original_bump_after_commit = workflow_tasks.bump_after_commit
+        workflow_tasks.bump_after_commit = self.bumped_company_ids.append
+        self.addCleanup(setattr, workflow_tasks, 'bump_after_commit', original_bump_after_commit)
+
+    def test_scheduling_workflows_invalidates_reports(self):
+        workflow = create_workflow(self.employee, start_at=timezone.now() + timedelta(minutes=30))
+
+        workflow_tasks.start_workflows_periodic()
+
+        self.assertEqual(Workflow.objects.get(id=workflow.id).status, common_constant.WORKFLOW_STATUS.SCHEDULED)
+        self.assertEqual(self.bumped_company_ids, [self.company.id])
+
+    def test_scheduling_tasks_invalidates_reports(self):
+        workflow = create_workflow(self.employee, status=common_constant.WORKFLOW_STATUS.INPROGRESS)
+        tasks = [create_task(workflow, self.employee), create_task(workflow, self.employee)]
+        Task.objects.filter(id__in=[task.id for task in tasks]).update(
+            expected_start_at=timezone.now() + timedelta(minutes=30)
+        )
+
+        fire_times = workflow_tasks.schedule_tasks_helper()
+
+        self.assertEqual(sorted(task_id for task_id, _ in fire_times), [task.id for task in tasks])
+        self.assertEqual(self.bumped_company_ids, [self.company.id])
+
+    def test_nothing_scheduled_invalidates_nothing(self):
+        workflow_tasks.start_workflows_periodic()
+        workflow_tasks.schedule_tasks_helper()
+
+        self.assertEqual(self.bumped_company_ids, [])
+
+
+class ReportExportTest(APITestCase):
+
+    def setUp(self):
+        company = create_company()
+        self.admin = create_employee(company, 'admin@t.com', is_admin=True)
+        self.employee = create_employee(company, 'employee@t.com')
+        self.workflows = [create_workflow(self.admin, name='first'), create_workflow(self.admin, name='second')]
+        create_task(self.workflows[0], self.employee)
+        other_company_admin = create_employee(create_company('other'), 'other@t.com', is_admin=True)
+        create_workflow(other_company_admin, name='other')
+        self.client.force_authenticate(self.admin.user)
+
+    def export(self, report, output):
+        response = self.client.get(reverse('report:report-export', args=[report]), {'output': output})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response['Content-Disposition'],
+            'attachment; filename="{report}.{output}"'.format(report=report, output=output)
+        )
+        return b''.join(response.streaming_content).decode('utf-8').splitlines()
+
+    def test_workflow_report_is_exported_as_json_lines(self):
+        rows = [json.loads(line) for line in self.export('workflow-report', 'ndjson')]
+
+        self.assertEqual([(row['id'], row['name']) for row in rows], [
+            (workflow.id, workflow.name) for workflow in self.workflows
+        ])
+        self.assertEqual([row['number_of_tasks'] for row in rows], [1, 0])
+
+    def test_employee_report_is_exported_as_csv(self):
+        lines = self.export('employee-report', 'csv')
+
+        header = lines[0].split(',')
+        self.assertEqual(header[:2], ['id', 'first_name'])
+        emails = [line.split(',')[header.index('email')] for line in lines[1:]]
+        self.assertEqual(emails, ['admin@t.com', 'employee@t.com'])
+
+    def test_non_admin_is_forbidden(self):
+        self.client.force_authenticate(self.employee.user)
+
+        response = self.client.get(reverse('report:report-export', args=['workflow-report']))
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ReportJobTest(APITestCase):
+
+    def setUp(self):
+        self.admin = create_employee(create_company(), 'admin@t.com', is_admin=True)
+        self.client.force_authenticate(self.admin.user)
+        # the worker runs in the test process
+        conf = generate_report.app.conf
+        original_always_eager = conf.task_always_eager
+        conf.task_always_eager = True
+        self.addCleanup(setattr, conf, 'task_always_eager', original_always_eager)
+
+    def test_async_report_is_computed_by_a_worker(self):
+        response = self.client.get(reverse('report:ijl-employees'), {'months': 2, 'async': 1})
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], common_constant.REPORT_JOB_STATUS.PENDING)
+
+        job_response = self.client.get(response.data['url'])
+        self.assertEqual(job_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(job_response.data['status'], common_constant.REPORT_JOB_STATUS.COMPLETE)
+        self.assertEqual(job_response.data['status_code'], status.HTTP_200_OK)
+
+        report_response = self.client.get(reverse('report:ijl-employees'), {'months': 2})
+        self.assertEqual(report_response.data, job_response.data['result'])
+        # the worker cached the report, the synchronous request reads it
+        self.assertEqual(get_cache_stats()['hits'], 1)
+
+    def test_completed_jobs_are_served_from_the_cache(self):
+        job_ids = [
+            self.client.get(reverse('report:favourite-employees', args=['01']), {'async': 1}).data['job_id'],
+            self.client.get(reverse('report:favourite-employees', args=['03']), {'async': 1}).data['job_id'],
+        ]
+        # the first job is complete, its report is served from the cache
+        response = self.client.get(reverse('report:favourite-employees', args=['01']), {'async': 1})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(job_ids[0], job_ids[1])
+
+    def test_job_of_other_company_is_not_found(self):
+        response = self.client.get(reverse('report:ijl-employees'), {'async': 1})
+        other_admin = create_employee(create_company('other'), 'other@t.com', is_admin=True)
+        self.client.force_authenticate(other_admin.user)
+
+        job_response = self.client.get(response.data['url'])
+
+        self.assertEqual(job_response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cache_stats(self):
+        self.client.get(reverse('report:ijl-employees'))
+        self.client.get(reverse('report:ijl-employees'))
+
+        response = self.client.get(reverse('report:report-cache-stats'))
 
-# Create your tests here.
+        self.assertEqual(response.data, {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
@@ -2,7 +2,8 @@ from django.conf.urls import url
 
 from rest_framework import routers
 
-from apps.report.views import IJLEmployeeCount, EmployeeReport, WorkflowReport, TopEmployeesReport
+from apps.report.views import IJLEmployeeCount, EmployeeReport, WorkflowReport, WorkflowBatchReport, TopEmployeesReport
+from apps.report.views import ReportCacheStats, ReportJobStatus, ReportExport
 
 router = routers.SimpleRouter()
 
@@ -12,5 +13,10 @@ urlpatterns += [
     url(r'^ijl-employees', IJLEmployeeCount.as_view(), name='ijl-employees'),
     url(r'^employee-report/(?P<pk>[0-9]+)/$', EmployeeReport.as_view(), name='employee-report'),
     url(r'^workflow-report/(?P<pk>[0-9]+)/$', WorkflowReport.as_view(), name='workflow-report'),
+    url(r'^workflow-report/$', WorkflowBatchReport.as_view(), name='workflow-batch-report'),
+    url(r'^(?P<report>employee-report|workflow-report)/export/$', ReportExport.as_view(), name='report-export'),
     url(r'^favourite-employees/(?P<duration>(01|03|12))/$', TopEmployeesReport.as_view(), name='favourite-employees'),
+    url(r'^favourite-employees/$', TopEmployeesReport.as_view(), name='favourite-employees-range'),
+    url(r'^report-cache-stats/$', ReportCacheStats.as_view(), name='report-cache-stats'),
+    url(r'^report-jobs/(?P<job_id>[0-9a-f]{32})/$', ReportJobStatus.as_view(), name='report-job'),
 ]
@@ -1,68 +1,131 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from datetime import datetime, timedelta
+import collections
+from datetime import datetime, time, timedelta
 import functools
-from itertools import chain
 import logging
 
 from django.contrib.auth import get_user_model
-from django.db.models import ExpressionWrapper, F, Count, Sum, Avg, Max, Min, DurationField
-from django.db.models import functions as db_functions
+from django.db import connection
+from django.http import StreamingHttpResponse
+from django.db.models import ExpressionWrapper, F, Count, Sum, Max, Min, DurationField, Case, When
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
-from rest_framework import generics, mixins, response, status, views, viewsets
+from rest_framework import generics, status, views
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
 
 from apps.common import constant as common_constant
+from apps.common.helper import add_months
 from apps.company.models import UserCompany
 from apps.workflow.models import Workflow, Task
+from apps.report import export
+from apps.report.cache import cached_report, get_cache_stats, get_report_job, get_report_job_data
+from apps.report.models import EmployeeTaskRollup
 from apps.report.permissions import IsCompanyAdmin
-from apps.report.serializers import IJLEmployeeCountSerializer, EmployeeReportSerializer
-from apps.report.serializers import WorkflowReportSerializer, TopEmployeeSerializer
+from apps.report.serializers import IJLEmployeeCountSerializer, IJLEmployeeCountRangeSerializer
+from apps.report.serializers import EmployeeReportSerializer
+from apps.report.serializers import WorkflowReportSerializer, TopEmployeeSerializer, ReportRangeSerializer
+from apps.report.serializers import WorkflowBatchReportSerializer, ReportExportSerializer
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
-DIFF_EXPR_NO_PARENT = ExpressionWrapper(
-    F('completed_at') - F('workflow__start_at') - F('start_delta'),
+# time spent on a task, null until it is completed. A task starts after the completion of its parent, the first task
+# of a workflow with the workflow, the parent being joined with a LEFT JOIN. Usable in annotate and aggregates, so
+# that reports group and aggregate tasks in a single scan.
+TIME_SPENT_EXPR = Case(
+    When(
+        status=common_constant.TASK_STATUS.COMPLETE,
+        then=ExpressionWrapper(
+            F('completed_at') - Coalesce(F('parent_task__completed_at'), F('workflow__start_at')) - F('start_delta'),
+            output_field=DurationField()
+        )
+    ),
     output_field=DurationField()
 )
-DIFF_EXPR_HAS_PARENT = ExpressionWrapper(
-    F('completed_at') - F('parent_task__completed_at') - F('start_delta'),
-    output_field=DurationField()
+TOP_EMPLOYEES_COUNT = 10
+
+
+# invitations, joins and departures of the employees of a company counted per month in one scan, every employee
+# giving one event per date it has. Months are truncated in the current time zone, like TruncMonth does, and the
+# month series is zero-filled by the outer join.
+IJL_EMPLOYEE_COUNT_SQL = '''
+WITH months AS (
+    SELECT generate_series(%(first_month)s::timestamp, %(last_month)s::timestamp, interval '1 month') AS month
+), employee_event AS (
+    SELECT event.kind, date_trunc('month', event.happened_at AT TIME ZONE %(time_zone)s) AS month
+    FROM {employee_table} AS employee
+        CROSS JOIN LATERAL (VALUES
+            ('invited', employee.created), ('joined', employee.join_at), ('left', employee.left_at)
+        ) AS event (kind, happened_at)
+    WHERE employee.company_id = %(company_id)s AND event.happened_at >= %(since)s
 )
+SELECT
+    months.month,
+    COUNT(employee_event.kind) FILTER (WHERE employee_event.kind = 'invited') AS invited_count,
+    COUNT(employee_event.kind) FILTER (WHERE employee_event.kind = 'joined') AS joined_count,
+    COUNT(employee_event.kind) FILTER (WHERE employee_event.kind = 'left') AS left_count
+FROM months
+    LEFT OUTER JOIN employee_event ON employee_event.month = months.month
+GROUP BY months.month
+ORDER BY months.month
+'''.format(employee_table=UserCompany._meta.db_table)
 
 
 class IJLEmployeeCount(generics.GenericAPIView):
-    queryset = UserCompany.objects.all()
     serializer_class = IJLEmployeeCountSerializer
     permission_classes = (IsCompanyAdmin,)
 
-    def get_queryset(self):
-        company = self.request.user.company
-        return self.queryset.filter(company=company)
+    def get_months(self):
+        '''
+        Returns the first day of every month of the report window, the current month being the last one.
+        '''
+        serializer = IJLEmployeeCountRangeSerializer(data=self.request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        current_month = add_months(timezone.localtime(timezone.now()).date(), 0)
+        return [add_months(current_month, -count) for count in reversed(range(serializer.validated_data['months']))]
+
+    def get_monthly_counts(self, months):
+        '''
+        Returns the number of employees invited, joined and left in each month, with a single query.
+
+        Arguments:
+            months {list} -- first day of the months to count, oldest first
 
-    def get_monthly_count_data(self, employees):
-        data = employees.annotate(
-            month=db_functions.TruncMonth('join_at')
-        ).values('month').annotate(count=Count('id')).values('count', 'month')
-        return self.get_serializer(data, many=True).data
+        Returns:
+            list -- (month, invited, joined, left) tuples, one per month
+        '''
+        first_month = datetime(months[0].year, months[0].month, 1)
+        with connection.cursor() as cursor:
+            cursor.execute(IJL_EMPLOYEE_COUNT_SQL, {
+                'first_month': first_month,
+                'last_month': datetime(months[-1].year, months[-1].month, 1),
+                'time_zone': timezone.get_current_timezone_name(),
+                'company_id': self.request.user.company.id,
+                'since': timezone.make_aware(first_month),
+            })
+            return [
+                (timezone.make_aware(month), invited, joined, left)
+                for month, invited, joined, left in cursor.fetchall()
+            ]
 
+    @cached_report('ijl-employees')
     def get(self, request, format=None):
         '''
-        Returns number of users invited, joined and left company within 12 months (month wise)
+        Returns number of users invited, joined and left company within the last months (month wise), 12 by default
         '''
-        employees = self.get_queryset()
-        past_12_months = timezone.now() - timedelta(days=365)
+        monthly_counts = self.get_monthly_counts(self.get_months())
         response_data = {}
 
-        # users who were invited to the company
-        response_data['invited_users'] = self.get_monthly_count_data(employees.filter(created__gt=past_12_months))
-        # users who joined the company
-        response_data['joined_users'] = self.get_monthly_count_data(employees.filter(join_at__gt=past_12_months))
-        # users who left the company
-        response_data['left_users'] = self.get_monthly_count_data(employees.filter(left_at__gt=past_12_months))
+        for key, index in (('invited_users', 1), ('joined_users', 2), ('left_users', 3)):
+            response_data[key] = self.get_serializer(
+                [{'month': counts[0], 'count': counts[index]} for counts in monthly_counts],
+                many=True
+            ).data
 
         return Response(response_data, status=status.HTTP_200_OK)
 
@@ -70,50 +133,267 @@ class IJLEmployeeCount(generics.GenericAPIView):
 class TopEmployeesReport(generics.GenericAPIView):
     queryset = UserCompany.objects.all()
     serializer_class = TopEmployeeSerializer
-    permisssion_classes = (IsCompanyAdmin,)
+    permission_classes = (IsCompanyAdmin,)
 
     def get_queryset(self):
         return self.queryset.filter(company=self.request.user.company)
 
-    def get(self, request, duration, format=None):
+    def get_range(self, duration):
+        '''
+        Returns the (start, end) range of the workflows start time, the last duration months when given in the url,
+        else the start and end query params.
+        '''
+        if duration is not None:
+            return timezone.now() - timedelta(days=30*int(duration)), None
+
+        serializer = ReportRangeSerializer(data=self.request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data.get('start'), serializer.validated_data.get('end')
+
+    @cached_report('favourite-employees')
+    def get(self, request, duration=None, format=None):
         '''
-        Returns the details of 10 favourite employees.
+        Returns the details of 10 favourite employees, those with the least average time spent on completed tasks.
         '''
-        duration = int(duration)
-        start_time = timezone.now() - timedelta(days=30*duration)
-        employees = self.get_queryset()
-
-        avg_task_time_employees = []
-        for employee in employees.all():
-            avg_task_time = self.completed_tasks_avg_time(employee.tasks.filter(workflow__start_at__gt=start_time))
-            if avg_task_time:
-                avg_task_time_employees.append({
-                    'employee': employee,
-                    'avg_task_time': avg_task_time
-                })
-        avg_task_time_employees = sorted(avg_task_time_employees, key=lambda k: k['avg_task_time'])
-
-        serializer = self.get_serializer(avg_task_time_employees[:10], many=True)
+        start, end = self.get_range(duration)
+        top_employees = get_top_employees(request.user.company.id, start, end)
+        employees = self.get_queryset().select_related('user').in_bulk(
+            [employee_id for employee_id, _ in top_employees]
+        )
+
+        serializer = self.get_serializer([
+            {'employee': employees[employee_id], 'avg_task_time': avg_task_time}
+            for employee_id, avg_task_time in top_employees
+        ], many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
-    def completed_tasks_avg_time(self, tasks):
-        return calculate_completed_tasks_time_spent(tasks).aggregate(avg_time=Avg('time_spent'))['avg_time']
+
+# average time spent on their completed tasks by the employees of a company whose workflows started in a range, the
+# lowest averages first. Rollups are kept by UTC day of the workflows start, so the days lying entirely in the range
+# are read from the rollups and the partial days at its bounds from the tasks.
+TOP_EMPLOYEES_SQL = '''
+SELECT completed_task.employee_id, SUM(completed_task.time_spent) / SUM(completed_task.completed_tasks) AS avg_time
+FROM (
+    SELECT rollup.employee_id, rollup.completed_tasks, rollup.time_spent_sum AS time_spent
+    FROM {rollup_table} AS rollup
+    WHERE rollup.company_id = %(company_id)s {rollup_range}
+    UNION ALL
+    SELECT
+        task.assignee_id,
+        1,
+        task.completed_at - COALESCE(parent_task.completed_at, workflow.start_at) - task.start_delta
+    FROM {task_table} AS task
+        INNER JOIN {workflow_table} AS workflow ON workflow.id = task.workflow_id
+        INNER JOIN {employee_table} AS employee ON employee.id = task.assignee_id
+        LEFT OUTER JOIN {task_table} AS parent_task ON parent_task.id = task.parent_task_id
+    WHERE employee.company_id = %(company_id)s AND task.status = %(complete)s {task_range}
+) AS completed_task
+GROUP BY completed_task.employee_id
+ORDER BY avg_time, completed_task.employee_id
+LIMIT %(count)s
+'''
+
+
+def get_utc_midnight(day):
+    return datetime.combine(day, time()).replace(tzinfo=timezone.utc)
+
+
+def get_top_employees(company_id, start, end, count=TOP_EMPLOYEES_COUNT):
+    '''
+    Returns the employees of the company with the least average time spent on the tasks they completed in the
+    workflows started after start and before end, ranked and limited by the database in a single query.
+
+    Arguments:
+        company_id {int} -- id of the company
+        start {datetime} -- start of the range, open when None
+        end {datetime} -- end of the range, open when None
+
+    Keyword Arguments:
+        count {int} -- number of employees (default: {TOP_EMPLOYEES_COUNT})
+
+    Returns:
+        list -- (employee id, average time spent) tuples, lowest average first
+    '''
+    params = {
+        'company_id': company_id,
+        'complete': common_constant.TASK_STATUS.COMPLETE,
+        'count': count,
+    }
+    rollup_range = []
+    # tasks are only read for the partial days at the bounds of the range
+    task_range = ['false'] if start is None and end is None else []
+    partial_days = []
+    if start is not None:
+        params['first_day'] = timezone.localtime(start, timezone.utc).date() + timedelta(days=1)
+        params['start'] = start
+        params['first_midnight'] = get_utc_midnight(params['first_day'])
+        rollup_range.append('rollup.day >= %(first_day)s')
+        task_range.append('workflow.start_at > %(start)s')
+        partial_days.append('workflow.start_at < %(first_midnight)s')
+    if end is not None:
+        params['last_day'] = timezone.localtime(end, timezone.utc).date()
+        params['end'] = end
+        params['last_midnight'] = get_utc_midnight(params['last_day'])
+        rollup_range.append('rollup.day < %(last_day)s')
+        task_range.append('workflow.start_at < %(end)s')
+        partial_days.append('workflow.start_at >= %(last_midnight)s')
+    if partial_days:
+        task_range.append('({})'.format(' OR '.join(partial_days)))
+
+    sql = TOP_EMPLOYEES_SQL.format(
+        rollup_table=EmployeeTaskRollup._meta.db_table,
+        task_table=Task._meta.db_table,
+        workflow_table=Workflow._meta.db_table,
+        employee_table=UserCompany._meta.db_table,
+        rollup_range=''.join(' AND ' + condition for condition in rollup_range),
+        task_range=''.join(' AND ' + condition for condition in task_range)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
 
 
 def calculate_completed_tasks_time_spent(tasks):
-    first_tasks_completed = tasks.filter(
-        parent_task__isnull=True,
-        status=common_constant.TASK_STATUS.COMPLETE
+    '''
+    Returns the completed tasks annotated with their time_spent, as a plain queryset which can still be filtered,
+    grouped with values() and aggregated.
+    '''
+    return tasks.filter(status=common_constant.TASK_STATUS.COMPLETE).annotate(time_spent=TIME_SPENT_EXPR)
+
+
+def get_employees_workflows(employee_ids):
+    '''
+    Returns the workflows the employees have tasks in, with the time spent on their completed tasks and the number of
+    these tasks, in a single query grouped by employee and workflow.
+
+    Arguments:
+        employee_ids {list} -- ids of the employees
+
+    Returns:
+        dict -- workflows of every employee by employee id, as dicts
+    '''
+    workflows = Task.objects.filter(assignee__in=employee_ids).values(
+        'assignee', 'workflow', 'workflow__name', 'workflow__status', 'workflow__completed_at'
+    ).annotate(
+        number_of_tasks=Count('id'),
+        total_time_spent=Sum(TIME_SPENT_EXPR)
+    ).order_by('assignee', 'workflow')
+
+    employees_workflows = collections.defaultdict(list)
+    for instance in workflows:
+        employees_workflows[instance['assignee']].append(dict(instance, workflow=Workflow(
+            id=instance['workflow'],
+            name=instance['workflow__name'],
+            status=instance['workflow__status'],
+            completed_at=instance['workflow__completed_at']
+        )))
+    return employees_workflows
+
+
+def get_employees_tasks_rollup(employee_ids):
+    '''
+    Returns the number and times of the completed tasks of the employees, summed from their rollups in a single query.
+
+    Returns:
+        dict -- aggregates of every employee by employee id
+    '''
+    rollups = EmployeeTaskRollup.objects.filter(employee__in=employee_ids).values('employee').annotate(
+        completed_tasks=Sum('completed_tasks'),
+        total_time=Sum('time_spent_sum'),
+        min_time=Min('time_spent_min'),
+        max_time=Max('time_spent_max')
+    ).order_by()
+    return {rollup['employee']: rollup for rollup in rollups}
+
+
+def get_employees_last_task_completed(employee_ids):
+    '''
+    Returns the last task completed by each of the employees, in a single query.
+
+    Returns:
+        dict -- tasks by assignee id
+    '''
+    tasks = Task.objects.filter(assignee__in=employee_ids, completed_at__isnull=False).order_by(
+        'assignee', '-completed_at'
+    ).distinct('assignee')
+    return {task.assignee_id: task for task in tasks}
+
+
+def get_workflows_completed_monthly(workflows, since):
+    workflows_completed = collections.Counter(
+        instance['workflow'].completed_at.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        for instance in workflows
+        if instance['workflow'].status == common_constant.WORKFLOW_STATUS.COMPLETE and
+        instance['workflow'].completed_at and instance['workflow'].completed_at > since
     )
-    other_tasks_completed = tasks.filter(
-        parent_task__isnull=False,
-        status=common_constant.TASK_STATUS.COMPLETE
+    return [{'month': month, 'count': count} for month, count in sorted(workflows_completed.iteritems())]
+
+
+def build_employee_report(employee, workflows, tasks_rollup, last_task_completed):
+    '''
+    Returns the report data of the employee from its workflows, the rollup of its tasks and its last completed task.
+    '''
+    past_12_months = timezone.now() - timedelta(days=365)
+
+    workflows_time = [
+        {'workflow': instance['workflow'], 'total_time_spent': instance['total_time_spent']}
+        for instance in workflows if instance['total_time_spent'] is not None
+    ]
+    times_spent_on_worflows = [x['total_time_spent'] for x in workflows_time] or [timedelta(0)]
+    workflows_completed = [
+        instance['workflow'] for instance in workflows if instance['workflow'].completed_at is not None
+    ]
+
+    data = {
+        'first_name': employee.user.first_name,
+        'last_name': employee.user.last_name,
+        'email': employee.user.email,
+        'time_spent_on_workflows': workflows_time
+    }
+
+    data['number_of_workflows_assigned'] = len(workflows)
+    data['number_of_tasks'] = sum(instance['number_of_tasks'] for instance in workflows)
+    data['total_time_spent_on_tasks'] = tasks_rollup.get('total_time') or timedelta(0)
+    data['avg_time_spent_on_tasks'] = data['total_time_spent_on_tasks'] / (tasks_rollup.get('completed_tasks') or 1)
+    data['min_time_spent_on_tasks'] = tasks_rollup.get('min_time') or timedelta(0)
+    data['max_time_spent_on_tasks'] = tasks_rollup.get('max_time') or timedelta(0)
+    data['total_time_spent_on_workflows'] = functools.reduce(
+        lambda a, b: a+b['total_time_spent'], workflows_time, timedelta(0)
     )
-
-    first_tasks_time = first_tasks_completed.annotate(time_spent=DIFF_EXPR_NO_PARENT)
-    other_tasks_time = other_tasks_completed.annotate(time_spent=DIFF_EXPR_HAS_PARENT)
-
-    return first_tasks_time.union(other_tasks_time)
+    data['avg_time_spent_on_workflows'] = data['total_time_spent_on_workflows']/max(len(workflows_time), 1)
+    data['max_time_spent_on_workflows'] = max(times_spent_on_worflows)
+    data['min_time_spent_on_workflows'] = min(times_spent_on_worflows)
+    data['last_task_completed'] = last_task_completed
+    data['last_workflow_completed'] = max(
+        workflows_completed, key=lambda workflow: workflow.completed_at
+    ) if workflows_completed else None
+    data['workflows_completed_monthly'] = get_workflows_completed_monthly(workflows, past_12_months)
+    return data
+
+
+def build_employee_reports(employees):
+    '''
+    Returns the report data of the employees, in three queries whatever their number.
+
+    Arguments:
+        employees {list} -- UserCompany instances, with their users loaded
+
+    Returns:
+        list -- report data of every employee, in the order of the employees
+    '''
+    employee_ids = [employee.id for employee in employees]
+    employees_workflows = get_employees_workflows(employee_ids)
+    employees_tasks_rollup = get_employees_tasks_rollup(employee_ids)
+    employees_last_task_completed = get_employees_last_task_completed(employee_ids)
+
+    return [
+        build_employee_report(
+            employee,
+            employees_workflows.get(employee.id, []),
+            employees_tasks_rollup.get(employee.id, {}),
+            employees_last_task_completed.get(employee.id)
+        ) for employee in employees
+    ]
 
 
 class EmployeeReport(generics.RetrieveAPIView):
@@ -121,139 +401,253 @@ class EmployeeReport(generics.RetrieveAPIView):
     permission_classes = (IsCompanyAdmin,)
     serializer_class = EmployeeReportSerializer
 
-    def insert_workflow(self, objs):
-        workflow_ids = [instance['workflow'] for instance in objs]
-        workflows = Workflow.objects.filter(id__in=workflow_ids).order_by('id')
-
-        for idx, instance in enumerate(objs):
-            instance['workflow'] = workflows[idx]
-
-    def get_workflows_time(self, tasks):
-        workflows_first_tasks_time = tasks.filter(
-            parent_task__isnull=True,
-            status=common_constant.TASK_STATUS.COMPLETE
-        ).values('workflow').annotate(total_time_spent=Sum(DIFF_EXPR_NO_PARENT))
-        workflows_other_tasks_time = tasks.filter(
-            parent_task__isnull=False,
-            status=common_constant.TASK_STATUS.COMPLETE
-        ).values('workflow').annotate(total_time_spent=Sum(DIFF_EXPR_HAS_PARENT))
-
-        workflows_time = {}
-        for instance in workflows_first_tasks_time:
-            workflows_time[instance['workflow']] = instance['total_time_spent']
-
-        for instance in workflows_other_tasks_time:
-            workflows_time[instance['workflow']] = instance['total_time_spent'] + workflows_time.get(
-                instance['workflow'], timedelta(0)
-            )
-
-        data = []
-        for key, value in workflows_time.iteritems():
-            data.append({
-                'workflow': key,
-                'total_time_spent': value
-            })
-
-        data = sorted(data, key=lambda k: k['workflow'])
-        return data
+    def get_queryset(self):
+        return self.queryset.select_related('user')
 
+    @cached_report('employee-report')
     def retrieve(self, request, *args, **kwargs):
         '''
-        override to serializer more user data
+        override to serializer more user data, the report takes three queries besides the employee.
         '''
         employee = self.get_object()
-        past_12_months = timezone.now() - timedelta(days=365)
-
-        tasks_associated = Task.objects.filter(assignee=employee)
-        tasks_time = calculate_completed_tasks_time_spent(tasks_associated)
-
-        workflows_associated = Workflow.objects.filter(tasks__assignee=employee).distinct()
-        workflows_time = self.get_workflows_time(tasks_associated)
-        self.insert_workflow(workflows_time)
-        times_spent_on_worflows = [x['total_time_spent'] for x in workflows_time] or [timedelta(0)]
-
-        data = {
-            'first_name': employee.user.first_name,
-            'last_name': employee.user.last_name,
-            'email': employee.user.email,
-            'time_spent_on_workflows': workflows_time
-        }
-
-        data['number_of_workflows_assigned'] = workflows_associated.count()
-        data['number_of_tasks'] = tasks_associated.count()
-        data['total_time_spent_on_tasks'] = tasks_time.aggregate(total_time=Sum('time_spent'))[
-            'total_time'] or timedelta(0)
-        data['avg_time_spent_on_tasks'] = tasks_time.aggregate(avg_time=Avg('time_spent'))['avg_time'] or timedelta(0)
-        data['min_time_spent_on_tasks'] = tasks_time.aggregate(min_time=Min('time_spent'))['min_time'] or timedelta(0)
-        data['max_time_spent_on_tasks'] = tasks_time.aggregate(max_time=Max('time_spent'))['max_time'] or timedelta(0)
-        data['total_time_spent_on_workflows'] = functools.reduce(
-            lambda a, b: a+b['total_time_spent'], workflows_time, timedelta(0)
-        )
-        data['avg_time_spent_on_workflows'] = data['total_time_spent_on_workflows']/max(len(workflows_time), 1)
-        data['max_time_spent_on_workflows'] = max(times_spent_on_worflows)
-        data['min_time_spent_on_workflows'] = min(times_spent_on_worflows)
-        data['last_task_completed'] = tasks_associated.order_by('-completed_at').first()
-        data['last_workflow_completed'] = workflows_associated.order_by('-completed_at').first()
-
-        data['workflows_completed_monthly'] = workflows_associated.filter(
-            status=common_constant.WORKFLOW_STATUS.COMPLETE,
-            completed_at__gt=past_12_months
-        ).annotate(
-            month=db_functions.TruncMonth('completed_at')
-        ).values('month').annotate(count=Count('id')).values('count', 'month')
-
-        serializer = self.get_serializer(data)
+        serializer = self.get_serializer(build_employee_reports([employee])[0])
         return Response(serializer.data)
 
 
+WORKFLOW_TASKS_TIME_SQL = '''
+WITH task_time AS (
+    SELECT
+        task.workflow_id,
+        task.id AS task_id,
+        task.status,
+        task.start_delta,
+        assignee.id AS assignee_id,
+        assignee_user.id AS user_id,
+        assignee_user.first_name,
+        assignee_user.last_name,
+        assignee_user.email,
+        CASE WHEN task.status = %(complete)s
+            THEN task.completed_at - COALESCE(parent_task.completed_at, workflow.start_at) - task.start_delta
+        END AS time_spent
+    FROM {task_table} AS task
+        INNER JOIN {workflow_table} AS workflow ON workflow.id = task.workflow_id
+        INNER JOIN {employee_table} AS assignee ON assignee.id = task.assignee_id
+        INNER JOIN {user_table} AS assignee_user ON assignee_user.id = assignee.user_id
+        LEFT OUTER JOIN {task_table} AS parent_task ON parent_task.id = task.parent_task_id
+    WHERE task.workflow_id IN %(workflow_ids)s
+)
+SELECT
+    workflow_id, assignee_id, user_id, first_name, last_name, email, time_spent,
+    COUNT(*) OVER workflow_tasks AS number_of_tasks,
+    SUM(start_delta) FILTER (WHERE status = %(complete)s) OVER workflow_tasks AS completed_tasks_delta,
+    AVG(time_spent) OVER workflow_tasks AS average_task_complete_time,
+    ROW_NUMBER() OVER (PARTITION BY workflow_id ORDER BY time_spent ASC NULLS LAST, task_id) AS min_time_rank,
+    ROW_NUMBER() OVER (PARTITION BY workflow_id ORDER BY time_spent DESC NULLS LAST, task_id) AS max_time_rank
+FROM task_time
+WINDOW workflow_tasks AS (PARTITION BY workflow_id)
+ORDER BY workflow_id, task_id
+'''.format(
+    task_table=Task._meta.db_table,
+    workflow_table=Workflow._meta.db_table,
+    employee_table=UserCompany._meta.db_table,
+    user_table=User._meta.db_table
+)
+
+
+def get_workflows_tasks_time(workflow_ids):
+    '''
+    Returns the tasks of the workflows with their assignees, time spent and the aggregates of their workflows, in a
+    single query.
+
+    Arguments:
+        workflow_ids {list} -- ids of the workflows
+
+    Returns:
+        dict -- rows of the tasks by workflow id, as dicts
+    '''
+    if not workflow_ids:
+        return {}
+
+    with connection.cursor() as cursor:
+        cursor.execute(WORKFLOW_TASKS_TIME_SQL, {
+            'complete': common_constant.TASK_STATUS.COMPLETE,
+            'workflow_ids': tuple(workflow_ids)
+        })
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    workflows_tasks = collections.defaultdict(list)
+    for row in rows:
+        workflows_tasks[row['workflow_id']].append(row)
+    return workflows_tasks
+
+
+def get_assignee(row):
+    return UserCompany(
+        id=row['assignee_id'],
+        user=User(id=row['user_id'], first_name=row['first_name'], last_name=row['last_name'], email=row['email'])
+    )
+
+
+def build_workflow_report(workflow, tasks):
+    '''
+    Returns the report data of the workflow from the rows of its tasks.
+    '''
+    data = {
+        'name': workflow.name,
+        'status': workflow.status,
+        'start_at': workflow.start_at,
+        'completed_at': workflow.completed_at,
+        'creator': workflow.creator,
+    }
+
+    assignees = {}
+    for row in tasks:
+        assignees.setdefault(row['assignee_id'], row)
+    data['unique_assignees'] = [get_assignee(assignees[assignee_id]) for assignee_id in sorted(assignees)]
+    data['number_of_assignees'] = len(assignees)
+
+    # aggregates are the same on every row of the workflow
+    aggregates = tasks[0] if tasks else {}
+    completed_tasks_delta = aggregates.get('completed_tasks_delta')
+
+    if(workflow.status == common_constant.WORKFLOW_STATUS.INITIATED):
+        data['total_time_spend'] = timedelta(0)
+    else:
+        data['total_time_spend'] = (
+            workflow.completed_at if workflow.completed_at else timezone.now()
+        ) - workflow.start_at - (completed_tasks_delta if completed_tasks_delta else timedelta(0))
+
+    data['number_of_tasks'] = aggregates.get('number_of_tasks', 0)
+    data['average_task_complete_time'] = aggregates.get('average_task_complete_time') or timedelta(0)
+
+    data['assingee_with_min_time'] = None
+    data['assingee_with_max_time'] = None
+    for row in tasks:
+        if row['time_spent'] is None:
+            continue
+        if row['min_time_rank'] == 1:
+            data['assingee_with_min_time'] = {'assignee': get_assignee(row), 'time': row['time_spent']}
+        if row['max_time_rank'] == 1:
+            data['assingee_with_max_time'] = {'assignee': get_assignee(row), 'time': row['time_spent']}
+    return data
+
+
+def build_workflow_reports(workflows):
+    '''
+    Returns the report data of the workflows, in one query besides the workflows.
+    '''
+    workflows_tasks = get_workflows_tasks_time([workflow.id for workflow in workflows])
+    return [build_workflow_report(workflow, workflows_tasks.get(workflow.id, [])) for workflow in workflows]
+
+
 class WorkflowReport(generics.RetrieveAPIView):
     queryset = Workflow.objects.all()
     permission_classes = (IsCompanyAdmin,)
     serializer_class = WorkflowReportSerializer
 
+    def get_queryset(self):
+        return self.queryset.select_related('creator__user')
+
+    @cached_report('workflow-report')
     def retrieve(self, request, *args, **kwargs):
         '''
         override to serializer more workflow data
         '''
         workflow = self.get_object()
-        tasks_time = calculate_completed_tasks_time_spent(workflow.tasks)
-        completed_tasks_delta = workflow.tasks.filter(
-            status=common_constant.TASK_STATUS.COMPLETE
-        ).values('start_delta').aggregate(total_delta=Sum('start_delta'))['total_delta']
-
-        data = {
-            'name': workflow.name,
-            'status': workflow.status,
-            'start_at': workflow.start_at,
-            'completed_at': workflow.completed_at,
-            'creator': workflow.creator,
-        }
-
-        data['unique_assignees'] = UserCompany.objects.filter(tasks__workflow=workflow).distinct()
-
-        if(workflow.status == common_constant.WORKFLOW_STATUS.INITIATED):
-            data['total_time_spend'] = timedelta(0)
-        else:
-            data['total_time_spend'] = (
-                workflow.completed_at if workflow.completed_at else timezone.now()
-            ) - workflow.start_at - (completed_tasks_delta if completed_tasks_delta else timedelta(0))
-
-        data['number_of_assignees'] = data['unique_assignees'].count()
-        data['number_of_tasks'] = workflow.tasks.count()
-        data['average_task_complete_time'] = tasks_time.aggregate(Avg('time_spent'))['time_spent__avg'] or timedelta(0)
-        try:
-            data['assingee_with_min_time'] = {
-                'assignee': tasks_time.earliest('time_spent').assignee,
-                'time': tasks_time.earliest('time_spent').time_spent
-            }
-            data['assingee_with_max_time'] = {
-                'assignee': tasks_time.latest('time_spent').assignee,
-                'time': tasks_time.latest('time_spent').time_spent
-            }
-        except Task.DoesNotExist as e:
-            data['assingee_with_min_time'] = None
-            data['assingee_with_max_time'] = None
-            logger.debug('assingee with min/max time query : {msg}'.format(msg=str(e)))
-
-        serializer = self.get_serializer(data)
+        tasks = get_workflows_tasks_time([workflow.id]).get(workflow.id, [])
+        serializer = self.get_serializer(build_workflow_report(workflow, tasks))
         return Response(serializer.data)
+
+
+class WorkflowBatchReport(generics.GenericAPIView):
+    queryset = Workflow.objects.all()
+    permission_classes = (IsCompanyAdmin,)
+    serializer_class = WorkflowReportSerializer
+
+    def get_queryset(self):
+        return self.queryset.filter(creator__company=self.request.user.company).select_related('creator__user')
+
+    @cached_report('workflow-batch-report')
+    def get(self, request, format=None):
+        '''
+        Returns the reports of the workflows whose ids are given in the ids query param, comma separated.
+        '''
+        params = WorkflowBatchReportSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        workflows = self.get_queryset().filter(id__in=params.validated_data['ids']).order_by('id')
+        reports = build_workflow_reports(workflows)
+
+        serializer = self.get_serializer(reports, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+# reports which can be exported, by name: (instances of the company, report data builder, serializer)
+ReportExportType = collections.namedtuple('ReportExportType', 'get_queryset build_reports serializer_class')
+REPORT_EXPORTS = {
+    'employee-report': ReportExportType(
+        lambda company: UserCompany.objects.filter(company=company).select_related('user'),
+        build_employee_reports,
+        EmployeeReportSerializer
+    ),
+    'workflow-report': ReportExportType(
+        lambda company: Workflow.objects.filter(creator__company=company).select_related('creator__user'),
+        build_workflow_reports,
+        WorkflowReportSerializer
+    ),
+}
+
+
+class ReportExport(views.APIView):
+    '''
+    Streams the report named in the url for every instance of the company, as csv or as json lines depending on the
+    output query param. Instances are read in chunks and the response is written as they are reported, so that memory
+    stays flat whatever the size of the company.
+    '''
+    permission_classes = (IsCompanyAdmin,)
+
+    def get(self, request, report, format=None):
+        params = ReportExportSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        output = params.validated_data['output']
+        report_export = REPORT_EXPORTS[report]
+
+        rows = export.serialize_rows(
+            export.iterate_chunks(
+                report_export.get_queryset(request.user.company), common_constant.REPORT_EXPORT_CHUNK_SIZE
+            ),
+            report_export.build_reports,
+            report_export.serializer_class
+        )
+        if output == export.OUTPUT_CSV:
+            lines = export.stream_csv(rows, report_export.serializer_class())
+        else:
+            lines = export.stream_ndjson(rows)
+
+        response = StreamingHttpResponse(lines, content_type=export.CONTENT_TYPES[output])
+        response['Content-Disposition'] = 'attachment; filename="{name}.{output}"'.format(name=report, output=output)
+        return response
+
+
+class ReportCacheStats(views.APIView):
+    permission_classes = (IsCompanyAdmin,)
+
+    def get(self, request, format=None):
+        '''
+        Returns the hit and miss counts of the report cache.
+        '''
+        return Response(get_cache_stats(), status=status.HTTP_200_OK)
+
+
+class ReportJobStatus(views.APIView):
+    permission_classes = (IsCompanyAdmin,)
+
+    def get(self, request, job_id, format=None):
+        '''
+        Returns the status of a report job queued with the async query param, along with the report once computed.
+        '''
+        job = get_report_job(job_id)
+        if job is None or job['company_id'] != request.user.company.id:
+            raise NotFound({'detail': 'report job not found'})
+        return Response(get_report_job_data(request, job_id, job), status=status.HTTP_200_OK)
@@ -1,6 +1,53 @@
-from datetime import timedelta
+from django.db import connection
+
+from django_bulk_update.helper import bulk_update
 
 from apps.common import constant as common_constant
+from apps.workflow.models import Workflow, Task
+
+
+PARENT_START_TIME_SQL = '''
+    WITH RECURSIVE chain (origin_id, parent_task_id, workflow_id, completed_at, pending_time) AS (
+        SELECT task.id, task.parent_task_id, task.workflow_id, task.completed_at,
+               CASE WHEN task.completed_at IS NULL THEN task.start_delta + task.duration
+                    ELSE INTERVAL '0' END
+        FROM {task_table} AS task
+        WHERE task.id = ANY(%(tasks_ids)s)
+      UNION ALL
+        SELECT chain.origin_id, parent.parent_task_id, parent.workflow_id, parent.completed_at,
+               chain.pending_time + CASE WHEN parent.completed_at IS NULL THEN parent.start_delta + parent.duration
+                                         ELSE INTERVAL '0' END
+        FROM chain
+        INNER JOIN {task_table} AS parent ON parent.id = chain.parent_task_id
+        WHERE chain.completed_at IS NULL
+    )
+    SELECT chain.origin_id, COALESCE(chain.completed_at, workflow.start_at) + chain.pending_time
+    FROM chain
+    INNER JOIN {workflow_table} AS workflow ON workflow.id = chain.workflow_id
+    WHERE chain.completed_at IS NOT NULL OR chain.parent_task_id IS NULL
+'''.format(task_table=Task._meta.db_table, workflow_table=Workflow._meta.db_table)
+
+
+def get_parent_start_times(tasks_parents_ids):
+    '''
+    Calculates in one recursive query the exact date and time after completion of many parent tasks till their
+    child tasks. Every chain is followed up to its first completed task (or the start of the workflow), summing start
+    delta and duration of the uncompleted tasks on the way.
+
+    Arguments:
+        tasks_parents_ids {iterable} -- ids of the parent tasks
+
+    Returns:
+        dict -- parent task id to exact date and time after its completion mapping
+    '''
+
+    tasks_parents_ids = list(set(tasks_parents_ids))
+    if not tasks_parents_ids:
+        return {}
+
+    with connection.cursor() as cursor:
+        cursor.execute(PARENT_START_TIME_SQL, {'tasks_ids': tasks_parents_ids})
+        return dict(cursor.fetchall())
 
 
 def get_parent_start_time(task_parent):
@@ -14,15 +61,7 @@ def get_parent_start_time(task_parent):
         datetime -- exact date and time after completion of the parent task till current task.
     '''
 
-    initial_task = task_parent
-    task_start_time = timedelta(0)
-    while task_parent and not task_parent.completed_at:
-        task_start_time += task_parent.start_delta + task_parent.duration
-        task_parent = task_parent.parent_task
-    if task_parent:
-        return task_parent.completed_at + task_start_time
-    else:
-        return initial_task.workflow.start_at + task_start_time
+    return get_parent_start_times([task_parent.id])[task_parent.id]
 
 
 def is_time_conflicting(t1_start_time, t1_end_time, t2_start_time, t2_end_time):
@@ -46,6 +85,178 @@ def is_time_conflicting(t1_start_time, t1_end_time, t2_start_time, t2_end_time):
     return True
 
 
+class IntervalTree(object):
+    '''
+    Static interval tree answering overlap queries in O(log n + k).
+
+    Intervals are kept sorted by start time and viewed as an implicit balanced binary search tree, every node storing
+    the maximum end time of its subtree so that subtrees ending before the queried interval are skipped.
+    '''
+
+    def __init__(self, intervals):
+        '''
+        Arguments:
+            intervals {list} -- (start time, end time, data) tuples
+        '''
+
+        self.intervals = sorted(intervals, key=lambda interval: interval[0])
+        self.max_end_times = [None] * len(self.intervals)
+        self._build(0, len(self.intervals))
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def _build(self, low, high):
+        if low >= high:
+            return None
+
+        mid = (low + high) // 2
+        max_end_time = self.intervals[mid][1]
+        for child_max_end_time in (self._build(low, mid), self._build(mid + 1, high)):
+            if child_max_end_time is not None and child_max_end_time > max_end_time:
+                max_end_time = child_max_end_time
+        self.max_end_times[mid] = max_end_time
+        return max_end_time
+
+    def _search(self, low, high, start_time, end_time, result, first_only):
+        if low >= high:
+            return
+        mid = (low + high) // 2
+        # no interval of the subtree ends after the queried interval starts
+        if self.max_end_times[mid] <= start_time:
+            return
+
+        self._search(low, mid, start_time, end_time, result, first_only)
+        if first_only and result:
+            return
+
+        interval = self.intervals[mid]
+        # this interval and the ones after it start after the queried interval ends
+        if interval[0] >= end_time:
+            return
+        if is_time_conflicting(start_time, end_time, interval[0], interval[1]):
+            result.append(interval)
+            if first_only:
+                return
+
+        self._search(mid + 1, high, start_time, end_time, result, first_only)
+
+    def overlapping(self, start_time, end_time):
+        '''
+        Returns the intervals conflicting with the given timings.
+        '''
+
+        result = []
+        self._search(0, len(self.intervals), start_time, end_time, result, False)
+        return result
+
+    def is_overlapping(self, start_time, end_time):
+        '''
+        Checks whether any interval conflicts with the given timings.
+        '''
+
+        result = []
+        self._search(0, len(self.intervals), start_time, end_time, result, True)
+        return bool(result)
+
+
+def get_expected_timings(parent_end_time, start_delta, duration, completed_at=None):
+    '''
+    Calculates expected start and end times of a task.
+
+    Arguments:
+        parent_end_time {datetime} -- expected end time of the parent task (start time of the workflow for first task)
+        start_delta {timedelta} -- start delta of the task
+        duration {timedelta} -- duration of the task
+
+    Keyword Arguments:
+        completed_at {datetime} -- completion time of the task, if completed (default: {None})
+
+    Returns:
+        tuple -- (expected start time, expected end time)
+    '''
+
+    expected_start_time = parent_end_time + start_delta
+    return (expected_start_time, completed_at or expected_start_time + duration)
+
+
+def refresh_expected_timings(workflow, start_task=None):
+    '''
+    Recomputes the materialized expected timings down the task chain of the workflow and persists the ones that
+    moved. To be called after a task completes, start delta or duration of a task changes or the workflow's start
+    time moves.
+
+    Arguments:
+        workflow {Workflow} -- Workflow model instance
+
+    Keyword Arguments:
+        start_task {Task} -- first changed task, tasks before it in the chain are left untouched. The instance is
+                             updated in place (default: {None}, the whole chain)
+
+    Returns:
+        list -- tasks whose expected timings were updated
+    '''
+
+    tasks = {task.id: task for task in workflow.tasks.all()}
+    if start_task:
+        tasks[start_task.id] = start_task
+    child_tasks = {task.parent_task_id: task for task in tasks.itervalues()}
+
+    task = start_task or child_tasks.get(None)
+    changed_tasks = []
+    while task is not None:
+        parent_task = tasks.get(task.parent_task_id)
+        if parent_task is None:
+            parent_end_time = workflow.start_at
+        elif parent_task.expected_end_at is None:
+            # parent timings not materialized yet, resolve them from the chain
+            parent_end_time = get_parent_start_time(parent_task)
+        else:
+            parent_end_time = parent_task.expected_end_at
+        expected_timings = get_expected_timings(
+            parent_end_time,
+            task.start_delta,
+            task.duration,
+            task.completed_at
+        )
+        if expected_timings != (task.expected_start_at, task.expected_end_at):
+            task.expected_start_at, task.expected_end_at = expected_timings
+            changed_tasks.append(task)
+        task = child_tasks.get(task.id)
+
+    bulk_update(changed_tasks, update_fields=['expected_start_at', 'expected_end_at'])
+    return changed_tasks
+
+
+def get_employees_tasks_intervals(employees_ids, ignore_tasks_ids=()):
+    '''
+    Builds the interval trees of the upcoming and ongoing tasks of the employees, in a single query.
+
+    Arguments:
+        employees_ids {iterable} -- ids of UserCompany model instances
+
+    Keyword Arguments:
+        ignore_tasks_ids {iterable} -- tasks to leave out of the trees (default: {()})
+
+    Returns:
+        dict -- employee id to IntervalTree mapping, data of every interval being the task id
+    '''
+
+    employees_ids = set(employees_ids)
+    other_tasks = Task.objects.filter(
+        assignee__in=employees_ids,
+        status__in=[common_constant.TASK_STATUS.UPCOMING, common_constant.TASK_STATUS.ONGOING]
+    ).exclude(id__in=ignore_tasks_ids).values_list('id', 'assignee_id', 'expected_start_at', 'expected_end_at')
+
+    employees_intervals = {employee_id: [] for employee_id in employees_ids}
+    for task_id, employee_id, expected_start_time, expected_end_time in other_tasks:
+        employees_intervals[employee_id].append((expected_start_time, expected_end_time, task_id))
+
+    return {
+        employee_id: IntervalTree(intervals) for employee_id, intervals in employees_intervals.iteritems()
+    }
+
+
 def is_task_conflicting(employee, task_start_time, task_end_time, visited=None, ignore_tasks_ids=[]):
     '''
     Checks whether the tasks of the employee conflict with the new task timings.
@@ -56,8 +267,8 @@ def is_task_conflicting(employee, task_start_time, task_end_time, visited=None,
         task_end_time {datetime} -- end time of the new task
 
     Keyword Arguments:
-        visited {boolean} -- dictionary containing the pre-computed values of the employee's other
-                                tasks timings (default: {None})
+        visited {dict} -- dictionary containing the pre-computed interval trees of the employees, when not given
+                            conflict is checked with a range query on the expected timings (default: {None})
         ignore_tasks_ids {list} -- tasks to ignore (could contain the task's id who's timings are
                                      updated) (default: {[]})
 
@@ -65,35 +276,38 @@ def is_task_conflicting(employee, task_start_time, task_end_time, visited=None,
         boolean -- Whether new timings conflict with other tasks of the employee
     '''
 
-    if(visited and visited[employee.id]):
-        other_tasks = visited[employee.id]
-        for other_task in other_tasks:
-            expected_start_time, expected_end_time = other_task
-            if is_time_conflicting(task_start_time, task_end_time, expected_start_time, expected_end_time):
-                return True
+    if visited is None:
+        return employee.tasks.filter(
+            status__in=[common_constant.TASK_STATUS.UPCOMING, common_constant.TASK_STATUS.ONGOING],
+            expected_start_at__lt=task_end_time,
+            expected_end_at__gt=task_start_time
+        ).exclude(id__in=ignore_tasks_ids).exists()
 
-        return False
+    if employee.id not in visited:
+        visited.update(get_employees_tasks_intervals([employee.id], ignore_tasks_ids))
 
-    if(visited):
-        visited[employee.id] = []
-    filtered_tasks = employee.tasks.exclude(id__in=ignore_tasks_ids)
-    other_tasks = filtered_tasks.filter(status__in=[common_constant.TASK_STATUS.UPCOMING,
-                                                    common_constant.TASK_STATUS.ONGOING])
-    # calculate expected start and end times of other tasks and check conflict
-    for other_task in other_tasks.all():
-        expected_start_time = other_task.start_delta
-        other_task_parent = other_task.parent_task
-        if(other_task_parent):
-            expected_start_time += get_parent_start_time(other_task_parent)
-        else:
-            expected_start_time += other_task.workflow.start_at
-        expected_end_time = expected_start_time + other_task.duration
-        # check for conflict
-        if is_time_conflicting(task_start_time, task_end_time, expected_start_time, expected_end_time):
-            return True
+    return visited[employee.id].is_overlapping(task_start_time, task_end_time)
+
+
+def get_conflicting_employees(tasks_timings, ignore_tasks_ids=()):
+    '''
+    Checks a whole list of new task timings against the other tasks of their assignees at once.
+
+    Arguments:
+        tasks_timings {list} -- (employee, task start time, task end time) tuples
+
+    Keyword Arguments:
+        ignore_tasks_ids {iterable} -- tasks to ignore (default: {()})
 
-        # save the calculations
-        if(visited):
-            visited[employee.id].append((expected_start_time, expected_end_time))
+    Returns:
+        list -- employees for whom the new timings conflict, in the order of tasks_timings
+    '''
 
-    return False
+    employees_intervals = get_employees_tasks_intervals(
+        [employee.id for employee, _, _ in tasks_timings],
+        ignore_tasks_ids
+    )
+    return [
+        employee for employee, task_start_time, task_end_time in tasks_timings
+        if employees_intervals[employee.id].is_overlapping(task_start_time, task_end_time)
+    ]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from django_bulk_update.helper import bulk_update
+
+from apps.common import constant as common_constant
+from apps.workflow.helpers import get_expected_timings, get_parent_start_times
+from apps.workflow.models import Task
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    '''
+    Recompute materialized expected timings of uncompleted tasks from their parent chains.
+    '''
+    help = 'Resolves parent chains of uncompleted tasks in batches and fixes their expected start/end times.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='number of tasks resolved per query'
+        )
+
+    def handle(self, *args, **options):
+        tasks = Task.objects.exclude(
+            status=common_constant.TASK_STATUS.COMPLETE
+        ).select_related('workflow').order_by('id')
+
+        last_task_id = 0
+        repaired = 0
+        while True:
+            batch = list(tasks.filter(id__gt=last_task_id)[:options['batch_size']])
+            if not batch:
+                break
+            last_task_id = batch[-1].id
+
+            parent_start_times = get_parent_start_times(
+                task.parent_task_id for task in batch if task.parent_task_id
+            )
+            changed_tasks = []
+            for task in batch:
+                expected_timings = get_expected_timings(
+                    parent_start_times[task.parent_task_id] if task.parent_task_id else task.workflow.start_at,
+                    task.start_delta,
+                    task.duration
+                )
+                if expected_timings != (task.expected_start_at, task.expected_end_at):
+                    task.expected_start_at, task.expected_end_at = expected_timings
+                    changed_tasks.append(task)
+
+            bulk_update(changed_tasks, update_fields=['expected_start_at', 'expected_end_at'])
+            repaired += len(changed_tasks)
+
+        logger.info('%d tasks repaired' % repaired)
+        self.stdout.write('%d tasks repaired' % repaired)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.common import constant as common_constant
+from apps.workflow.tasks import fire_due_timers
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    '''
+    Timer loop firing due workflow and task start timers.
+    '''
+    help = 'Polls the timer table and starts workflows and tasks once they are due.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=common_constant.TIMER_BATCH_SIZE,
+            help='maximum number of timers claimed per transaction'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=common_constant.TIMER_POLL_SECONDS,
+            help='seconds to wait when no timer is due'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='fire the currently due timers and exit'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        logger.info('Timer loop started')
+        while True:
+            fired = fire_due_timers(batch_size)
+            if fired:
+                logger.info('%d timers fired' % fired)
+            if options['once'] and fired < batch_size:
+                break
+            # keep draining while full batches are being claimed
+            if fired < batch_size:
+                time.sleep(options['poll_interval'])
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0013_auto_20190302_0805'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Timer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('kind', models.PositiveIntegerField(choices=[(1, b'START_WORKFLOW'), (2, b'START_TASK')], help_text='action performed when the timer fires')),
+                ('object_id', models.PositiveIntegerField(help_text='id of the workflow or task to start')),
+                ('fire_at', models.DateTimeField(db_index=True, help_text='time at which the timer is due')),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='number of failed fire attempts')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='timer',
+            unique_together=set([('kind', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 11:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from django_bulk_update.helper import bulk_update
+
+
+def backfill_expected_timings(apps, schema_editor):
+    '''
+    Materialize expected timings of existing tasks, walking the task chain of every workflow.
+    '''
+    Workflow = apps.get_model('workflow', 'Workflow')
+    Task = apps.get_model('workflow', 'Task')
+
+    for workflow in Workflow.objects.all().iterator():
+        tasks = list(Task.objects.filter(workflow=workflow))
+        child_tasks = {task.parent_task_id: task for task in tasks}
+
+        task = child_tasks.get(None)
+        parent_end_time = workflow.start_at
+        while task is not None:
+            task.expected_start_at = parent_end_time + task.start_delta
+            task.expected_end_at = task.completed_at or task.expected_start_at + task.duration
+            parent_end_time = task.expected_end_at
+            task = child_tasks.get(task.id)
+
+        bulk_update(tasks, update_fields=['expected_start_at', 'expected_end_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0014_timer'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='expected_end_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='projected end time, completion time once the task is completed', null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='expected_start_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='projected start time, end of the parent task (or start of the workflow) plus start delta', null=True),
+        ),
+        migrations.RunPython(backfill_expected_timings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-17 14:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflow', '0015_task_expected_timings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('kind', models.PositiveIntegerField(choices=[(1, b'WORKFLOW_MAIL'), (2, b'TASK_MAIL')], help_text='notification to send')),
+                ('object_id', models.PositiveIntegerField(help_text='id of the workflow or task changed')),
+                ('update_fields', django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=64), blank=True, default=list, help_text='fields saved with update_fields', size=None)),
+                ('full_save', models.BooleanField(default=False, help_text='whether the whole object was saved')),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='number of failed relay attempts')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, help_text='time from which the event can be relayed')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='outboxevent',
+            unique_together=set([('kind', 'object_id')]),
+        ),
+    ]
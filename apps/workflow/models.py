@@ -5,14 +5,17 @@ from datetime import timedelta
 import logging
 
 from django.contrib.auth import get_user_model
-from django.contrib.postgres.fields import CICharField
+from django.contrib.postgres.fields import ArrayField, CICharField
 from django.db import models
+from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericRelation
 
 from partial_index import PartialIndex, PQ
 from model_utils.tracker import FieldTracker
 
 from apps.common import constant as common_constant
+from apps.common.mail import MailBatch
+from apps.common.models import BaseModel
 from apps.company.models import UserCompany
 from apps.workflow_template.models import WorkflowTemplate
 from apps.history.models import History
@@ -68,13 +71,14 @@ class Workflow(models.Model):
             associated_people_details[self.creator_id] = {
                 'employee': self.creator}
 
-            for accessor in self.accessors.all():
+            for accessor in self.accessors.select_related('employee__user'):
                 associated_people_details[accessor.employee_id] = {
                     'employee': accessor.employee}
-            for task in self.tasks.all():
+            for task in self.tasks.select_related('assignee__user'):
                 associated_people_details[task.assignee_id] = {
                     'employee': task.assignee}
 
+        mail_batch = MailBatch()
         for key, person in associated_people_details.iteritems():
             context = {
                 'is_updated': is_updated,
@@ -87,14 +91,17 @@ class Workflow(models.Model):
                 'write_permission': person.get('write_permission', False),
                 'task_list': person.get('task_list', [])
             }
-            person['employee'].user.email_user(
+            mail_batch.add(
+                person['employee'].user,
                 'workflow.txt',
                 'workflow.html',
                 'Workflow Update',
                 context
             )
-            logger.info('Workflow create/update/shared mail send to {email}'.format(
-                email=person['employee'].user.email))
+
+        failed_recipients = mail_batch.send()
+        logger.info('Workflow create/update/shared mail send to {count} people, failed for {failed}'.format(
+            count=len(mail_batch), failed=failed_recipients))
 
     def _history_representation(self):
         '''
@@ -102,6 +109,12 @@ class Workflow(models.Model):
         '''
         return self.name
 
+    def _history_workflow_id(self):
+        '''
+            method use for getting the id of the workflow the history of the object belongs to.
+        '''
+        return self.id
+
 
 class Task(models.Model):
     '''
@@ -130,6 +143,18 @@ class Task(models.Model):
     duration = models.DurationField(
         help_text='expected duration of the task'
     )
+    expected_start_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text='projected start time, end of the parent task (or start of the workflow) plus start delta'
+    )
+    expected_end_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text='projected end time, completion time once the task is completed'
+    )
     status = models.PositiveIntegerField(
         choices=(choice for choice in zip(
             common_constant.TASK_STATUS,
@@ -153,6 +178,9 @@ class Task(models.Model):
         ]
     )
 
+    # derived from the chain and refreshed in bulk without signals, kept out of the histories as they are not tracked
+    history_excluded_fields = ('expected_start_at', 'expected_end_at')
+
     def __unicode__(self):
         return '{workflow_id}-#-{title}'.format(
             title=self.title,
@@ -165,6 +193,12 @@ class Task(models.Model):
         '''
         return self.title
 
+    def _history_workflow_id(self):
+        '''
+            method use for getting the id of the workflow the history of the object belongs to.
+        '''
+        return self.workflow_id
+
     def send_mail(self, is_started=False, is_completed=False):
         '''
         send task start/update mail.
@@ -177,18 +211,17 @@ class Task(models.Model):
             'is_completed': is_completed
         }
 
+        mail_batch = MailBatch()
         # send mail to the assignee
-        self.assignee.user.email_user(
-            'task.txt', 'task.html', 'Task Update', context)
-        logger.info(
-            'Task start/update mail send to {email}'.format(email=self.assignee.user.email))
+        mail_batch.add(self.assignee.user, 'task.txt', 'task.html', 'Task Update', context)
 
         # send mail to the  creator if task is updated
-        context['name'] = self.workflow.creator.user.name
-        self.workflow.creator.user.email_user(
-            'task.txt', 'task.html', 'Task Update', context)
-        logger.info(
-            'Task start/update mail send to {email}'.format(email=self.assignee.user.email))
+        context = dict(context, name=self.workflow.creator.user.name)
+        mail_batch.add(self.workflow.creator.user, 'task.txt', 'task.html', 'Task Update', context)
+
+        failed_recipients = mail_batch.send()
+        logger.info('Task start/update mail send to {email}, failed for {failed}'.format(
+            email=self.assignee.user.email, failed=failed_recipients))
 
 
 class WorkflowAccess(models.Model):
@@ -224,6 +257,9 @@ class WorkflowAccess(models.Model):
 
     objects_all = models.Manager()
 
+    # relations followed by _history_representation, loaded along when resolving history values
+    history_select_related = ('employee__user', 'employee__company', 'workflow')
+
     class Meta:
         indexes = [
             PartialIndex(
@@ -247,9 +283,15 @@ class WorkflowAccess(models.Model):
         '''
         return '%s --> %s' % (self.employee._history_representation(), self.workflow._history_representation())
 
-    def send_mail(self):
+    def _history_workflow_id(self):
         '''
-        send workflow shared mail.
+            method use for getting the id of the workflow the history of the object belongs to.
+        '''
+        return self.workflow_id
+
+    def add_mail(self, mail_batch):
+        '''
+        queue workflow shared mail into the mail batch.
         '''
         context = {
             'is_updated': False,
@@ -260,11 +302,81 @@ class WorkflowAccess(models.Model):
             'write_permission': self.permission == common_constant.PERMISSION.READ_WRITE,
             'task_list': []
         }
-        self.employee.user.email_user(
+        mail_batch.add(
+            self.employee.user,
             'workflow.txt',
             'workflow.html',
             'Workflow Update',
             context
         )
+
+    def send_mail(self):
+        '''
+        send workflow shared mail.
+        '''
+        mail_batch = MailBatch()
+        self.add_mail(mail_batch)
+        mail_batch.send()
         logger.info(
             'Accessor create/update mail send to {email}'.format(email=self.employee.user.email))
+
+
+class Timer(BaseModel):
+    '''
+    Pending workflow/task start timers, fired by the timer loop once fire_at is reached.
+    '''
+    kind = models.PositiveIntegerField(
+        choices=(choice for choice in zip(
+            common_constant.TIMER_KIND,
+            common_constant.TIMER_KIND._fields
+        )),
+        help_text='action performed when the timer fires'
+    )
+    object_id = models.PositiveIntegerField(help_text='id of the workflow or task to start')
+    fire_at = models.DateTimeField(db_index=True, help_text='time at which the timer is due')
+    attempts = models.PositiveIntegerField(default=0, help_text='number of failed fire attempts')
+
+    class Meta:
+        unique_together = ('kind', 'object_id')
+
+    def __unicode__(self):
+        return '{kind}-#-{object_id}-#-{fire_at}'.format(
+            kind=self.get_kind_display(),
+            object_id=self.object_id,
+            fire_at=self.fire_at
+        )
+
+
+class OutboxEvent(BaseModel):
+    '''
+    Notification events written in the transaction of the change, relayed to celery after commit. Events of an
+    object are coalesced per kind until relayed, keeping the union of the saved fields and whether it was ever saved
+    whole. Failed events are retried after a growing delay and parked after OUTBOX_MAX_ATTEMPTS, until the next save
+    of their object.
+    '''
+    kind = models.PositiveIntegerField(
+        choices=(choice for choice in zip(
+            common_constant.OUTBOX_KIND,
+            common_constant.OUTBOX_KIND._fields
+        )),
+        help_text='notification to send'
+    )
+    object_id = models.PositiveIntegerField(help_text='id of the workflow or task changed')
+    update_fields = ArrayField(
+        models.CharField(max_length=64),
+        blank=True,
+        default=list,
+        help_text='fields saved with update_fields'
+    )
+    full_save = models.BooleanField(default=False, help_text='whether the whole object was saved')
+    attempts = models.PositiveIntegerField(default=0, help_text='number of failed relay attempts')
+    next_attempt_at = models.DateTimeField(default=timezone.now, help_text='time from which the event can be relayed')
+
+    class Meta:
+        unique_together = ('kind', 'object_id')
+
+    def __unicode__(self):
+        return '{kind}-#-{object_id}'.format(
+            kind=self.get_kind_display(),
+            object_id=self.object_id
+        )
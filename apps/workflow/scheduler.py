@@ -0,0 +1,94 @@
+import logging
+
+from django.db import connection
+from django.utils import timezone
+
+from apps.common import constant as common_constant
+from apps.workflow.models import Timer
+
+logger = logging.getLogger(__name__)
+
+# registers a timer or moves the pending one of the object, like schedule_timer, for many objects in one statement
+SCHEDULE_TIMERS_SQL = '''
+INSERT INTO {timer_table} AS timer (created, modified, kind, object_id, fire_at, attempts)
+VALUES {values}
+ON CONFLICT (kind, object_id) DO UPDATE SET
+    modified = EXCLUDED.modified,
+    fire_at = EXCLUDED.fire_at,
+    attempts = 0
+'''
+
+
+def schedule_timer(kind, object_id, fire_at):
+    '''
+    Registers (or moves) the timer of the given kind for the object.
+
+    Arguments:
+        kind {int} -- one of common_constant.TIMER_KIND
+        object_id {int} -- id of the workflow or task the timer belongs to
+        fire_at {datetime} -- time at which the timer should fire
+
+    Returns:
+        Timer -- the registered timer
+    '''
+
+    timer, _ = Timer.objects.update_or_create(
+        kind=kind,
+        object_id=object_id,
+        defaults={'fire_at': fire_at, 'attempts': 0}
+    )
+    logger.debug('Timer %s registered' % timer)
+    return timer
+
+
+def schedule_timers(kind, fire_times):
+    '''
+    Registers (or moves) timers of the given kind in bulk, with a single statement.
+
+    Arguments:
+        kind {int} -- one of common_constant.TIMER_KIND
+        fire_times {list} -- list of (object_id, fire_at) tuples
+    '''
+
+    if not fire_times:
+        return
+
+    # an object can only be upserted once per statement, its last fire time wins
+    fire_times = dict(fire_times)
+    now = timezone.now()
+    params = []
+    for object_id, fire_at in fire_times.items():
+        params.extend([now, now, kind, object_id, fire_at])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            SCHEDULE_TIMERS_SQL.format(
+                timer_table=Timer._meta.db_table,
+                values=', '.join(['(%s, %s, %s, %s, %s, 0)'] * len(fire_times))
+            ),
+            params
+        )
+    logger.debug('%d timers registered' % len(fire_times))
+
+
+def cancel_timer(kind, object_id):
+    '''
+    Removes the pending timer of the given kind for the object, if any.
+    '''
+
+    Timer.objects.filter(kind=kind, object_id=object_id).delete()
+
+
+def schedule_workflow_start(workflow):
+    '''
+    Registers the start timer of the workflow at its start time.
+    '''
+
+    return schedule_timer(common_constant.TIMER_KIND.START_WORKFLOW, workflow.id, workflow.start_at)
+
+
+def schedule_task_start(task, fire_at):
+    '''
+    Registers the start timer of the task.
+    '''
+
+    return schedule_timer(common_constant.TIMER_KIND.START_TASK, task.id, fire_at)
@@ -3,7 +3,6 @@ from __future__ import unicode_literals
 import logging
 
 from datetime import timedelta
-from django.db.transaction import atomic
 from django.conf import settings
 from django.utils import timezone
 from django.db.models import Q
@@ -13,15 +12,18 @@ from django_bulk_update.helper import bulk_update
 from rest_framework import serializers
 
 from apps.common import constant as common_constant
-from apps.common.helper import generate_error
+from apps.common.helper import allocate_ids, generate_error
 from apps.company.models import UserCompany
 from apps.company.serializers import UserCompanySerializer
-from apps.workflow.helpers import is_time_conflicting, is_task_conflicting, get_parent_start_time
+from apps.workflow.helpers import (
+    is_task_conflicting, get_conflicting_employees, get_expected_timings, refresh_expected_timings
+)
 from apps.workflow.models import Workflow, Task, WorkflowAccess
-from apps.workflow.tasks import start_workflow, send_permission_mail
+from apps.workflow.scheduler import schedule_workflow_start, schedule_task_start
+from apps.workflow.tasks import send_permission_mail
 from apps.workflow_template.models import WorkflowTemplate
 from apps.workflow_template.serializers import WorkflowTemplateBaseSerializer as WorkflowTemplateBaseSerializer
-from apps.history.helpers import update_bulk_history, delete_bulk_history, create_bulk_history
+from apps.history.helpers import buffer_histories, update_bulk_history, delete_bulk_history, create_bulk_history
 
 logger = logging.getLogger(__name__)
 
@@ -36,9 +38,10 @@ class TaskBaseSerializer(serializers.ModelSerializer):
     class Meta:
         model = Task
         fields = ('id', 'workflow', 'title', 'description', 'parent_task',
-                  'assignee', 'completed_at', 'start_delta', 'duration', 'status')
+                  'assignee', 'completed_at', 'start_delta', 'duration', 'status',
+                  'expected_start_at', 'expected_end_at')
         read_only_fields = ('id', 'workflow', 'parent_task',
-                            'completed_at', 'status')
+                            'completed_at', 'status', 'expected_start_at', 'expected_end_at')
 
     def validate_assignee(self, assignee):
         '''
@@ -113,14 +116,12 @@ class TaskUpdateSerializer(TaskBaseSerializer):
         instance = self.instance
 
         if(data.get('start_delta') or data.get('duration')):
-            task_start_time = data.get('start_delta', instance.start_delta)
             task_parent = instance.parent_task
-            if(task_parent):
-                task_start_time += get_parent_start_time(task_parent)
-            else:
-                task_start_time += instance.workflow.start_at
-            task_end_time = task_start_time + \
+            task_start_time, task_end_time = get_expected_timings(
+                task_parent.expected_end_at if task_parent else instance.workflow.start_at,
+                data.get('start_delta', instance.start_delta),
                 data.get('duration', instance.duration)
+            )
             employee = data.get('assignee', instance.assignee)
             if is_task_conflicting(employee, task_start_time, task_end_time, ignore_tasks_ids=[instance.id]):
                 raise serializers.ValidationError(generate_error(
@@ -130,6 +131,20 @@ class TaskUpdateSerializer(TaskBaseSerializer):
 
         return data
 
+    @buffer_histories
+    def update(self, instance, validated_data):
+        '''
+        override to refresh expected timings down the chain and move the start timer of an already scheduled task
+        along with its start delta.
+        '''
+        instance = super(TaskUpdateSerializer, self).update(instance, validated_data)
+        if 'start_delta' in validated_data or 'duration' in validated_data:
+            refresh_expected_timings(instance.workflow, instance)
+        if 'start_delta' in validated_data and instance.status == common_constant.TASK_STATUS.SCHEDULED:
+            schedule_task_start(instance, instance.expected_start_at)
+
+        return instance
+
 
 class WorkflowAccessBaseSerializer(serializers.ModelSerializer):
     class Meta:
@@ -170,7 +185,7 @@ class WorkflowAccessCreateSerializer(WorkflowAccessBaseSerializer):
             }
         }
 
-    @atomic
+    @buffer_histories
     def create(self, validated_data):
         '''
         override to create or update accessor instance and send mail.
@@ -240,7 +255,7 @@ class WorkflowAccessUpdateSerializer(serializers.Serializer):
             )
         return attr
 
-    @atomic
+    @buffer_histories
     def update(self, workflow, validated_data):
         read_permissions = validated_data['read_permissions']
         write_permissions = validated_data['write_permissions']
@@ -374,27 +389,28 @@ class WorkflowCreateSerializer(WorkflowBaseSerializer):
         Validate that tasks of assignees don't conflict with their other tasks.
         '''
         tasks = data.get('tasks', [])
-        visited_assignees = {}
+        tasks_timings = []
         prev_task_end_time = data['start_at']
         for task in tasks:
             task_start_time = prev_task_end_time + task['start_delta']
             task_end_time = task_start_time + task['duration']
-            employee = task['assignee']
-            if is_task_conflicting(employee, task_start_time, task_end_time, visited_assignees):
-                raise serializers.ValidationError(generate_error(
-                    'Task time conflict occurred for user {email}'.format(
-                        email=employee.user.email)
-                ))
+            tasks_timings.append((task['assignee'], task_start_time, task_end_time))
 
             prev_task_end_time = task_end_time
 
+        conflicting_employees = get_conflicting_employees(tasks_timings)
+        if conflicting_employees:
+            raise serializers.ValidationError(generate_error(
+                'Task time conflict occurred for user {email}'.format(
+                    email=conflicting_employees[0].user.email)
+            ))
+
         return data
 
-    @atomic
+    @buffer_histories
     def create(self, validated_data):
         '''
-        override due to nested writes. Also start workflow if it's start time delta is less than celery scheduled task
-        schedule
+        override due to nested writes. Also registers the start timer of the workflow.
         '''
 
         tasks = validated_data.pop('tasks', [])
@@ -407,11 +423,26 @@ class WorkflowCreateSerializer(WorkflowBaseSerializer):
 
         workflow = Workflow.objects.create(creator=employee, **validated_data)
 
+        # ids are allocated upfront so that the task chain can be wired in memory and inserted at once.
+        tasks_ids = allocate_ids(Task, len(tasks))
+        task_instances = []
         prev_task = None
-        for task in tasks:
-            prev_task = Task.objects.create(
-                workflow=workflow, parent_task=prev_task, **task)
-            # prev task Id required, bulk query ommited.
+        for task_id, task in zip(tasks_ids, tasks):
+            expected_start_at, expected_end_at = get_expected_timings(
+                prev_task.expected_end_at if prev_task else workflow.start_at,
+                task['start_delta'],
+                task['duration']
+            )
+            prev_task = Task(
+                id=task_id,
+                workflow=workflow,
+                parent_task=prev_task,
+                expected_start_at=expected_start_at,
+                expected_end_at=expected_end_at,
+                **task
+            )
+            task_instances.append(prev_task)
+
             person = people_assiciated.get(prev_task.assignee_id, {})
             if not person:
                 person['employee'] = prev_task.assignee
@@ -420,12 +451,14 @@ class WorkflowCreateSerializer(WorkflowBaseSerializer):
                 person['task_list'] = []
             person['task_list'].append(prev_task.title)
 
+        accessor_instances = []
         for accessor in accessors:
             if accessor.get('employee').id == employee.id:
                 # do not add creator in the accessor list.
                 continue
-            instance = WorkflowAccess.objects.create(
-                workflow=workflow, **accessor)
+            instance = WorkflowAccess(workflow=workflow, **accessor)
+            accessor_instances.append(instance)
+
             person = people_assiciated.get(instance.employee_id, {})
             if not person:
                 person['employee'] = instance.employee
@@ -433,17 +466,13 @@ class WorkflowCreateSerializer(WorkflowBaseSerializer):
             person['is_shared'] = True
             person['write_permission'] = instance.permission == common_constant.PERMISSION.READ_WRITE
 
+        Task.objects.bulk_create(task_instances)
+        accessor_instances = WorkflowAccess.objects.bulk_create(accessor_instances)
+        create_bulk_history(task_instances + accessor_instances)
+
         workflow.send_mail(people_assiciated, is_updated=False)
 
-        # if workflow will start before celery scheduled task, send it's start task to celery
-        current_time = timezone.now()
-        delta_time = workflow.start_at - current_time
-        if(delta_time < timedelta(seconds=common_constant.WORKFLOW_PERIODIC_TASK_SCHEDULE_SECONDS)):
-            workflow.status = common_constant.WORKFLOW_STATUS.SCHEDULED
-            workflow.save()
-            eta = workflow.start_at if workflow.start_at > current_time else timezone.now() + \
-                timedelta(seconds=10)
-            start_workflow.apply_async((workflow.id,), eta=eta)
+        schedule_workflow_start(workflow)
 
         return workflow
 
@@ -474,3 +503,15 @@ class WorkflowUpdateSerializer(WorkflowBaseSerializer):
             )
 
         return value
+
+    @buffer_histories
+    def update(self, instance, validated_data):
+        '''
+        override to move expected timings of the tasks and the start timer of the workflow along with its start time.
+        '''
+        instance = super(WorkflowUpdateSerializer, self).update(instance, validated_data)
+        if 'start_at' in validated_data:
+            refresh_expected_timings(instance)
+            schedule_workflow_start(instance)
+
+        return instance
@@ -3,26 +3,22 @@ from django.dispatch import receiver
 
 from apps.common import constant as common_constant
 from apps.workflow.models import Workflow, Task
-from apps.workflow.tasks import send_mail_for_workflow, send_mail_for_task
-
-# TODO : send mail via celery.
+from apps.workflow.tasks import record_outbox_event
 
 
 @receiver(post_save, sender=Workflow)
 def send_mail_on_workflow_update(sender, instance, created, **kwargs):
     '''
-    sends mail on workflow update.
+    sends mail on workflow update, through the outbox so that it is sent once the transaction commits.
     '''
     if not created:
-        update_fields = kwargs.get('update_fields') or []
-        send_mail_for_workflow.delay(instance.id, list(update_fields))
+        record_outbox_event(common_constant.OUTBOX_KIND.WORKFLOW_MAIL, instance.id, kwargs.get('update_fields'))
 
 
 @receiver(post_save, sender=Task)
 def send_mail_on_task_update(sender, instance, created, **kwargs):
     '''
-    sends mail on task update.
+    sends mail on task update, through the outbox so that it is sent once the transaction commits.
     '''
     if not created:
-        update_fields = kwargs.get('update_fields') or []
-        send_mail_for_task.delay(instance.id, list(update_fields))
+        record_outbox_event(common_constant.OUTBOX_KIND.TASK_MAIL, instance.id, kwargs.get('update_fields'))
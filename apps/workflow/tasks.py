@@ -3,13 +3,21 @@ from __future__ import unicode_literals
 
 from celery import task, shared_task
 from datetime import timedelta
+import functools
 import logging
+import threading
 
-from django.db.transaction import atomic
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+from django.db.transaction import atomic, on_commit
 from django.utils import timezone
 
 from apps.common import constant as common_constant
-from apps.workflow.models import Workflow, Task, WorkflowAccess
+from apps.common.mail import MailBatch
+from apps.company.models import UserCompany
+from apps.report.cache import bump_after_commit
+from apps.workflow.models import Workflow, Task, WorkflowAccess, Timer, OutboxEvent
+from apps.workflow.scheduler import schedule_task_start, schedule_timers
 
 logger = logging.getLogger(__name__)
 
@@ -18,25 +26,24 @@ logger = logging.getLogger(__name__)
 @atomic
 def start_workflow(workflow_id):
     '''
-    Marks the workflow to be inprogress.
-    Also start the first task if it's start delta is less than celery scheduled task schedule
+    Marks the workflow to be inprogress and registers the start timer of its first task.
 
     Arguments:
         workflow_id {int} -- id of the workflow to start
     '''
 
     workflow = Workflow.objects.get(pk=workflow_id)
+    if workflow.status not in (common_constant.WORKFLOW_STATUS.INITIATED, common_constant.WORKFLOW_STATUS.SCHEDULED):
+        logger.info('Workflow %s already started' % workflow_id)
+        return
+
     workflow.status = common_constant.WORKFLOW_STATUS.INPROGRESS
     workflow.save(update_fields=['status'])
 
     first_task = workflow.tasks.filter(parent_task__isnull=True)[0]
-    if first_task.start_delta < timedelta(seconds=common_constant.TASK_PERIODIC_TASK_SCHEDULE_SECONDS):
-        first_task.status = common_constant.TASK_STATUS.SCHEDULED
-        first_task.save()
-        start_task.apply_async(
-            (first_task.id,),
-            countdown=first_task.start_delta.seconds
-        )
+    first_task.status = common_constant.TASK_STATUS.SCHEDULED
+    first_task.save(update_fields=['status'])
+    schedule_task_start(first_task, first_task.expected_start_at)
 
 
 @shared_task
@@ -50,15 +57,70 @@ def start_task(task_id):
     '''
 
     task = Task.objects.get(pk=task_id)
+    if task.status not in (common_constant.TASK_STATUS.UPCOMING, common_constant.TASK_STATUS.SCHEDULED):
+        logger.info('Task %s already started' % task_id)
+        return
+
     task.status = common_constant.TASK_STATUS.ONGOING
     task.save(update_fields=['status'])
 
 
+TIMER_HANDLERS = {
+    common_constant.TIMER_KIND.START_WORKFLOW: start_workflow,
+    common_constant.TIMER_KIND.START_TASK: start_task,
+}
+
+
+def fire_due_timers(batch_size=common_constant.TIMER_BATCH_SIZE):
+    '''
+    Claims a batch of due timers and fires them. Rows locked by other timer loops are skipped, so several loops
+    can run side by side. A timer is removed only after its handler succeeded, failed ones are retried after a delay
+    growing with their attempts. Timers failing TIMER_MAX_ATTEMPTS times are parked, left in place but no longer
+    fired, until they are scheduled again.
+
+    Keyword Arguments:
+        batch_size {int} -- maximum number of timers claimed at once (default: {TIMER_BATCH_SIZE})
+
+    Returns:
+        int -- number of timers claimed
+    '''
+
+    with atomic():
+        current_time = timezone.now()
+        timers = list(
+            Timer.objects.select_for_update(skip_locked=True).filter(
+                fire_at__lte=current_time,
+                attempts__lt=common_constant.TIMER_MAX_ATTEMPTS
+            ).order_by('fire_at')[:batch_size]
+        )
+
+        fired_timers_ids = []
+        for timer in timers:
+            try:
+                with atomic():
+                    TIMER_HANDLERS[timer.kind](timer.object_id)
+            except Exception:
+                logger.exception('Timer %s failed' % timer)
+                timer.attempts += 1
+                timer.fire_at = current_time + timedelta(
+                    seconds=common_constant.TIMER_RETRY_SECONDS * timer.attempts)
+                timer.save(update_fields=['attempts', 'fire_at', 'modified'])
+                if timer.attempts >= common_constant.TIMER_MAX_ATTEMPTS:
+                    logger.error('Timer %s parked after %d failed attempts' % (timer, timer.attempts))
+            else:
+                fired_timers_ids.append(timer.id)
+
+        Timer.objects.filter(id__in=fired_timers_ids).delete()
+
+    return len(timers)
+
+
 @shared_task
 @atomic
 def start_workflows_periodic():
     '''
-    Periodic task to schedule workflows to start who's start time is below some threshold.
+    Periodic task to mark workflows who's start time is below some threshold as scheduled. Also registers the start
+    timer of any such workflow missing one.
     '''
     current_time = timezone.now()
     workflows = Workflow.objects.filter(
@@ -66,68 +128,101 @@ def start_workflows_periodic():
         start_at__lt=current_time +
         timedelta(hours=common_constant.WORKFLOW_START_UPDATE_THRESHOLD_HOURS)
     )
-    for workflow in workflows.all():
-        eta = workflow.start_at if workflow.start_at > current_time else timezone.now() + \
-            timedelta(seconds=10)
-        start_workflow.apply_async((workflow.id,), eta=eta)
+    timers_workflows_ids = Timer.objects.filter(
+        kind=common_constant.TIMER_KIND.START_WORKFLOW
+    ).values_list('object_id', flat=True)
+    schedule_timers(
+        common_constant.TIMER_KIND.START_WORKFLOW,
+        list(workflows.exclude(id__in=timers_workflows_ids).values_list('id', 'start_at'))
+    )
 
+    # update() sends no post_save, the cached reports of the companies are invalidated here
+    company_ids = set(workflows.values_list('creator__company_id', flat=True))
     workflows.update(status=common_constant.WORKFLOW_STATUS.SCHEDULED)
+    for company_id in company_ids:
+        bump_after_commit(company_id)
+
+
+SCHEDULE_DUE_TASKS_SQL = '''
+    UPDATE {task_table} AS task
+    SET status = %(scheduled)s
+    FROM (
+        SELECT other_task.id, creator.company_id
+        FROM {task_table} AS other_task
+        INNER JOIN {workflow_table} AS workflow ON workflow.id = other_task.workflow_id
+        INNER JOIN {employee_table} AS creator ON creator.id = workflow.creator_id
+        LEFT OUTER JOIN {task_table} AS parent ON parent.id = other_task.parent_task_id
+        WHERE other_task.status = %(upcoming)s
+          AND other_task.expected_start_at < %(threshold)s
+          AND ((other_task.parent_task_id IS NULL AND workflow.status = %(inprogress)s)
+               OR parent.status = %(complete)s)
+    ) AS due
+    WHERE task.id = due.id
+      AND task.status = %(upcoming)s
+    RETURNING task.id, task.expected_start_at, due.company_id
+'''.format(
+    task_table=Task._meta.db_table,
+    workflow_table=Workflow._meta.db_table,
+    employee_table=UserCompany._meta.db_table
+)
 
 
 @atomic
-def schedule_tasks_helper(tasks):
+def schedule_tasks_helper():
     '''
-    Helper function for scheduling tasks.
+    Marks upcoming tasks who's expected start time is below some threshold as scheduled in a single statement and
+    registers their start timers in bulk. The statement sends no post_save, so the cached reports of the companies of
+    the tasks are invalidated here.
 
-    Arguments:
-        tasks {QuerySet} -- queryset containing the tasks to check for their start time
+    Returns:
+        list -- (task id, start time) tuples of the scheduled tasks
     '''
 
-    current_time = timezone.now()
-    for task in tasks.all():
-        if task.parent_task:
-            delta_time = task.parent_task.completed_at + task.start_delta - current_time
-        else:
-            delta_time = task.workflow.start_at + task.start_delta - current_time
-
-        if (delta_time < timedelta(hours=common_constant.TASK_START_UPDATE_THRESHOLD_HOURS)):
-            if delta_time < timedelta(seconds=0):
-                delta_time = timedelta(seconds=10)
-            start_task.apply_async((task.id,), countdown=delta_time.seconds)
-        else:
-            tasks.exclude(pk=task.id)
+    threshold = timezone.now() + timedelta(hours=common_constant.TASK_START_UPDATE_THRESHOLD_HOURS)
+    with connection.cursor() as cursor:
+        cursor.execute(SCHEDULE_DUE_TASKS_SQL, {
+            'scheduled': common_constant.TASK_STATUS.SCHEDULED,
+            'upcoming': common_constant.TASK_STATUS.UPCOMING,
+            'inprogress': common_constant.WORKFLOW_STATUS.INPROGRESS,
+            'complete': common_constant.TASK_STATUS.COMPLETE,
+            'threshold': threshold,
+        })
+        rows = cursor.fetchall()
 
-    tasks.update(status=common_constant.TASK_STATUS.SCHEDULED)
+    fire_times = [(task_id, expected_start_at) for task_id, expected_start_at, _ in rows]
+    for company_id in set(company_id for _, _, company_id in rows):
+        bump_after_commit(company_id)
+    schedule_timers(common_constant.TIMER_KIND.START_TASK, fire_times)
+    return fire_times
 
 
 @shared_task
 def start_tasks_periodic():
     '''
-    Periodic function to schedule tasks to start who's start time is below some threshold.
+    Periodic function to register start timers of tasks who's start time is below some threshold and which were not
+    scheduled on parent completion or workflow start.
     '''
 
-    # get tasks that have parent
-    tasks = Task.objects.filter(status=common_constant.TASK_STATUS.UPCOMING,
-                                parent_task__isnull=False,
-                                parent_task__status=common_constant.TASK_STATUS.COMPLETE)
-    schedule_tasks_helper(tasks)
-
-    # get tasks that don't have parent, i.e. are first tasks of their workflows
-    tasks = Task.objects.filter(status=common_constant.TASK_STATUS.UPCOMING,
-                                parent_task__isnull=True,
-                                workflow__status=common_constant.WORKFLOW_STATUS.INPROGRESS)
-    schedule_tasks_helper(tasks)
+    fire_times = schedule_tasks_helper()
+    logger.info('%d tasks scheduled' % len(fire_times))
 
 
 @shared_task
 def send_permission_mail(instances):
-    instances = WorkflowAccess.objects.filter(id__in=instances)
+    '''
+    sends workflow shared mail to new accessors over one connection.
+    '''
+    instances = WorkflowAccess.objects.filter(id__in=instances).select_related('employee__user', 'workflow')
+    mail_batch = MailBatch()
     for instance in instances:
-        instance.send_mail()
+        instance.add_mail(mail_batch)
+    failed_recipients = mail_batch.send()
+    logger.info('Accessor mail send to {count} people, failed for {failed}'.format(
+        count=len(mail_batch), failed=failed_recipients))
 
 
 @shared_task
-def send_mail_for_workflow(instance, update_fields):
+def send_mail_for_workflow(instance, update_fields, full_save=False):
     '''
     sends mail on workflow update.
     '''
@@ -135,28 +230,183 @@ def send_mail_for_workflow(instance, update_fields):
     if instance.status == common_constant.WORKFLOW_STATUS.COMPLETE:
         instance.send_mail(
             associated_people_details=False, is_completed=True)
-    elif update_fields:
-        if 'status' in update_fields and instance.status == common_constant.WORKFLOW_STATUS.INPROGRESS:
-            instance.send_mail(
-                associated_people_details=False, is_started=True)
-        elif 'status' in update_fields and instance.status == common_constant.WORKFLOW_STATUS.SCHEDULED:
-            return
-    else:
+        return
+    if 'status' in update_fields and instance.status == common_constant.WORKFLOW_STATUS.INPROGRESS:
+        instance.send_mail(
+            associated_people_details=False, is_started=True)
+    if full_save:
         instance.send_mail(associated_people_details=None, is_updated=True)
 
 
 @shared_task
-def send_mail_for_task(instance, update_fields):
+def send_mail_for_task(instance, update_fields, full_save=False):
     '''
     sends mail on task update.
     '''
     instance = Task.objects.get(pk=instance)
     if instance.status == common_constant.TASK_STATUS.COMPLETE:
         instance.send_mail(is_completed=True)
-    elif update_fields:
-        if 'status' in update_fields and instance.status == common_constant.TASK_STATUS.ONGOING:
-            instance.send_mail(is_started=True)
-        if 'status' in update_fields and instance.status == common_constant.TASK_STATUS.SCHEDULED:
-            return
-    else:
+        return
+    if 'status' in update_fields and instance.status == common_constant.TASK_STATUS.ONGOING:
+        instance.send_mail(is_started=True)
+    if full_save:
         instance.send_mail()
+
+
+OUTBOX_HANDLERS = {
+    common_constant.OUTBOX_KIND.WORKFLOW_MAIL: send_mail_for_workflow,
+    common_constant.OUTBOX_KIND.TASK_MAIL: send_mail_for_task,
+}
+
+# coalesces the event with the pending one of the object, returning the id of the transaction writing it. The retry
+# state of the event written wins: a new change is relayed right away, a failed event is delayed with the changes
+# made while it was relayed.
+STORE_OUTBOX_EVENT_SQL = '''
+INSERT INTO {outbox_table} AS event (
+    created, modified, kind, object_id, update_fields, full_save, attempts, next_attempt_at
+)
+VALUES (
+    %(now)s, %(now)s, %(kind)s, %(object_id)s, %(update_fields)s::varchar(64)[], %(full_save)s, %(attempts)s,
+    %(next_attempt_at)s
+)
+ON CONFLICT (kind, object_id) DO UPDATE SET
+    modified = EXCLUDED.modified,
+    update_fields = ARRAY(
+        SELECT DISTINCT field FROM unnest(event.update_fields || EXCLUDED.update_fields) AS field ORDER BY field
+    ),
+    full_save = event.full_save OR EXCLUDED.full_save,
+    attempts = EXCLUDED.attempts,
+    next_attempt_at = EXCLUDED.next_attempt_at
+RETURNING txid_current()
+'''.format(outbox_table=OutboxEvent._meta.db_table)
+
+
+def store_outbox_event(kind, object_id, update_fields=None, full_save=None, attempts=0, next_attempt_at=None):
+    '''
+    Writes a notification event in the current transaction, coalescing it with the pending event of the object: the
+    saved fields are merged and a save of the whole object is kept as such, so that the same mails are sent as for
+    separate events.
+
+    Arguments:
+        kind {int} -- one of common_constant.OUTBOX_KIND
+        object_id {int} -- id of the changed object
+
+    Keyword Arguments:
+        update_fields {iterable} -- fields saved with update_fields (default: {None})
+        full_save {bool} -- whether the whole object was saved, by default when no fields are given (default: {None})
+        attempts {int} -- number of failed relay attempts of the event (default: {0})
+        next_attempt_at {datetime} -- time from which the event can be relayed, now by default (default: {None})
+
+    Returns:
+        int -- id of the transaction the event was written in
+    '''
+
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(STORE_OUTBOX_EVENT_SQL, {
+            'now': now,
+            'kind': kind,
+            'object_id': object_id,
+            'update_fields': sorted(update_fields or []),
+            'full_save': not update_fields if full_save is None else full_save,
+            'attempts': attempts,
+            'next_attempt_at': next_attempt_at or now,
+        })
+        return cursor.fetchone()[0]
+
+
+_relayed_transaction = threading.local()
+
+
+def _relay_outbox_after_commit(transaction_id):
+    # hooks of a transaction run one after the other once it commits, only the first one enqueues the relay
+    if getattr(_relayed_transaction, 'id', None) == transaction_id:
+        return
+    _relayed_transaction.id = transaction_id
+    relay_outbox.delay()
+
+
+def record_outbox_event(kind, object_id, update_fields=None):
+    '''
+    Writes a notification event in the current transaction and makes sure the outbox is relayed once the
+    transaction commits. The relay is enqueued once per transaction, whatever the number of events.
+    '''
+
+    transaction_id = store_outbox_event(kind, object_id, update_fields)
+    on_commit(functools.partial(_relay_outbox_after_commit, transaction_id))
+
+
+def claim_outbox_events(batch_size):
+    '''
+    Removes a batch of due outbox events, in a transaction of its own, and returns them. Rows locked by another relay
+    are skipped, and the locks are released before any mail is sent, so saves of the objects never wait for a relay.
+    Parked events, which failed OUTBOX_MAX_ATTEMPTS times, are left in place.
+    '''
+
+    with atomic():
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True).filter(
+                next_attempt_at__lte=timezone.now(),
+                attempts__lt=common_constant.OUTBOX_MAX_ATTEMPTS
+            ).order_by('id')[:batch_size]
+        )
+        OutboxEvent.objects.filter(id__in=[event.id for event in events]).delete()
+    return events
+
+
+def retry_outbox_event(event):
+    '''
+    Writes back a failed outbox event, merged with the changes made to its object in the meantime, to be relayed again
+    after a delay growing with its attempts. An event failing OUTBOX_MAX_ATTEMPTS times is parked until its object is
+    saved again.
+    '''
+
+    attempts = event.attempts + 1
+    if attempts >= common_constant.OUTBOX_MAX_ATTEMPTS:
+        logger.error('Outbox event %s parked after %d failed attempts' % (event, attempts))
+    store_outbox_event(
+        event.kind,
+        event.object_id,
+        event.update_fields,
+        full_save=event.full_save,
+        attempts=attempts,
+        next_attempt_at=timezone.now() + timedelta(seconds=common_constant.OUTBOX_RETRY_SECONDS * attempts)
+    )
+
+
+@shared_task
+def relay_outbox(batch_size=common_constant.OUTBOX_BATCH_SIZE):
+    '''
+    Publishes pending outbox events in batches. Events are claimed and removed before their handlers run, a failed
+    event is written back to be retried later.
+
+    Keyword Arguments:
+        batch_size {int} -- maximum number of events claimed at once (default: {OUTBOX_BATCH_SIZE})
+
+    Returns:
+        int -- number of events relayed
+    '''
+
+    relayed = 0
+    failed = 0
+    while True:
+        events = claim_outbox_events(batch_size)
+        for event in events:
+            try:
+                with atomic():
+                    OUTBOX_HANDLERS[event.kind](event.object_id, event.update_fields, event.full_save)
+            except ObjectDoesNotExist:
+                logger.info('Outbox event %s dropped as its object does not exist' % event)
+                relayed += 1
+            except Exception:
+                logger.exception('Outbox event %s failed' % event)
+                retry_outbox_event(event)
+                failed += 1
+            else:
+                relayed += 1
+
+        if len(events) < batch_size:
+            break
+
+    logger.info('%d outbox events relayed, %d failed' % (relayed, failed))
+    return relayed
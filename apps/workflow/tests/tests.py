@@ -1,4 +1,460 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-# Create your tests here.
+from datetime import timedelta
+import random
+
+from django.contrib.contenttypes.models import ContentType
+from django.core import mail
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from apps.common import constant as common_constant
+from apps.common.tests.tests import create_company, create_employee, create_workflow, create_task
+from apps.workflow.helpers import (
+    IntervalTree, get_conflicting_employees, get_parent_start_times, is_task_conflicting, is_time_conflicting,
+    refresh_expected_timings
+)
+from apps.workflow import tasks as workflow_tasks
+from apps.history.models import History
+from apps.history.snapshots import replay
+from apps.workflow.models import OutboxEvent, Task, Timer, Workflow, WorkflowAccess
+from apps.workflow.scheduler import schedule_timers
+from apps.workflow_template.models import WorkflowTemplate
+
+
+class ScheduleTimersTest(TestCase):
+
+    def test_schedule_timers_moves_pending_timers(self):
+        now = timezone.now()
+        kind = common_constant.TIMER_KIND.START_TASK
+        Timer.objects.create(kind=kind, object_id=1, fire_at=now, attempts=3)
+
+        schedule_timers(kind, [(1, now + timedelta(hours=1)), (2, now + timedelta(hours=2))])
+
+        timers = {timer.object_id: timer for timer in Timer.objects.filter(kind=kind)}
+        self.assertEqual(set(timers), {1, 2})
+        self.assertEqual(timers[1].fire_at, now + timedelta(hours=1))
+        self.assertEqual(timers[1].attempts, 0)
+        self.assertEqual(timers[2].fire_at, now + timedelta(hours=2))
+
+    def test_schedule_timers_keeps_other_kinds(self):
+        now = timezone.now()
+        Timer.objects.create(kind=common_constant.TIMER_KIND.START_WORKFLOW, object_id=1, fire_at=now)
+
+        schedule_timers(common_constant.TIMER_KIND.START_TASK, [(1, now + timedelta(hours=1))])
+
+        self.assertEqual(Timer.objects.filter(object_id=1).count(), 2)
+
+
+class FireDueTimersTest(TestCase):
+
+    def setUp(self):
+        self.kind = common_constant.TIMER_KIND.START_TASK
+        self.fired_objects_ids = []
+        handlers = dict(workflow_tasks.TIMER_HANDLERS)
+        workflow_tasks.TIMER_HANDLERS[self.kind] = self.handler
+        self.addCleanup(workflow_tasks.TIMER_HANDLERS.update, handlers)
+        self.failing = False
+
+    def handler(self, object_id):
+        if self.failing:
+            raise ValueError('handler failed')
+        self.fired_objects_ids.append(object_id)
+
+    def test_fired_timers_are_removed(self):
+        Timer.objects.create(kind=self.kind, object_id=1, fire_at=timezone.now())
+        Timer.objects.create(kind=self.kind, object_id=2, fire_at=timezone.now() + timedelta(hours=1))
+
+        self.assertEqual(workflow_tasks.fire_due_timers(), 1)
+
+        self.assertEqual(self.fired_objects_ids, [1])
+        self.assertEqual(list(Timer.objects.values_list('object_id', flat=True)), [2])
+
+    def test_failed_timers_are_retried_later(self):
+        timer = Timer.objects.create(kind=self.kind, object_id=1, fire_at=timezone.now(), attempts=1)
+        self.failing = True
+
+        before = timezone.now()
+        self.assertEqual(workflow_tasks.fire_due_timers(), 1)
+
+        timer = Timer.objects.get(id=timer.id)
+        self.assertEqual(timer.attempts, 2)
+        self.assertGreaterEqual(timer.fire_at, before + timedelta(seconds=2 * common_constant.TIMER_RETRY_SECONDS))
+        # not due yet
+        self.failing = False
+        self.assertEqual(workflow_tasks.fire_due_timers(), 0)
+
+    def test_timers_are_parked_after_max_attempts(self):
+        timer = Timer.objects.create(
+            kind=self.kind, object_id=1, fire_at=timezone.now(), attempts=common_constant.TIMER_MAX_ATTEMPTS - 1
+        )
+        self.failing = True
+        workflow_tasks.fire_due_timers()
+        self.assertEqual(Timer.objects.get(id=timer.id).attempts, common_constant.TIMER_MAX_ATTEMPTS)
+
+        self.failing = False
+        Timer.objects.update(fire_at=timezone.now())
+        self.assertEqual(workflow_tasks.fire_due_timers(), 0)
+        self.assertTrue(Timer.objects.filter(id=timer.id).exists())
+
+        # scheduling the timer again revives it
+        schedule_timers(self.kind, [(1, timezone.now())])
+        self.assertEqual(workflow_tasks.fire_due_timers(), 1)
+        self.assertEqual(self.fired_objects_ids, [1])
+
+
+class ParentStartTimeTest(TestCase):
+
+    def setUp(self):
+        self.start_at = timezone.now().replace(microsecond=0)
+        employee = create_employee(create_company(), 'employee@t.com')
+        workflow = create_workflow(employee, self.start_at)
+        self.first_task = create_task(
+            workflow, employee, start_delta=timedelta(hours=1), duration=timedelta(hours=2)
+        )
+        self.second_task = create_task(
+            workflow, employee, self.first_task, start_delta=timedelta(minutes=30), duration=timedelta(hours=1)
+        )
+        self.third_task = create_task(workflow, employee, self.second_task)
+
+    def test_uncompleted_chain_starts_from_workflow(self):
+        parent_start_times = get_parent_start_times([self.first_task.id, self.second_task.id])
+
+        self.assertEqual(parent_start_times, {
+            self.first_task.id: self.start_at + timedelta(hours=3),
+            self.second_task.id: self.start_at + timedelta(hours=4, minutes=30),
+        })
+
+    def test_chain_stops_at_completed_task(self):
+        completed_at = self.start_at + timedelta(hours=10)
+        Task.objects.filter(id=self.first_task.id).update(
+            completed_at=completed_at,
+            status=common_constant.TASK_STATUS.COMPLETE
+        )
+
+        parent_start_times = get_parent_start_times([self.second_task.id])
+
+        self.assertEqual(parent_start_times, {self.second_task.id: completed_at + timedelta(hours=1, minutes=30)})
+
+    def test_repair_expected_timings(self):
+        Task.objects.update(expected_start_at=None, expected_end_at=None)
+
+        call_command('repair_expected_timings', batch_size=1, stdout=StringIO())
+
+        third_task = Task.objects.get(id=self.third_task.id)
+        self.assertEqual(third_task.expected_start_at, self.start_at + timedelta(hours=4, minutes=30))
+        self.assertEqual(third_task.expected_end_at, self.start_at + timedelta(hours=5, minutes=30))
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        employee = create_employee(create_company(), 'employee@t.com')
+        self.workflow = create_workflow(employee, status=common_constant.WORKFLOW_STATUS.INPROGRESS)
+        self.kind = common_constant.OUTBOX_KIND.WORKFLOW_MAIL
+
+    def test_store_outbox_event_coalesces_full_and_partial_saves(self):
+        workflow_tasks.store_outbox_event(self.kind, self.workflow.id)
+        workflow_tasks.store_outbox_event(self.kind, self.workflow.id, ['status'])
+        workflow_tasks.store_outbox_event(self.kind, self.workflow.id, ['name', 'status'])
+
+        event = OutboxEvent.objects.get()
+        self.assertTrue(event.full_save)
+        self.assertEqual(event.update_fields, ['name', 'status'])
+
+    def test_relay_sends_the_mails_of_coalesced_events(self):
+        workflow_tasks.store_outbox_event(self.kind, self.workflow.id)
+        workflow_tasks.store_outbox_event(self.kind, self.workflow.id, ['status'])
+
+        self.assertEqual(workflow_tasks.relay_outbox(), 1)
+
+        # started mail and updated mail, to the creator
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_relay_keeps_failed_events(self):
+        other_workflow = create_workflow(self.workflow.creator, name='other')
+        workflow_tasks.store_outbox_event(self.kind, self.workflow.id, ['name'])
+        workflow_tasks.store_outbox_event(self.kind, other_workflow.id, ['name'])
+
+        def handler(object_id, update_fields, full_save):
+            if object_id == other_workflow.id:
+                raise ValueError('mail server down')
+
+        handlers = dict(workflow_tasks.OUTBOX_HANDLERS)
+        workflow_tasks.OUTBOX_HANDLERS[self.kind] = handler
+        try:
+            self.assertEqual(workflow_tasks.relay_outbox(batch_size=1), 1)
+        finally:
+            workflow_tasks.OUTBOX_HANDLERS.update(handlers)
+
+        self.assertEqual(list(OutboxEvent.objects.values_list('object_id', flat=True)), [other_workflow.id])
+
+    def relay_failing(self, failing_ids):
+        def handler(object_id, update_fields, full_save):
+            # the event is claimed before its handler runs, saves of the object do not wait for the mail
+            self.assertFalse(OutboxEvent.objects.filter(kind=self.kind, object_id=object_id).exists())
+            if object_id in failing_ids:
+                raise ValueError('mail server down')
+
+        handlers = dict(workflow_tasks.OUTBOX_HANDLERS)
+        workflow_tasks.OUTBOX_HANDLERS[self.kind] = handler
+        try:
+            return workflow_tasks.relay_outbox()
+        finally:
+            workflow_tasks.OUTBOX_HANDLERS.update(handlers)
+
+    def test_failed_events_are_retried_later(self):
+        workflow_tasks.store_outbox_event(self.kind, self.workflow.id, ['name'])
+
+        self.assertEqual(self.relay_failing([self.workflow.id]), 0)
+
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        self.assertEqual(event.update_fields, ['name'])
+        self.assertFalse(event.full_save)
+        self.assertGreater(event.next_attempt_at, timezone.now())
+        # not due yet
+        self.assertEqual(self.relay_failing([]), 0)
+        self.assertTrue(OutboxEvent.objects.exists())
+
+    def test_events_are_parked_after_max_attempts(self):
+        workflow_tasks.store_outbox_event(self.kind, self.workflow.id, ['name'])
+
+        for _ in range(common_constant.OUTBOX_MAX_ATTEMPTS):
+            OutboxEvent.objects.update(next_attempt_at=timezone.now())
+            self.relay_failing([self.workflow.id])
+
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.attempts, common_constant.OUTBOX_MAX_ATTEMPTS)
+        OutboxEvent.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(self.relay_failing([]), 0)
+
+        # a new save of the object relays the parked changes with it
+        workflow_tasks.store_outbox_event(self.kind, self.workflow.id, ['status'])
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.attempts, event.update_fields), (0, ['name', 'status']))
+        self.assertEqual(self.relay_failing([]), 1)
+        self.assertFalse(OutboxEvent.objects.exists())
+
+
+class ScheduleDueTasksTest(TestCase):
+
+    def setUp(self):
+        self.employee = create_employee(create_company(), 'employee@t.com')
+        self.workflow = create_workflow(self.employee, status=common_constant.WORKFLOW_STATUS.INPROGRESS)
+        self.due_at = timezone.now() + timedelta(minutes=30)
+
+    def create_due_task(self, workflow=None, parent_task=None, expected_start_at=None):
+        task = create_task(workflow or self.workflow, self.employee, parent_task)
+        Task.objects.filter(id=task.id).update(expected_start_at=expected_start_at or self.due_at)
+        return task
+
+    def test_due_tasks_ready_to_start_are_scheduled(self):
+        completed_task = self.create_due_task()
+        Task.objects.filter(id=completed_task.id).update(status=common_constant.TASK_STATUS.COMPLETE)
+        first_task = self.create_due_task()
+        child_of_completed = self.create_due_task(parent_task=completed_task)
+        self.create_due_task(parent_task=first_task)
+        self.create_due_task(expected_start_at=timezone.now() + timedelta(days=1))
+        self.create_due_task(workflow=create_workflow(self.employee, name='initiated'))
+
+        fire_times = workflow_tasks.schedule_tasks_helper()
+
+        scheduled_ids = sorted([first_task.id, child_of_completed.id])
+        self.assertEqual(sorted(task_id for task_id, _ in fire_times), scheduled_ids)
+        self.assertEqual(sorted(Task.objects.filter(
+            status=common_constant.TASK_STATUS.SCHEDULED
+        ).values_list('id', flat=True)), scheduled_ids)
+        self.assertEqual(sorted(Timer.objects.filter(
+            kind=common_constant.TIMER_KIND.START_TASK
+        ).values_list('object_id', flat=True)), scheduled_ids)
+
+    def test_scheduled_tasks_are_not_scheduled_again(self):
+        self.create_due_task()
+
+        self.assertEqual(len(workflow_tasks.schedule_tasks_helper()), 1)
+        self.assertEqual(workflow_tasks.schedule_tasks_helper(), [])
+
+
+class IntervalTreeTest(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        generator = random.Random(0)
+        self.intervals = []
+        for index in range(200):
+            start_time = self.now + timedelta(minutes=generator.randrange(0, 10000))
+            self.intervals.append((start_time, start_time + timedelta(minutes=generator.randrange(1, 300)), index))
+        self.tree = IntervalTree(self.intervals)
+
+    def test_overlapping_matches_a_linear_scan(self):
+        generator = random.Random(1)
+        for _ in range(100):
+            start_time = self.now + timedelta(minutes=generator.randrange(-100, 10100))
+            end_time = start_time + timedelta(minutes=generator.randrange(1, 300))
+
+            expected = sorted(
+                interval for interval in self.intervals
+                if is_time_conflicting(start_time, end_time, interval[0], interval[1])
+            )
+            self.assertEqual(sorted(self.tree.overlapping(start_time, end_time)), expected)
+            self.assertEqual(self.tree.is_overlapping(start_time, end_time), bool(expected))
+
+    def test_touching_intervals_do_not_overlap(self):
+        tree = IntervalTree([(self.now, self.now + timedelta(hours=1), 1)])
+
+        self.assertFalse(tree.is_overlapping(self.now + timedelta(hours=1), self.now + timedelta(hours=2)))
+        self.assertFalse(tree.is_overlapping(self.now - timedelta(hours=1), self.now))
+        self.assertFalse(IntervalTree([]).is_overlapping(self.now, self.now + timedelta(hours=1)))
+
+
+class TaskConflictTest(TestCase):
+
+    def setUp(self):
+        company = create_company()
+        self.busy_employee = create_employee(company, 'busy@t.com')
+        self.free_employee = create_employee(company, 'free@t.com')
+        self.start_at = timezone.now()
+        self.task = create_task(create_workflow(self.busy_employee), self.busy_employee)
+        Task.objects.filter(id=self.task.id).update(
+            expected_start_at=self.start_at, expected_end_at=self.start_at + timedelta(hours=1)
+        )
+
+    def test_range_query_and_interval_trees_agree(self):
+        timings = [
+            (self.start_at + timedelta(minutes=30), self.start_at + timedelta(hours=2), True),
+            (self.start_at + timedelta(hours=1), self.start_at + timedelta(hours=2), False),
+        ]
+        for start_time, end_time, conflicting in timings:
+            self.assertEqual(is_task_conflicting(self.busy_employee, start_time, end_time), conflicting)
+            self.assertEqual(is_task_conflicting(self.busy_employee, start_time, end_time, visited={}), conflicting)
+
+    def test_ignored_tasks_do_not_conflict(self):
+        end_time = self.start_at + timedelta(hours=1)
+
+        self.assertFalse(is_task_conflicting(self.busy_employee, self.start_at, end_time, None, [self.task.id]))
+        self.assertFalse(is_task_conflicting(self.busy_employee, self.start_at, end_time, {}, [self.task.id]))
+
+    def test_conflicting_employees_are_listed_in_order(self):
+        end_time = self.start_at + timedelta(hours=1)
+
+        conflicting_employees = get_conflicting_employees([
+            (self.free_employee, self.start_at, end_time),
+            (self.busy_employee, self.start_at, end_time),
+            (self.busy_employee, end_time, end_time + timedelta(hours=1)),
+        ])
+
+        self.assertEqual(conflicting_employees, [self.busy_employee])
+
+
+class RefreshExpectedTimingsTest(TestCase):
+
+    def setUp(self):
+        self.start_at = timezone.now().replace(microsecond=0)
+        employee = create_employee(create_company(), 'employee@t.com')
+        self.workflow = create_workflow(employee, self.start_at)
+        self.tasks = [create_task(self.workflow, employee, start_delta=timedelta(hours=1))]
+        for _ in range(2):
+            self.tasks.append(create_task(self.workflow, employee, self.tasks[-1], start_delta=timedelta(minutes=30)))
+        refresh_expected_timings(self.workflow)
+
+    def get_timings(self):
+        return [
+            (task.expected_start_at, task.expected_end_at)
+            for task in Task.objects.filter(workflow=self.workflow).order_by('id')
+        ]
+
+    def test_timings_follow_the_chain(self):
+        self.assertEqual(self.get_timings(), [
+            (self.start_at + timedelta(hours=1), self.start_at + timedelta(hours=2)),
+            (self.start_at + timedelta(hours=2, minutes=30), self.start_at + timedelta(hours=3, minutes=30)),
+            (self.start_at + timedelta(hours=4), self.start_at + timedelta(hours=5)),
+        ])
+        self.assertEqual(refresh_expected_timings(self.workflow), [])
+
+    def test_timings_are_kept_out_of_the_histories(self):
+        for task in self.tasks:
+            history = task.histories.get()
+            self.assertEqual(history.action, common_constant.HISTORY_ACTION.CREATE)
+            self.assertNotIn('expected_start_at', history.changes)
+            self.assertNotIn('expected_end_at', history.changes)
+        # the as-of state holds no timings gone stale since the refresh
+        state, _ = replay(self.workflow.id)
+        self.assertEqual(len(state['task']), len(self.tasks))
+        for values in state['task'].values():
+            self.assertNotIn('expected_start_at', values)
+
+    def test_changed_task_moves_the_tasks_after_it(self):
+        second_task = Task.objects.get(id=self.tasks[1].id)
+        second_task.duration = timedelta(hours=2)
+
+        changed_tasks = refresh_expected_timings(self.workflow, second_task)
+
+        self.assertEqual([task.id for task in changed_tasks], [task.id for task in self.tasks[1:]])
+        self.assertEqual(self.get_timings()[1:], [
+            (self.start_at + timedelta(hours=2, minutes=30), self.start_at + timedelta(hours=4, minutes=30)),
+            (self.start_at + timedelta(hours=5), self.start_at + timedelta(hours=6)),
+        ])
+
+    def test_completed_task_ends_at_its_completion(self):
+        completed_at = self.start_at + timedelta(minutes=90)
+        first_task = Task.objects.get(id=self.tasks[0].id)
+        first_task.completed_at = completed_at
+
+        refresh_expected_timings(self.workflow, first_task)
+
+        self.assertEqual(self.get_timings()[0][1], completed_at)
+        self.assertEqual(self.get_timings()[1][0], completed_at + timedelta(minutes=30))
+
+
+class WorkflowCreateTest(APITestCase):
+
+    def setUp(self):
+        company = create_company()
+        self.admin = create_employee(company, 'admin@t.com', is_admin=True)
+        self.employees = [create_employee(company, 'first@t.com'), create_employee(company, 'second@t.com')]
+        self.template = WorkflowTemplate.objects.create(name='template', structure={})
+        self.start_at = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        self.client.force_authenticate(self.admin.user)
+
+    def test_tasks_and_accessors_are_created_in_bulk(self):
+        response = self.client.post(reverse('workflow:workflow-list'), {
+            'template': self.template.id,
+            'name': 'workflow',
+            'start_at': self.start_at.isoformat(),
+            'tasks': [
+                {'title': title, 'assignee': employee.id, 'start_delta': '00:30:00', 'duration': '01:00:00'}
+                for title, employee in zip(['first', 'second', 'third'], self.employees + self.employees[:1])
+            ],
+            'accessors': [
+                {'employee': self.employees[1].id, 'permission': common_constant.PERMISSION.READ},
+                {'employee': self.admin.id, 'permission': common_constant.PERMISSION.READ_WRITE},
+            ],
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        workflow = Workflow.objects.get(id=response.data['id'])
+        tasks = list(workflow.tasks.order_by('id'))
+        self.assertEqual([task.title for task in tasks], ['first', 'second', 'third'])
+        self.assertEqual([task.parent_task_id for task in tasks], [None, tasks[0].id, tasks[1].id])
+        self.assertEqual(
+            [task.expected_start_at for task in tasks],
+            [self.start_at + timedelta(minutes=30 + 90 * index) for index in range(3)]
+        )
+        # the creator is not added as an accessor
+        self.assertEqual(
+            list(WorkflowAccess.objects.filter(workflow=workflow).values_list('employee_id', flat=True)),
+            [self.employees[1].id]
+        )
+        self.assertEqual(History.objects.filter(
+            content_type=ContentType.objects.get_for_model(Task), object_id__in=[task.id for task in tasks]
+        ).count(), 3)
+        self.assertTrue(Timer.objects.filter(kind=common_constant.TIMER_KIND.START_WORKFLOW, object_id=workflow.id))
@@ -2,11 +2,9 @@
 from __future__ import unicode_literals
 
 import logging
-from datetime import timedelta
 
 from django.contrib.auth import get_user_model
 from django.db.models import Q
-from django.db.transaction import atomic
 from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 
@@ -17,28 +15,86 @@ from rest_framework.mixins import (
     CreateModelMixin, ListModelMixin, RetrieveModelMixin,
     UpdateModelMixin, DestroyModelMixin
 )
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from rest_framework.viewsets import GenericViewSet
 
 from apps.common import constant as common_constant
+from apps.common.pagination import KeysetPagination, CreatedKeysetPagination
 from apps.company.models import Company, UserCompany
 from apps.company.permissions import (IsActiveCompanyEmployee, IsCompanyAdmin)
 from apps.workflow import permissions as workflow_permissions
 from apps.workflow import serializers as workflow_serializers
+from apps.workflow.helpers import refresh_expected_timings
 from apps.workflow.models import Workflow, Task, WorkflowAccess
-from apps.workflow.tasks import start_task
+from apps.workflow.scheduler import schedule_task_start
+from apps.history.helpers import buffer_histories
 from apps.history.models import History
-from apps.history.serializers import HistorySerializer
+from apps.history.partitions import read_archived_histories
+from apps.history.serializers import HistorySerializer, HistoryAsOfSerializer
+from apps.history.snapshots import get_workflow_state
+from apps.report.rollups import record_task_completion
 
 User = get_user_model()
 UPDATE_METHODS = ('PATCH', 'PUT')
+ARCHIVE_OFFSET_PARAM = 'archive_offset'
 
 logger = logging.getLogger(__name__)
 
 
+def archived_history_response(view, is_listed):
+    '''
+    Page of the histories read back from the archived partitions, paged by offset as archived histories are plain
+    instances. The last archived page links to the first page of the history table. Archive files are scanned up to
+    the requested page, so this is slow.
+    '''
+    request = view.request
+    page_size = view.paginator.get_page_size(request)
+    try:
+        offset = max(int(request.query_params.get(ARCHIVE_OFFSET_PARAM, 0)), 0)
+    except ValueError:
+        offset = 0
+
+    histories = read_archived_histories(
+        lambda history: any(map(is_listed, History.expand_changes([history]))),
+        limit=offset + page_size + 1
+    )
+    page = [history for history in History.expand_changes(histories[offset:offset + page_size]) if is_listed(history)]
+
+    url = request.build_absolute_uri()
+    if len(histories) > offset + page_size:
+        next_link = replace_query_param(url, ARCHIVE_OFFSET_PARAM, offset + page_size)
+    else:
+        next_link = remove_query_param(remove_query_param(url, ARCHIVE_OFFSET_PARAM), 'include_archived')
+    previous_link = replace_query_param(url, ARCHIVE_OFFSET_PARAM, max(offset - page_size, 0)) if offset else None
+    serializer = view.get_serializer(instance=page, many=True)
+    return response.Response({
+        'next': next_link,
+        'previous': previous_link,
+        'resume': None,
+        'results': serializer.data,
+    })
+
+
+def history_response(view, histories, is_listed):
+    '''
+    Paginated response of the histories, expanded to one entry per field and filtered with is_listed. With
+    include_archived=1 the histories of the archived partitions are paged first, see archived_history_response.
+    '''
+    params = view.request.query_params
+    if params.get('include_archived') == '1' and view.paginator.cursor_query_param not in params:
+        return archived_history_response(view, is_listed)
+
+    page = view.paginate_queryset(histories)
+    page = [history for history in History.expand_changes(page) if is_listed(history)]
+    serializer = view.get_serializer(instance=page, many=True)
+    return view.get_paginated_response(serializer.data)
+
+
 class WorkflowCRULView(CreateModelMixin, ListModelMixin, RetrieveModelMixin, UpdateModelMixin, GenericViewSet):
     queryset = Workflow.objects.all()
     permission_classes = (workflow_permissions.WorkflowAccessPermission,)
     serializer_class = workflow_serializers.WorkflowCreateSerializer
+    pagination_class = KeysetPagination
 
     def get_serializer_class(self):
         if self.request.method in UPDATE_METHODS:
@@ -101,25 +157,43 @@ class WorkflowCRULView(CreateModelMixin, ListModelMixin, RetrieveModelMixin, Upd
 
     @action(detail=True,
             methods=['get'],
-            serializer_class=HistorySerializer)
+            serializer_class=HistorySerializer,
+            pagination_class=CreatedKeysetPagination)
     def history(self, request, pk):
         workflow_instance = self.get_object()
-        tasks_qs = Task.objects.filter(workflow=workflow_instance)
-        permission_qs = WorkflowAccess.objects_all.filter(
-            workflow=workflow_instance)
-        history = History.objects.exclude(field_name='id').filter(
-            Q(workflows=workflow_instance) |
-            Q(workflow_accesses__in=permission_qs, field_name='permission') |
-            Q(tasks__in=tasks_qs)
+        access_content_type = ContentType.objects.get_for_model(WorkflowAccess)
+        # histories are tagged with their workflow, only permission changes of workflow accesses are shown
+        history = History.objects.filter(workflow_id=workflow_instance.id).exclude(field_name='id').exclude(
+            ~Q(field_name='permission'),
+            ~Q(changes__has_key='permission'),
+            content_type=access_content_type
         )
-        serializer = self.get_serializer(instance=history, many=True)
-        return response.Response(serializer.data, status=status.HTTP_200_OK)
+        return history_response(self, history, lambda history: (
+            history.workflow_id == workflow_instance.id and history.field_name != 'id' and (
+                history.content_type_id != access_content_type.id or history.field_name == 'permission'
+            )
+        ))
+
+    @action(detail=True,
+            methods=['get'],
+            url_path='as-of',
+            serializer_class=HistoryAsOfSerializer)
+    def as_of(self, request, pk):
+        '''
+            workflow, its tasks and accessors as they were at the time given in ts.
+        '''
+        workflow_instance = self.get_object()
+        serializer = self.get_serializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        state = get_workflow_state(workflow_instance.id, serializer.validated_data['ts'])
+        return response.Response(state, status=status.HTTP_200_OK)
 
 
 class TaskULView(RetrieveModelMixin, UpdateModelMixin, ListModelMixin, GenericViewSet):
     queryset = Task.objects.all()
     permission_classes = (workflow_permissions.TaskAccessPermission,)
     serializer_class = workflow_serializers.TaskUpdateSerializer
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         employee = self.request.user.active_employee
@@ -133,11 +207,10 @@ class TaskULView(RetrieveModelMixin, UpdateModelMixin, ListModelMixin, GenericVi
         ).distinct()
 
     @action(detail=True, methods=['patch'], url_path='completed')
-    @atomic
+    @buffer_histories
     def mark_task_completion(self, request, *args, **kwargs):
         '''
-        Mark task as completed and intiate next task after its start delta if it's start delta is higher than celery
-        scheduled task schedule.
+        Mark task as completed and register the start timer of the next task after its start delta.
         '''
         task_instance = self.get_object()
         # bad request if task is not ongoing.
@@ -147,17 +220,17 @@ class TaskULView(RetrieveModelMixin, UpdateModelMixin, ListModelMixin, GenericVi
         task_instance.status = common_constant.TASK_STATUS.COMPLETE
         task_instance.completed_at = timezone.now()
         task_instance.save()
+        record_task_completion(task_instance)
+        refresh_expected_timings(task_instance.workflow, task_instance)
 
         next_task = Task.objects.filter(parent_task=task_instance)
 
         if next_task.exists():
-            # send start task to celery if start delta of next task is less than celery scheduled task schedule
+            # register start timer of the next task after its start delta
             next_task = next_task[0]
-            if next_task.start_delta < timedelta(seconds=common_constant.TASK_PERIODIC_TASK_SCHEDULE_SECONDS):
-                next_task.status = common_constant.TASK_STATUS.SCHEDULED
-                next_task.save()
-                start_task.apply_async(
-                    (next_task.id,), countdown=next_task.start_delta.seconds)
+            next_task.status = common_constant.TASK_STATUS.SCHEDULED
+            next_task.save(update_fields=['status'])
+            schedule_task_start(next_task, next_task.expected_start_at)
         else:
             # mark workflow as completed
             task_instance.workflow.status = common_constant.WORKFLOW_STATUS.COMPLETE
@@ -170,11 +243,15 @@ class TaskULView(RetrieveModelMixin, UpdateModelMixin, ListModelMixin, GenericVi
 
     @action(detail=True,
             methods=['get'],
-            serializer_class=HistorySerializer)
+            serializer_class=HistorySerializer,
+            pagination_class=CreatedKeysetPagination)
     def history(self, request, pk):
         task_instance = self.get_object()
+        task_content_type = ContentType.objects.get_for_model(Task)
         history = History.objects.exclude(field_name='id').filter(
             tasks=task_instance
         )
-        serializer = self.get_serializer(instance=history, many=True)
-        return response.Response(serializer.data, status=status.HTTP_200_OK)
+        return history_response(self, history, lambda history: (
+            history.content_type_id == task_content_type.id and history.object_id == task_instance.id and
+            history.field_name != 'id'
+        ))
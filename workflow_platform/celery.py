@@ -1,9 +1,19 @@
 from __future__ import absolute_import
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'workflow_platform.settings.settings')
 
 app = Celery('workflow_platform')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
+
+
+@worker_process_init.connect
+def compile_mail_templates(**kwargs):
+    '''
+    compile mail templates once per worker process, before the first notification is rendered.
+    '''
+    from apps.common.mail import preload_mail_templates
+    preload_mail_templates()
@@ -154,6 +154,29 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = "workflow_platform/media/"
 
+# history partitions older than the retention are dumped to this directory of the archive storage and dropped from
+# the database. They are written by the celery worker and read back by the web nodes, which need a storage shared by
+# their hosts, e.g. storages.backends.s3boto3.S3Boto3Storage, when they do not run on the same one.
+HISTORY_ARCHIVE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+HISTORY_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive', 'history')
+HISTORY_RETENTION_MONTHS = 12
+HISTORY_PARTITION_MONTHS_AHEAD = 2
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'reports': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'report_cache',
+    },
+}
+# reports are cached until the data of their company changes, time relative ones at most for the timeout. The reports
+# cache also holds the results of report jobs, so it must be shared between the web and worker processes.
+REPORT_CACHE_ALIAS = 'reports'
+REPORT_CACHE_TIMEOUT = 15 * 60
+REPORT_JOB_TIMEOUT = 60 * 60
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.TokenAuthentication',
@@ -224,6 +247,14 @@ CELERY_BEAT_SCHEDULE = {
     'start-tasks-periodic': {
         'task': 'apps.workflow.tasks.start_tasks_periodic',
         'schedule': common_constant.TASK_PERIODIC_TASK_SCHEDULE_SECONDS
+    },
+    'relay-outbox-periodic': {
+        'task': 'apps.workflow.tasks.relay_outbox',
+        'schedule': common_constant.OUTBOX_RELAY_SCHEDULE_SECONDS
+    },
+    'maintain-history-partitions-periodic': {
+        'task': 'apps.history.tasks.maintain_history_partitions',
+        'schedule': common_constant.HISTORY_PARTITION_SCHEDULE_SECONDS
     }
 }
 